@@ -0,0 +1,518 @@
+"""A local stand-in for the parts of Cloud Storage and BigQuery that the
+runner uses, for benchmarking and trying out transfers offline.
+
+It serves minimal discovery documents, so the real API client libraries
+can talk to it: point `CloudHandler` at it by setting
+OPENP_CLOUD_ENDPOINT to its root URL. Objects, uploads and jobs are
+kept in memory.
+
+Responses can be delayed by a fixed latency and throttled to a
+bandwidth, and a proportion of requests can be made to fail with a 503
+or a connection reset. BigQuery jobs stay running for a set number of
+seconds before they're done.
+
+Run it on its own with:
+
+    python -m benchmarks.fakecloud --port 8780 --latency 0.05
+
+"""
+import argparse
+import base64
+import collections
+import datetime
+import hashlib
+import json
+import random
+import re
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Bytes read or written between bandwidth checks
+BLOCK_SIZE = 64 * 1024
+# Most objects or tables in one page of a listing
+PAGE_SIZE = 1000
+
+
+def discovery_document(api, root_url):
+    """Return just enough of the discovery document for `api` for the
+    client library to build the methods the runner calls
+    """
+    def param(location, required=False, type='string'):
+        return {'type': type, 'location': location, 'required': required}
+
+    def method(name, http_method, path, parameters, **extra):
+        desc = {
+            'id': "%s.%s" % (api, name),
+            'path': path,
+            'httpMethod': http_method,
+            'parameters': parameters,
+            'parameterOrder': [k for k, v in parameters.items()
+                               if v['required']],
+            'response': {'$ref': 'Resource'},
+        }
+        desc.update(extra)
+        return desc
+
+    if api == 'storage':
+        service_path = 'storage/v1/'
+        bucket = {'bucket': param('path', True)}
+        obj = dict(bucket, object=param('path', True))
+        upload_path = '/upload/storage/v1/b/{bucket}/o'
+        resources = {'objects': {'methods': {
+            'list': method('objects.list', 'GET', 'b/{bucket}/o', dict(
+                bucket, prefix=param('query'), pageToken=param('query'),
+                maxResults=param('query', type='integer'))),
+            'get': method('objects.get', 'GET', 'b/{bucket}/o/{object}',
+                          obj, supportsMediaDownload=True),
+            'insert': method(
+                'objects.insert', 'POST', 'b/{bucket}/o',
+                dict(bucket, name=param('query')),
+                request={'$ref': 'Resource'}, supportsMediaUpload=True,
+                mediaUpload={'accept': ['*/*'], 'protocols': {
+                    'simple': {'multipart': True, 'path': upload_path},
+                    'resumable': {'multipart': True, 'path': upload_path},
+                }}),
+        }}}
+    elif api == 'bigquery':
+        service_path = 'bigquery/v2/'
+        project = {'projectId': param('path', True)}
+        resources = {
+            'jobs': {'methods': {
+                'insert': method('jobs.insert', 'POST',
+                                 'projects/{projectId}/jobs', project,
+                                 request={'$ref': 'Resource'}),
+                'get': method('jobs.get', 'GET',
+                              'projects/{projectId}/jobs/{jobId}',
+                              dict(project, jobId=param('path', True))),
+                'query': method('jobs.query', 'POST',
+                                'projects/{projectId}/queries', project,
+                                request={'$ref': 'Resource'}),
+            }},
+            'tables': {'methods': {
+                'list': method(
+                    'tables.list', 'GET',
+                    'projects/{projectId}/datasets/{datasetId}/tables',
+                    dict(project, datasetId=param('path', True),
+                         pageToken=param('query'),
+                         maxResults=param('query', type='integer'))),
+            }},
+        }
+    else:
+        return None
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': api,
+        'name': api,
+        'version': service_path.split('/')[1],
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': service_path,
+        'baseUrl': root_url + service_path,
+        'batchPath': 'batch/' + service_path,
+        'parameters': {
+            'alt': {'type': 'string', 'default': 'json', 'location': 'query'},
+            'fields': {'type': 'string', 'location': 'query'},
+        },
+        'schemas': {'Resource': {'id': 'Resource', 'type': 'object'}},
+        'resources': resources,
+    }
+
+
+class FakeCloud(object):
+    """The stand-in's state, and how badly it behaves.
+
+    `latency` is seconds added to each request, `bandwidth` bytes per
+    second each connection can send or receive, `error_rate` and
+    `reset_rate` the proportions of requests answered with a 503 or a
+    dropped connection, and `job_seconds` how long BigQuery jobs run.
+    Counts of requests and injected failures are kept in `stats`.
+
+    """
+    def __init__(self, latency=0, bandwidth=None, error_rate=0,
+                 reset_rate=0, job_seconds=0, page_size=PAGE_SIZE,
+                 seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.job_seconds = job_seconds
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.jobs = {}
+        self.tables = set()
+        self.stats = collections.Counter()
+        self.server = None
+        self.url = None
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a background thread, returning the root URL
+        """
+        self.server = Server((host, port), Handler)
+        self.server.cloud = self
+        self.url = "http://%s:%s/" % self.server.server_address
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.close_connections()
+        self.server.server_close()
+
+    def failure(self):
+        """Return 'reset' or 'error' if this request should fail
+        """
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.reset_rate:
+            return 'reset'
+        if roll < self.reset_rate + self.error_rate:
+            return 'error'
+
+    def add_object(self, bucket, name, data):
+        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        metadata = {
+            'kind': 'storage#object',
+            'id': "%s/%s" % (bucket, name),
+            'bucket': bucket,
+            'name': name,
+            'size': str(len(data)),
+            'md5Hash': base64.b64encode(hashlib.md5(data).digest()),
+            'timeCreated': now,
+            'updated': now,
+        }
+        with self.lock:
+            self.objects[(bucket, name)] = (data, metadata)
+        return metadata
+
+
+class Server(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(
+            self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Close kept-alive connections, so their threads finish
+        """
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        # Clients going away, and the connections we reset, are expected.
+        # Handler threads can also outlive a stand-in that isn't stopped,
+        # and find the modules torn down at exit.
+        if sys is None:
+            return
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', r'/discovery/v1/apis/(\w+)/\w+/rest', 'get_discovery'),
+        ('GET', r'/storage/v1/b/([^/]+)/o', 'list_objects'),
+        ('GET', r'/storage/v1/b/([^/]+)/o/([^/]+)', 'get_object'),
+        ('POST', r'/upload/storage/v1/b/([^/]+)/o', 'start_upload'),
+        ('PUT', r'/upload/storage/v1/b/([^/]+)/o', 'continue_upload'),
+        ('POST', r'/bigquery/v2/projects/([^/]+)/jobs', 'insert_job'),
+        ('GET', r'/bigquery/v2/projects/([^/]+)/jobs/([^/]+)', 'get_job'),
+        ('POST', r'/bigquery/v2/projects/([^/]+)/queries', 'query'),
+        ('GET', r'/bigquery/v2/projects/([^/]+)/datasets/([^/]+)/tables',
+         'list_tables'),
+    ]
+
+    @property
+    def cloud(self):
+        return self.server.cloud
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        url = urlparse.urlsplit(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        self.body = self.read_body()
+        with self.cloud.lock:
+            self.cloud.stats['requests'] += 1
+        if self.cloud.latency:
+            time.sleep(self.cloud.latency)
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.match(pattern + '$', url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send_json(404, {'error': {
+                'code': 404, 'message': "No route for %s %s" % (
+                    method, url.path)}})
+        if handler != 'get_discovery':
+            failure = self.cloud.failure()
+            if failure:
+                with self.cloud.lock:
+                    self.cloud.stats[failure + 's'] += 1
+                if failure == 'reset':
+                    return self.reset()
+                return self.send_json(503, {'error': {
+                    'code': 503, 'message': 'Injected error'}})
+        args = [urllib.unquote(group) for group in match.groups()]
+        getattr(self, handler)(*args)
+
+    def read_body(self):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        blocks = []
+        while remaining:
+            block = self.rfile.read(min(remaining, BLOCK_SIZE))
+            if not block:
+                break
+            blocks.append(block)
+            remaining -= len(block)
+            self.throttle(len(block))
+        return ''.join(blocks)
+
+    def throttle(self, size):
+        if self.cloud.bandwidth:
+            time.sleep(float(size) / self.cloud.bandwidth)
+
+    def reset(self):
+        """Drop the connection with a TCP reset, without a response
+        """
+        self.close_connection = True
+        self.connection.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), BLOCK_SIZE):
+            block = body[start:start + BLOCK_SIZE]
+            self.wfile.write(block)
+            self.throttle(len(block))
+
+    def send_json(self, status, obj, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self.send(status, json.dumps(obj), headers)
+
+    def page(self, items, key):
+        start = int(self.query.get('pageToken') or 0)
+        size = min(int(self.query.get('maxResults') or self.cloud.page_size),
+                   self.cloud.page_size)
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+    def get_discovery(self, api):
+        document = discovery_document(api, self.cloud.url)
+        if document is None:
+            return self.send_json(404, {'error': {'code': 404}})
+        self.send_json(200, document)
+
+    def list_objects(self, bucket):
+        prefix = self.query.get('prefix', '')
+        with self.cloud.lock:
+            items = [metadata for (b, name), (_, metadata)
+                     in sorted(self.cloud.objects.items())
+                     if b == bucket and name.startswith(prefix)]
+        response = self.page(items, 'items')
+        response['kind'] = 'storage#objects'
+        self.send_json(200, response)
+
+    def get_object(self, bucket, name):
+        with self.cloud.lock:
+            found = self.cloud.objects.get((bucket, name))
+        if found is None:
+            return self.send_json(404, {'error': {
+                'code': 404, 'message': "No such object: %s" % name}})
+        data, metadata = found
+        if self.query.get('alt') != 'media':
+            return self.send_json(200, metadata)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if not match:
+            return self.send(200, data)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        self.send(206, data[start:end + 1], {
+            'Content-Range': "bytes %s-%s/%s" % (start, end, len(data))})
+
+    def start_upload(self, bucket):
+        name = self.query.get('name')
+        if self.query.get('uploadType') == 'media' and name:
+            return self.send_json(
+                200, self.cloud.add_object(bucket, name, self.body))
+        if self.query.get('uploadType') != 'resumable':
+            return self.send_json(400, {'error': {
+                'code': 400, 'message': 'Only resumable and media uploads '
+                'are supported'}})
+        if self.body:
+            name = json.loads(self.body).get('name', name)
+        upload_id = hashlib.sha1(
+            "%s %s %s" % (bucket, name, time.time())).hexdigest()
+        with self.cloud.lock:
+            self.cloud.uploads[upload_id] = {
+                'bucket': bucket, 'name': name, 'data': []}
+        self.send_json(200, {}, {'Location': "%supload/storage/v1/b/%s/o?"
+                                 "uploadType=resumable&upload_id=%s" % (
+                                     self.cloud.url, bucket, upload_id)})
+
+    def continue_upload(self, bucket):
+        with self.cloud.lock:
+            upload = self.cloud.uploads.get(self.query.get('upload_id'))
+        if upload is None:
+            return self.send_json(404, {'error': {
+                'code': 404, 'message': 'No such upload'}})
+        received = sum(len(block) for block in upload['data'])
+        match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)$',
+                         self.headers.get('Content-Range', ''))
+        if not match:
+            return self.send_json(400, {'error': {
+                'code': 400, 'message': 'Bad Content-Range'}})
+        if match.group(1) != '*' and int(match.group(2)) == received:
+            upload['data'].append(self.body)
+            received += len(self.body)
+        total = match.group(4)
+        if total != '*' and received >= int(total):
+            with self.cloud.lock:
+                self.cloud.uploads.pop(self.query['upload_id'], None)
+            return self.send_json(200, self.cloud.add_object(
+                upload['bucket'], upload['name'], ''.join(upload['data'])))
+        headers = {}
+        if received:
+            headers['Range'] = "bytes=0-%s" % (received - 1)
+        self.send(308, '', headers)
+
+    def insert_job(self, project):
+        job = json.loads(self.body or '{}')
+        job_id = job.get('jobReference', {}).get('jobId') or \
+            "job_%s" % hashlib.sha1(str(time.time())).hexdigest()[:16]
+        job['jobReference'] = {'projectId': project, 'jobId': job_id}
+        job['status'] = {'state': 'RUNNING'}
+        with self.cloud.lock:
+            self.cloud.jobs[job_id] = (
+                time.time() + self.cloud.job_seconds, job)
+            self.cloud.stats['jobs'] += 1
+        self.send_json(200, job)
+
+    def get_job(self, project, job_id):
+        with self.cloud.lock:
+            found = self.cloud.jobs.get(job_id)
+        if found is None:
+            return self.send_json(404, {'error': {
+                'code': 404, 'message': "No such job: %s" % job_id}})
+        done_at, job = found
+        if time.time() >= done_at and job['status']['state'] != 'DONE':
+            self.finish_job(job)
+        self.send_json(200, job)
+
+    def finish_job(self, job):
+        job['status'] = {'state': 'DONE'}
+        load = job.get('configuration', {}).get('load')
+        if load:
+            missing = []
+            with self.cloud.lock:
+                for uri in load.get('sourceUris', []):
+                    match = re.match(r'gs://([^/]+)/(.*)$', uri)
+                    if not match or match.groups() not in self.cloud.objects:
+                        missing.append(uri)
+            if missing:
+                error = {'reason': 'notFound',
+                         'message': "Not found: %s" % ", ".join(missing)}
+                job['status'].update({'errorResult': error,
+                                      'errors': [error]})
+                return
+        destination = (job.get('configuration', {}).get('load') or
+                       job.get('configuration', {}).get('query') or
+                       {}).get('destinationTable')
+        if destination:
+            with self.cloud.lock:
+                self.cloud.tables.add(
+                    (destination['datasetId'], destination['tableId']))
+
+    def query(self, project):
+        self.send_json(200, {
+            'kind': 'bigquery#queryResponse',
+            'jobComplete': True,
+            'schema': {'fields': [{'name': 'count', 'type': 'INTEGER'}]},
+            'rows': [{'f': [{'v': '0'}]}],
+            'totalRows': '1',
+        })
+
+    def list_tables(self, project, dataset):
+        with self.cloud.lock:
+            tables = sorted(t for d, t in self.cloud.tables if d == dataset)
+        self.send_json(200, self.page([
+            {'tableReference': {'projectId': project, 'datasetId': dataset,
+                                'tableId': table}}
+            for table in tables], 'tables'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for Cloud Storage and BigQuery")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8780)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds added to each request")
+    parser.add_argument('--bandwidth', type=float,
+                        help="Bytes per second per connection")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Proportion of requests answered with a 503")
+    parser.add_argument('--reset-rate', type=float, default=0,
+                        help="Proportion of requests whose connection is reset")
+    parser.add_argument('--job-seconds', type=float, default=0,
+                        help="Seconds BigQuery jobs take")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    cloud = FakeCloud(
+        latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, reset_rate=args.reset_rate,
+        job_seconds=args.job_seconds, page_size=args.page_size,
+        seed=args.seed)
+    url = cloud.start(args.host, args.port)
+    print "Serving on %s; set OPENP_CLOUD_ENDPOINT=%s to use it" % (url, url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cloud.stop()
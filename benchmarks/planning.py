@@ -0,0 +1,264 @@
+"""Benchmarks of how the runner's planning scales with the manifest,
+the data directory and the import log.
+
+For each scale, a synthetic manifest, data tree and `log.json` are
+generated in a temporary directory. Each planning entry point is then
+run in a fresh process there, so that its peak memory use is its own;
+the process reports the wall time of each repeat and its peak RSS.
+
+Run from the top of the repository:
+
+    python -m benchmarks.planning --scales small,medium
+    python -m benchmarks.planning --compare benchmarks/results/planning-...json
+
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import report
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Sizes of synthetic setup: number of sources, months of data, and the
+# most sources each source depends on
+SCALES = {
+    'small': {'sources': 50, 'months': 24, 'max_parents': 2},
+    'medium': {'sources': 200, 'months': 60, 'max_parents': 3},
+    'large': {'sources': 500, 'months': 120, 'max_parents': 4},
+}
+DEFAULT_SCALES = ['small', 'medium']
+# Data files written to each month directory of each source
+FILES_PER_MONTH = 3
+# Times each entry point is run in its process
+REPEATS = 3
+SEED = 1
+KEY = ['scale', 'entry_point']
+MEASURES = ['best_seconds', 'mean_seconds', 'peak_rss_kb', 'base_rss_kb']
+
+
+def month_dirs(months):
+    """Return `months` month directory names, oldest first, ending in
+    January 2017
+    """
+    names = []
+    year, month = 2017, 1
+    for _ in range(months):
+        names.append("%04d_%02d" % (year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return list(reversed(names))
+
+
+def generate(directory, sources, months, max_parents, seed=SEED):
+    """Write a manifest, data tree and import log for `sources` sources
+    with `months` months of data each into `directory`.
+
+    Each source depends on the one before it, so the dependency chain
+    is as deep as there are sources, plus up to `max_parents` - 1
+    others chosen at random. Half the sources have two importers. All
+    but the most recent month of each source has been imported.
+
+    """
+    rng = random.Random(seed)
+    basedir = os.path.join(directory, 'data')
+    dates = month_dirs(months)
+    manifest = []
+    log = {}
+    for i in range(sources):
+        source_id = "source_%04d" % i
+        names = ["%s_a_.*\\.csv" % source_id]
+        if i % 2:
+            names.append("%s_b_.*\\.csv" % source_id)
+        parents = set()
+        if i:
+            parents.add("source_%04d" % (i - 1))
+            for _ in range(rng.randint(0, max_parents - 1)):
+                parents.add("source_%04d" % rng.randrange(i))
+        manifest.append({
+            'id': source_id,
+            'title': "Synthetic source %s" % i,
+            'description': '',
+            'tags': ['core_data'],
+            'importers': ["import_%s --filename %s" % (source_id, name)
+                          for name in names],
+            'after_import': ["refresh_%s" % source_id] if i % 5 == 0 else [],
+            'depends_on': sorted(parents),
+        })
+        records = []
+        for date in dates:
+            month_dir = os.path.join(basedir, source_id, date)
+            os.makedirs(month_dir)
+            for n in range(FILES_PER_MONTH):
+                kind = 'ab'[n % 2]
+                path = os.path.join(
+                    month_dir, "%s_%s_%s.csv" % (source_id, kind, n))
+                open(path, 'wb').close()
+                if date != dates[-1] and (kind == 'a' or i % 2):
+                    records.append({
+                        'imported_file': path,
+                        'imported_at': "%s-%s-01T00:00:00" % (
+                            date[:4], date[5:]),
+                    })
+        log[source_id] = records
+    with open(os.path.join(directory, 'manifest.json'), 'wb') as f:
+        json.dump(manifest, f, indent=2)
+    with open(os.path.join(directory, 'log.json'), 'wb') as f:
+        json.dump(log, f, indent=2, separators=(',', ': '))
+
+
+def entry_points():
+    """Return a dict of functions that set up a planning entry point,
+    returning a function that runs it once
+    """
+    import runner
+    from utils import plan
+
+    def manifest_reader_cold():
+        def run():
+            if os.path.exists(plan.CACHE_FILE):
+                os.remove(plan.CACHE_FILE)
+            runner.ManifestReader()
+        return run
+
+    def manifest_reader():
+        runner.ManifestReader()
+        return runner.ManifestReader
+
+    def dependency_order():
+        return runner.ManifestReader().sources_ordered_by_dependency
+
+    def unimported_files():
+        reader = runner.ManifestReader()
+
+        def run():
+            for source in reader.sources:
+                for importer in source.get('importers', []):
+                    source.unimported_files(importer)
+        return run
+
+    def importer_cmds():
+        reader = runner.ManifestReader()
+
+        def run():
+            for source in reader.sources:
+                source.importer_cmds_with_latest_data()
+        return run
+
+    def files_since_last_import():
+        reader = runner.ManifestReader()
+
+        def run():
+            for source in reader.sources:
+                source.has_files_since_last_import()
+        return run
+
+    return {
+        'manifest_reader_cold': manifest_reader_cold,
+        'manifest_reader': manifest_reader,
+        'dependency_order': dependency_order,
+        'unimported_files': unimported_files,
+        'importer_cmds': importer_cmds,
+        'files_since_last_import': files_since_last_import,
+    }
+
+
+def measure(entry_point, repeats):
+    """Time `entry_point` in this process, printing the timings and
+    peak RSS as JSON
+    """
+    setup = entry_points()[entry_point]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run = setup()
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        run()
+        timings.append(time.time() - start)
+    print json.dumps({
+        'timings': timings,
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def run_benchmarks(scales, repeats=REPEATS, keep=False):
+    results = []
+    for scale in scales:
+        directory = tempfile.mkdtemp(prefix='planning-%s-' % scale)
+        try:
+            print "Generating %s setup in %s" % (scale, directory)
+            generate(directory, **SCALES[scale])
+            env = os.environ.copy()
+            env['OPENP_DATA_BASEDIR'] = os.path.join(directory, 'data')
+            env['PYTHONPATH'] = os.pathsep.join(
+                [REPO_DIR] + filter(None, [env.get('PYTHONPATH')]))
+            for entry_point in sorted(entry_points()):
+                output = subprocess.check_output(
+                    [sys.executable, '-m', 'benchmarks.planning',
+                     '--measure', entry_point, '--repeats', str(repeats)],
+                    cwd=directory, env=env)
+                measured = json.loads(output.strip().splitlines()[-1])
+                result = dict(SCALES[scale])
+                result.update({
+                    'scale': scale,
+                    'entry_point': entry_point,
+                    'best_seconds': min(measured['timings']),
+                    'mean_seconds': (sum(measured['timings']) /
+                                     len(measured['timings'])),
+                    'peak_rss_kb': measured['peak_rss_kb'],
+                    'base_rss_kb': measured['base_rss_kb'],
+                })
+                print "%-8s %-25s %8.4fs %10s KB" % (
+                    scale, entry_point, result['best_seconds'],
+                    result['peak_rss_kb'])
+                results.append(result)
+        finally:
+            if not keep:
+                shutil.rmtree(directory)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the runner's planning at synthetic scales")
+    parser.add_argument(
+        '--scales', default=','.join(DEFAULT_SCALES),
+        help="Comma-separated scales to run, from %s (default: %%(default)s)"
+        % ", ".join(sorted(SCALES)))
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument(
+        '--output', help="Where to save results (default: a timestamped "
+        "file in benchmarks/results)")
+    parser.add_argument(
+        '--compare', help="Earlier results to compare these with")
+    parser.add_argument(
+        '--keep', action='store_true',
+        help="Keep the generated setups rather than deleting them")
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.repeats)
+        sys.exit()
+    scales = args.scales.split(',')
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        parser.error("Unknown scales: %s" % ", ".join(unknown))
+    results = run_benchmarks(scales, args.repeats, args.keep)
+    print
+    if args.compare:
+        report.print_comparison(
+            report.load_results(args.compare), results, KEY, MEASURES)
+    else:
+        report.print_table(results, KEY, MEASURES)
+    path = report.save_results(
+        'planning', results,
+        {'scales': dict((s, SCALES[s]) for s in scales), 'repeats':
+         args.repeats, 'files_per_month': FILES_PER_MONTH},
+        args.output)
+    print "Saved results to %s" % path
@@ -0,0 +1,94 @@
+"""Saving benchmark results, and comparing them with earlier runs.
+
+Results are a list of dicts, each identified by the values of its
+`key` fields, with numeric measurements in the rest.
+
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'wb')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name, results, params, path=None):
+    """Write `results` as JSON with details of the run, to `path` or a
+    timestamped file in RESULTS_DIR, returning the path
+    """
+    now = datetime.datetime.now().replace(microsecond=0)
+    if path is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        path = os.path.join(RESULTS_DIR, "%s-%s.json" % (
+            name, now.strftime('%Y%m%dT%H%M%S')))
+    with open(path, 'wb') as f:
+        json.dump({
+            'benchmark': name,
+            'run_at': now.isoformat(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'params': params,
+            'results': results,
+        }, f, indent=2, separators=(',', ': '), sort_keys=True)
+    return path
+
+
+def load_results(path):
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def print_table(results, key, measures):
+    print "  ".join("%-22s" % k for k in key) + "".join(
+        "%16s" % m for m in measures)
+    for result in results:
+        print "  ".join("%-22s" % result[k] for k in key) + "".join(
+            "%16s" % format_value(result.get(m)) for m in measures)
+
+
+def print_comparison(previous, results, key, measures):
+    """Print each measurement in `results` beside the matching one in
+    `previous`, as loaded by `load_results`, with the relative change
+    """
+    earlier = dict(
+        (tuple(r[k] for k in key), r) for r in previous['results'])
+    print "Compared with %s (revision %s):" % (
+        previous['run_at'], previous.get('revision'))
+    print "  ".join("%-22s" % k for k in key) + "".join(
+        "%16s %16s %8s" % (m, 'before', 'change') for m in measures)
+    for result in results:
+        before = earlier.get(tuple(result[k] for k in key), {})
+        line = "  ".join("%-22s" % result[k] for k in key)
+        for m in measures:
+            line += "%16s %16s %8s" % (
+                format_value(result.get(m)), format_value(before.get(m)),
+                change(before.get(m), result.get(m)))
+        print line
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return "%.4f" % value
+    return str(value)
+
+
+def change(before, after):
+    if not before or after is None:
+        return '-'
+    return "%+.0f%%" % (100.0 * (after - before) / before)
@@ -0,0 +1,208 @@
+"""Benchmarks of `CloudHandler`'s transfers, against the local stand-in
+in `benchmarks/fakecloud.py`.
+
+Each scenario starts a stand-in with its own latency, bandwidth and
+failure rates, then uploads a set of files, lists them, downloads them
+one at a time and in parallel, and runs a BigQuery load job. For each
+operation it records the wall time, throughput, the requests the
+stand-in served and the failures it injected, and any errors the
+runner's code didn't recover from.
+
+Run from the top of the repository:
+
+    python -m benchmarks.transfer --files 8 --size 4194304
+    python -m benchmarks.transfer --compare benchmarks/results/transfer-...json
+
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from benchmarks import report
+from benchmarks.fakecloud import FakeCloud
+
+# How the stand-in behaves in each scenario; see FakeCloud
+SCENARIOS = {
+    'local': {},
+    'wan': {'latency': 0.05, 'bandwidth': 20 * 1024 * 1024},
+    'flaky': {'latency': 0.02, 'bandwidth': 20 * 1024 * 1024,
+              'error_rate': 0.05, 'reset_rate': 0.02},
+}
+DEFAULT_SCENARIOS = ['local', 'wan', 'flaky']
+FILES = 8
+FILE_SIZE = 4 * 1024 * 1024
+# Small pages, so that listing has to follow page tokens
+PAGE_SIZE = 3
+JOB_SECONDS = 2
+DOWNLOAD_WORKERS = 4
+BUCKET = 'ebmdatalab'
+SEED = 1
+KEY = ['scenario', 'operation']
+MEASURES = ['seconds', 'mb_per_second', 'requests', 'errors', 'resets',
+            'failures']
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide the progress messages transfers print
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'wb')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run_scenario(name, settings, files, size, workers, directory):
+    from utils.cloud import CloudHandler
+    fake = FakeCloud(page_size=PAGE_SIZE, job_seconds=JOB_SECONDS,
+                     seed=SEED, **settings)
+    os.environ['OPENP_CLOUD_ENDPOINT'] = fake.start()
+    handler = CloudHandler()
+    sources = []
+    for i in range(files):
+        path = os.path.join(directory, "upload_%s.csv" % i)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        sources.append(path)
+    names = ["hscic/benchmark/%s" % os.path.basename(p) for p in sources]
+    results = []
+
+    def operation(op_name, func, items, transferred=0):
+        fake.stats.clear()
+        failures = 0
+        start = time.time()
+        with quiet():
+            for item in items:
+                try:
+                    func(item)
+                except Exception as e:
+                    failures += 1
+                    print >> sys.stderr, "%s %s failed: %s: %s" % (
+                        name, op_name, e.__class__.__name__, e)
+        seconds = time.time() - start
+        result = {
+            'scenario': name,
+            'operation': op_name,
+            'seconds': seconds,
+            'mb_per_second': (transferred / seconds / 1024 / 1024
+                              if transferred else None),
+            'requests': fake.stats['requests'],
+            'errors': fake.stats['errors'],
+            'resets': fake.stats['resets'],
+            'failures': failures,
+        }
+        result.update(settings)
+        print "%-8s %-20s %8.2fs %8s requests %4s failures" % (
+            name, op_name, seconds, result['requests'], failures)
+        results.append(result)
+
+    def download(item):
+        name, i = item
+        target = os.path.join(directory, "download_%s.csv" % i)
+        handler.download(target, BUCKET, name)
+        with open(target, 'rb') as f, open(sources[i], 'rb') as g:
+            if f.read() != g.read():
+                raise ValueError("%s differs from what was uploaded" % name)
+        os.remove(target)
+
+    def parallel_download(items):
+        pool = ThreadPool(workers)
+        try:
+            errors = pool.map_async(
+                lambda item: capture(download, item), items).get(2 ** 31)
+        finally:
+            pool.terminate()
+        errors = filter(None, errors)
+        if errors:
+            raise StandardError("%s downloads failed: %s" % (
+                len(errors), "; ".join(errors)))
+
+    try:
+        operation('upload', lambda i: handler.upload(
+            sources[i], BUCKET, names[i]), range(files), files * size)
+        operation('list', lambda prefix: handler.list_raw_datasets(
+            BUCKET, prefix=prefix), ['hscic/benchmark/'])
+        operation('download', download, zip(names, range(files)),
+                  files * size)
+        operation('parallel_download', parallel_download,
+                  [zip(names, range(files))], files * size)
+        operation('load_job', lambda name: handler.load(
+            "gs://%s/%s" % (BUCKET, name), table_name='benchmark',
+            schema='prescribing.json'), names[:1])
+    finally:
+        fake.stop()
+        del os.environ['OPENP_CLOUD_ENDPOINT']
+    return results
+
+
+def capture(func, item):
+    """Return an error message if `func(item)` fails
+    """
+    try:
+        func(item)
+    except Exception as e:
+        return "%s: %s" % (e.__class__.__name__, e)
+
+
+def run_benchmarks(scenarios, files=FILES, size=FILE_SIZE,
+                   workers=DOWNLOAD_WORKERS):
+    directory = tempfile.mkdtemp(prefix='transfer-')
+    # Keep the stand-in's discovery documents out of the real cache
+    os.environ['OPENP_DISCOVERY_CACHE_DIR'] = os.path.join(
+        directory, 'discovery')
+    results = []
+    try:
+        for scenario in scenarios:
+            results += run_scenario(
+                scenario, SCENARIOS[scenario], files, size, workers,
+                directory)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark transfers against a local stand-in for "
+        "Cloud Storage and BigQuery")
+    parser.add_argument(
+        '--scenarios', default=','.join(DEFAULT_SCENARIOS),
+        help="Comma-separated scenarios to run, from %s (default: "
+        "%%(default)s)" % ", ".join(sorted(SCENARIOS)))
+    parser.add_argument('--files', type=int, default=FILES)
+    parser.add_argument('--size', type=int, default=FILE_SIZE,
+                        help="Bytes in each file")
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS,
+                        help="Threads for parallel downloads")
+    parser.add_argument(
+        '--output', help="Where to save results (default: a timestamped "
+        "file in benchmarks/results)")
+    parser.add_argument(
+        '--compare', help="Earlier results to compare these with")
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(',')
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error("Unknown scenarios: %s" % ", ".join(unknown))
+    results = run_benchmarks(scenarios, args.files, args.size, args.workers)
+    print
+    if args.compare:
+        report.print_comparison(
+            report.load_results(args.compare), results, KEY, MEASURES)
+    else:
+        report.print_table(results, KEY, MEASURES)
+    path = report.save_results(
+        'transfer', results,
+        {'scenarios': dict((s, SCENARIOS[s]) for s in scenarios),
+         'files': args.files, 'size': args.size, 'workers': args.workers,
+         'page_size': PAGE_SIZE, 'job_seconds': JOB_SECONDS},
+        args.output)
+    print "Saved results to %s" % path
@@ -0,0 +1,67 @@
+"""Extracting downloaded zip archives.
+"""
+import os
+import zlib
+from zipfile import ZipFile, BadZipfile
+
+from downloader import partial_path
+
+# Number of bytes to decompress at a time
+CHUNKSIZE = 1024 * 1024
+
+
+class ArchiveError(StandardError):
+    pass
+
+
+def extract_members(archive_path, dest, expected_count=None):
+    """Extract every file in the zip at `archive_path` into `dest`,
+    checking each against the CRC recorded in the archive.
+
+    Members are streamed to a temporary name and only renamed once
+    verified, so a failed extraction never leaves a plausible-looking
+    file behind. Returns the list of extracted paths.
+
+    """
+    try:
+        z = ZipFile(archive_path)
+    except (BadZipfile, IOError) as e:
+        raise ArchiveError(
+            "Couldn't read archive at %s: %s" % (archive_path, e))
+    with z:
+        members = [info for info in z.infolist()
+                   if not info.filename.endswith('/')]
+        if expected_count is not None and len(members) != expected_count:
+            raise ArchiveError(
+                "Unexpected file count in archive at %s: "
+                "expected %s, found %s" % (
+                    archive_path, expected_count, len(members)))
+        extracted = []
+        for info in members:
+            target = os.path.join(dest, os.path.basename(info.filename))
+            _extract_member(z, info, target)
+            extracted.append(target)
+    return extracted
+
+
+def _extract_member(z, info, target):
+    partial = partial_path(target)
+    crc = 0
+    try:
+        try:
+            with z.open(info) as src, open(partial, 'wb') as dst:
+                while True:
+                    chunk = src.read(CHUNKSIZE)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    dst.write(chunk)
+        except (BadZipfile, zlib.error) as e:
+            raise ArchiveError(
+                "Couldn't extract %s: %s" % (info.filename, e))
+        if crc & 0xffffffff != info.CRC:
+            raise ArchiveError("Bad CRC-32 for %s" % info.filename)
+        os.rename(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
@@ -1,31 +1,104 @@
 import errno
 import argparse
+import collections
 import glob
+import hashlib
 import os
+import threading
+import time
+
+from downloader import Downloader
+from httpcache import HttpCache
+
+# Number of bytes to read at a time when hashing files
+HASH_CHUNKSIZE = 1024 * 1024
+
+FetchResult = collections.namedtuple(
+    'FetchResult', ['files', 'bytes', 'duration'])
 
 
 class BaseCommand(object):
-    def __init__(self):
+    def __init__(self, argv=None):
+        """Parse `argv`, a list of command-line arguments, defaulting to
+        those this process was started with
+        """
         self.base_parser = argparse.ArgumentParser(add_help=False)
         self.base_parser.add_argument(
             '--verbose', action='store_true')
+        self.base_parser.add_argument(
+            '--offline', action='store_true',
+            help="Don't make any requests; use cached responses only")
         self.add_arguments(self.base_parser)
-        self.args = self.base_parser.parse_args()
+        self.args = self.base_parser.parse_args(argv)
+        self.cancelled = threading.Event()
+        self.files_written = set()
+        self._downloader = None
+        self._http = None
+
+    def run(self):
+        """Run the command, returning a FetchResult describing the
+        files it wrote
+        """
+        start = time.time()
+        self.handle()
+        files = sorted(f for f in self.files_written if os.path.exists(f))
+        return FetchResult(
+            files=files,
+            bytes=sum(os.path.getsize(f) for f in files),
+            duration=time.time() - start)
+
+    def cancel(self):
+        """Ask a running command to stop; its downloads will raise
+        Cancelled
+        """
+        self.cancelled.set()
+
+    def record_file(self, path):
+        """Note that the command has written new data to `path`
+        """
+        self.files_written.add(path)
 
     def add_arguments(self, parser):
         """Override in subclasses as needed
         """
         pass
 
+    def downloader_options(self):
+        """Override in subclasses to return keyword arguments for the
+        command's Downloader
+        """
+        return {}
+
+    @property
+    def downloader(self):
+        """The Downloader shared by all of this command's requests
+        """
+        if self._downloader is None:
+            self._downloader = Downloader(
+                offline=self.args.offline,
+                cancelled=self.cancelled,
+                verbose=self.args.verbose,
+                **self.downloader_options())
+        return self._downloader
+
+    @property
+    def http(self):
+        """The on-disk HttpCache shared by all fetchers
+        """
+        if self._http is None:
+            self._http = HttpCache(self.downloader)
+        return self._http
+
     def most_recent_file(self, path):
         return sorted(glob.glob("%s/*/*" % path))[-1]
 
     def extension_to_uppercase(self, path, suffix):
         for name in glob.glob("%s/*.%s" % (path, suffix.lower())):
-            os.rename(
-                name,
-                "%s.%s" % (name[:-(len(suffix)+1)], suffix.upper())
-            )
+            new_name = "%s.%s" % (name[:-(len(suffix)+1)], suffix.upper())
+            os.rename(name, new_name)
+            if name in self.files_written:
+                self.files_written.remove(name)
+                self.files_written.add(new_name)
 
     def mkdir_p(self, path):
         try:
@@ -35,3 +108,12 @@ class BaseCommand(object):
                 pass
             else:
                 raise
+
+    def sha256(self, path):
+        """Return the hex SHA-256 digest of the file at `path`
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNKSIZE), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
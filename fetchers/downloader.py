@@ -0,0 +1,328 @@
+"""Streaming HTTP downloads over a pooled session.
+
+Fetchers share a `Downloader` for the length of a run: it keeps
+connections alive between requests, resumes partial files with Range
+requests (like `wget -c`), and limits how hard we hit any one host.
+
+"""
+import os
+import shutil
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of bytes to read from the network for each write
+CHUNKSIZE = 1024 * 1024
+# Number of downloads to run at once
+MAX_WORKERS = 4
+# Number of simultaneous connections allowed to any one host
+MAX_PER_HOST = 2
+# Minimum number of seconds between starting requests to one host
+HOST_DELAY = 0.5
+# Number of simultaneous HEAD requests allowed to any one host when
+# checking which of several URLs exist; these are cheap, so aren't
+# subject to HOST_DELAY
+MAX_PROBES_PER_HOST = 8
+# Seconds to wait for the server to connect or send more data
+TIMEOUT = 60
+# Effectively forever; waiting with a timeout lets KeyboardInterrupt
+# through to the main thread while workers are running
+WAIT_FOREVER = 2 ** 31
+
+
+class DownloadError(StandardError):
+    pass
+
+
+class Cancelled(StandardError):
+    pass
+
+
+def partial_path(target_file):
+    """Return where a download to `target_file` is kept until it's
+    complete; hidden, so that importers' globs don't pick it up
+    """
+    directory, name = os.path.split(target_file)
+    return os.path.join(directory, ".%s.part" % name)
+
+
+class HostLimiter(object):
+    """Context manager bounding the number of concurrent requests to a
+    host, and spacing out the times at which they start.
+
+    """
+    def __init__(self, max_connections, delay):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.time()
+            wait = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.delay
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class TokenBucket(object):
+    """Rate limiter allowing `rate` requests per second on average, in
+    bursts of up to `capacity`.
+
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """Block until a request is allowed
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Downloader(object):
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST,
+                 host_delay=HOST_DELAY, rate_limiter=None, offline=False,
+                 cancelled=None, verbose=False):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.host_delay = host_delay
+        self.rate_limiter = rate_limiter
+        self.offline = offline
+        # An Event which, once set, stops downloads in their tracks
+        self.cancelled = cancelled or threading.Event()
+        self.verbose = verbose
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+
+    def limiter(self, url, probe=False):
+        host = urlparse.urlparse(url).netloc
+        with self.hosts_lock:
+            if (host, probe) not in self.hosts:
+                if probe:
+                    limiter = HostLimiter(MAX_PROBES_PER_HOST, 0)
+                else:
+                    limiter = HostLimiter(self.max_per_host, self.host_delay)
+                self.hosts[(host, probe)] = limiter
+            return self.hosts[(host, probe)]
+
+    def first_existing(self, urls):
+        """Return the first of `urls` that the server has, or None.
+
+        All the URLs are checked at once, with HEAD requests.
+
+        """
+        if not urls:
+            return None
+        pool = ThreadPool(len(urls))
+        try:
+            found = pool.map_async(self.exists, urls).get(WAIT_FOREVER)
+        finally:
+            pool.terminate()
+        for url, exists in zip(urls, found):
+            if exists:
+                return url
+        return None
+
+    def exists(self, url):
+        """Return True if the server has `url`
+        """
+        self.check_cancelled()
+        if self.offline:
+            raise DownloadError("Offline, so not checking %s" % url)
+        with self.limiter(url, probe=True):
+            if self.verbose:
+                print "Checking %s" % url
+            try:
+                response = self.session.head(
+                    url, allow_redirects=True, timeout=TIMEOUT)
+                if response.status_code in (405, 501):
+                    # The server doesn't do HEAD; start a GET instead
+                    response = self.session.get(
+                        url, stream=True, timeout=TIMEOUT)
+                    response.close()
+            except requests.RequestException:
+                return False
+        return response.status_code == 200
+
+    def get(self, url, headers=None):
+        """Return the response for `url`, whatever its status.
+
+        Raise DownloadError only if we couldn't get a response at all.
+
+        """
+        with self.limiter(url):
+            response = self._get(url, headers or {})
+            try:
+                # Read the body while we hold our slot for this host
+                response.content
+            finally:
+                response.close()
+        return response
+
+    def fetch(self, url, target_file):
+        """Stream `url` to `target_file`, returning the number of bytes
+        written to it.
+
+        The download goes to a hidden partial file alongside
+        `target_file`, which is renamed over it once complete; a file
+        that has been deduplicated into the blob store is never
+        written in place. An interrupted download is resumed from its
+        partial file, as is an existing `target_file` that an earlier
+        download left incomplete. Raise DownloadError if the server
+        doesn't have the file; in that case `target_file` is left
+        untouched.
+
+        When offline, succeed only if `target_file` already exists.
+
+        """
+        if self.offline:
+            if os.path.exists(target_file):
+                return 0
+            raise DownloadError("Offline, and don't have %s" % url)
+        partial = partial_path(target_file)
+        if os.path.exists(partial):
+            resume_from = partial
+        elif os.path.exists(target_file):
+            resume_from = target_file
+        else:
+            resume_from = None
+        headers = {}
+        if resume_from:
+            headers['Range'] = 'bytes=%s-' % os.path.getsize(resume_from)
+        with self.limiter(url):
+            response = self._get(url, headers)
+            try:
+                if response.status_code == 416:
+                    # We already have the whole file
+                    if resume_from == partial:
+                        os.rename(partial, target_file)
+                        return os.path.getsize(target_file)
+                    return 0
+                if response.status_code not in (200, 206):
+                    raise DownloadError(
+                        "Got status %s from %s" % (
+                            response.status_code, url))
+                if response.status_code == 206 and \
+                        resume_from == target_file:
+                    # Carry on from a copy, as `target_file` may be
+                    # linked to a blob other files share
+                    shutil.copyfile(target_file, partial)
+                # A 200 means the server ignored our Range header
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                written = self._write(response, partial, mode)
+            finally:
+                response.close()
+        os.rename(partial, target_file)
+        return written
+
+    def fetch_if_modified(self, url, target_file, etag=None,
+                          last_modified=None):
+        """Stream `url` to `target_file`, unless it hasn't changed since
+        the response that carried `etag` or `last_modified`.
+
+        Returns None if the server says it is unchanged, otherwise the
+        response, whose headers hold validators for the next request.
+        When offline, everything is unchanged.
+
+        """
+        if self.offline:
+            return None
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with self.limiter(url):
+            response = self._get(url, headers)
+            try:
+                if response.status_code == 304:
+                    return None
+                if response.status_code != 200:
+                    raise DownloadError(
+                        "Got status %s from %s" % (
+                            response.status_code, url))
+                self._write(response, target_file, 'wb')
+                return response
+            finally:
+                response.close()
+
+    def _get(self, url, headers):
+        self.check_cancelled()
+        if self.offline:
+            raise DownloadError("Offline, so not fetching %s" % url)
+        if self.rate_limiter:
+            self.rate_limiter.consume()
+        if self.verbose:
+            print "Fetching %s" % url
+        try:
+            return self.session.get(
+                url, headers=headers, stream=True, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            raise DownloadError("Couldn't get %s: %s" % (url, e))
+
+    def _write(self, response, target_file, mode):
+        written = 0
+        with open(target_file, mode) as f:
+            for chunk in response.iter_content(CHUNKSIZE):
+                self.check_cancelled()
+                f.write(chunk)
+                written += len(chunk)
+        return written
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise Cancelled("Download cancelled")
+
+    def map(self, func, items):
+        """Call `func` on each of `items` using a pool of
+        `max_workers` threads, returning the results in order.
+
+        """
+        pool = ThreadPool(self.max_workers)
+        try:
+            return pool.map_async(func, items).get(WAIT_FOREVER)
+        finally:
+            pool.terminate()
+
+    def imap_unordered(self, func, items):
+        """Like `map`, but yield each result as soon as it is ready.
+        """
+        pool = ThreadPool(self.max_workers)
+        try:
+            results = pool.imap_unordered(func, items)
+            while True:
+                try:
+                    yield results.next(WAIT_FOREVER)
+                except StopIteration:
+                    return
+        finally:
+            pool.terminate()
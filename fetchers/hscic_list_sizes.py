@@ -1,9 +1,8 @@
-import requests
 from basecommand import BaseCommand
+from downloader import DownloadError
 from lxml import html
 import re
 from dateutil.parser import parse
-import subprocess
 import urlparse
 
 
@@ -30,29 +29,19 @@ class Command(BaseCommand):
         target_path = "%s/%s_%s" % (
             PREFIX, date.year, str(date.month).zfill(2))
         self.mkdir_p(target_path)
-        target_file = "patient_list_size_new.csv"
+        target_file = "%s/patient_list_size_new.csv" % target_path
         try:
-            self.wget_and_return(source_url, target_file)
-        except subprocess.CalledProcessError:
+            if self.http.fetch(source_url, target_file):
+                self.record_file(target_file)
+        except DownloadError:
             print "Couldn't get url %s" % source_url
 
-    def wget_and_return(self, url, target_file):
-        '''
-        Call wget, raise exception on error
-        Does not overwrite existing files.
-        '''
-        wget_command = 'wget -c -O %s' % target_file
-        cmd = '%s %s' % (wget_command, url)
-        if self.args.verbose:
-            print 'Runing %s' % cmd
-        subprocess.check_call(cmd.split())
-
     def most_recent_data(self):
         url = ('http://content.digital.nhs.uk'
                '/article/2021/Website-Search?'
                'q=Numbers+of+Patients+Registered+at+a+GP+Practice'
                '&go=Go&area=both')
-        page = requests.get(url)
+        page = self.http.get(url)
         tree = html.fromstring(page.content)
         first_link_text = tree.xpath(
             '//li[contains(@class, "HSCICProducts")]//a/text()')[0]
@@ -61,7 +50,7 @@ class Command(BaseCommand):
         most_recent_date = re.search(r" - (.*)$", first_link_text).groups()[0]
         o = urlparse.urlparse(first_link_href)
         q = urlparse.parse_qs(o.query)
-        page = requests.get(
+        page = self.http.get(
             "http://content.digital.nhs.uk/article/2021/Website-Search"
             "?productid=%s" % q['productid'][0])
         tree = html.fromstring(page.content)
@@ -1,17 +1,24 @@
-import requests
 from basecommand import BaseCommand
 from lxml import html
 import re
 from dateutil.parser import parse
 import calendar
-import subprocess
-from zipfile import ZipFile
+import glob
+import json
+import os
+import threading
+
+from archives import ArchiveError, extract_members
+from downloader import DownloadError, MAX_WORKERS
 
 
 """The HSCIC data is the source of prescribing data.
 """
 
 PREFIX = 'data/prescribing'
+BASE_URL = "http://datagov.ic.nhs.uk/presentation"
+# Where we remember which spelling of each month's URLs worked
+RESOLVED_URLS_FILE = "%s/.resolved_urls.json" % PREFIX
 
 
 class Command(BaseCommand):
@@ -26,8 +33,19 @@ class Command(BaseCommand):
             '--sample',
             action='store_true',
             help="Download a representative sample, useful for development")
+        parser.add_argument(
+            '--max_workers', type=int, default=MAX_WORKERS,
+            help="Number of months to download at once")
+        parser.add_argument(
+            '--keep_archives', action='store_true',
+            help="Keep zip archives after extracting their contents")
+
+    def downloader_options(self):
+        return {'max_workers': self.args.max_workers}
 
     def handle(self):
+        self.resolved_lock = threading.Lock()
+        self._resolved_urls = None
         if self.args.sample:
             date_range = self.sample_date_range()
         else:
@@ -41,74 +59,138 @@ class Command(BaseCommand):
                 start_date = parse("2010/08")
                 end_date = self.most_recent_date()
             date_range = self.date_range(start_date, end_date)
-        for year, month in date_range:
-            if self.args.verbose:
-                print "Getting data for %s-%s" % (year, month)
-            target_path = "%s/%s_%s" % (PREFIX, year, str(month).zfill(2))
-            self.mkdir_p(target_path)
-            try:
-                self.get_zipped_version(year, month, target_path)
-            except subprocess.CalledProcessError:
-                self.get_unzipped_version(year, month, target_path)
-            self.extension_to_uppercase(target_path, 'csv')
+        self.downloader.map(self.get_month, list(date_range))
         if self.args.verbose:
             print "Done"
 
+    def get_month(self, year_and_month):
+        year, month = year_and_month
+        if self.args.verbose:
+            print "Getting data for %s-%s" % (year, month)
+        target_path = "%s/%s_%s" % (PREFIX, year, str(month).zfill(2))
+        self.mkdir_p(target_path)
+        if self.have_month(year, month, target_path):
+            if self.args.verbose:
+                print "Already have data for %s-%s" % (year, month)
+            return
+        try:
+            self.get_zipped_version(year, month, target_path)
+        except DownloadError:
+            self.get_unzipped_version(year, month, target_path)
+        self.extension_to_uppercase(target_path, 'csv')
+
+    def have_month(self, year, month, target_path):
+        month_filled = str(month).zfill(2)
+        return all(
+            glob.glob("%s/T%s%s%s*.CSV" % (target_path, year, month_filled, f))
+            for f in ['PDPI', 'ADDR', 'CHEM'])
+
     def get_zipped_version(self, year, month, target_path):
         target_file = "%s/%s_%s_hscic.zip" % (target_path, year, month)
         month_name = calendar.month_name[month]
         poss_month_names = [month_name, month_name.lower(),
                             month_name[:3], month_name[:3].lower()]
+        candidates = []
         for possibility in poss_month_names:
             path = "%s_%s_%s" % (year, str(month).zfill(2),
                                  month_name)
             name = "%s_%s_%s" % (year, str(month).zfill(2),
                                  possibility)
-            url = "%s/%s.exe" % (path, name)
-            try:
-                self.wget_and_return(url, target_file)
-                break
-            except subprocess.CalledProcessError:
-                print "Nothing found at ", url
-                next
-        z = ZipFile(target_file)
-        if len(z.namelist()) == 3:
-            z.extractall("%s/%s_%s/" % (PREFIX, year, str(month).zfill(2)))
-        else:
-            raise "Unexpected file count in archive at %s" % target_file
+            candidates.append("%s/%s.exe" % (path, name))
+        self.download_first_existing(
+            year, month, 'zipped', candidates, target_file)
+        try:
+            extracted = extract_members(
+                target_file, target_path, expected_count=3)
+        except ArchiveError:
+            # Set the archive aside, so the next run doesn't try to
+            # resume it
+            os.rename(target_file, "%s.bad" % target_file)
+            raise
+        for path in extracted:
+            self.record_file(path)
+        if not self.args.keep_archives:
+            os.remove(target_file)
 
     def get_unzipped_version(self, year, month, target_path):
         '''
         The HSCIC URLs *usually* end with an uppercase .CSV but not
-        always. Try them with the uppercase suffix first, then with
-        a lowercase .csv suffix if they fail.
+        always. Prefer the uppercase suffix, then a lowercase .csv
+        suffix.
         '''
         individual_files = ['PDPI+BNFT', 'ADDR+BNFT', 'CHEM+SUBS']
         month_filled = str(month).zfill(2)
         date_part = "%s_%s_%s" % (
             year, month_filled, calendar.month_name[month])
         for f in individual_files:
-            for date_part_with_case in [date_part, date_part.lower()]:
-                basename = "T%s%s%s" % (year, month_filled, f)
-                target_file = "%s/%s.CSV" % (target_path, basename)
-                for name in ["%s.CSV" % basename, "%s.csv" % basename]:
-                    url = "%s/%s" % (date_part_with_case, name)
-                    try:
-                        self.wget_and_return(url, target_file)
-                    except subprocess.CalledProcessError:
-                        print "Couldn't get url %s" % url
-
-    def wget_and_return(self, url, target_file):
+            basename = "T%s%s%s" % (year, month_filled, f)
+            target_file = "%s/%s.CSV" % (target_path, basename)
+            candidates = [
+                "%s/%s" % (date_part_with_case, name)
+                for date_part_with_case in [date_part, date_part.lower()]
+                for name in ["%s.CSV" % basename, "%s.csv" % basename]]
+            try:
+                self.download_first_existing(
+                    year, month, f, candidates, target_file)
+            except DownloadError as e:
+                print e
+
+    def download_first_existing(self, year, month, kind, candidates,
+                                target_file):
         '''
-        Call wget, raise exception on error
-        Does not overwrite existing files.
+        Download the first of `candidates` that exists to `target_file`.
+
+        All the candidates are checked at once, and the one found is
+        remembered for next time.
         '''
-        base_url = "http://datagov.ic.nhs.uk/presentation"
-        wget_command = 'wget -c -O %s' % target_file
-        cmd = '%s %s' % (wget_command, "%s/%s" % (base_url, url))
-        if self.args.verbose:
-            print 'Runing %s' % cmd
-        subprocess.check_call(cmd.split())
+        key = "%s_%s" % (year, str(month).zfill(2))
+        with self.resolved_lock:
+            url = self.resolved_urls().get(key, {}).get(kind)
+        if not url:
+            url = self.downloader.first_existing(
+                ["%s/%s" % (BASE_URL, c) for c in candidates])
+            if not url:
+                raise DownloadError(
+                    "No %s data found for %s-%s" % (kind, year, month))
+            self.remember_url(key, kind, url)
+        try:
+            self.download(url, target_file)
+        except DownloadError:
+            self.remember_url(key, kind, None)
+            raise
+
+    def resolved_urls(self):
+        if self._resolved_urls is None:
+            try:
+                with open(RESOLVED_URLS_FILE, 'rb') as f:
+                    self._resolved_urls = json.load(f)
+            except (IOError, ValueError):
+                self._resolved_urls = {}
+        return self._resolved_urls
+
+    def remember_url(self, key, kind, url):
+        """Record `url` as the place to find `kind` of data for the month
+        `key`, or forget it if `url` is None
+        """
+        with self.resolved_lock:
+            urls = self.resolved_urls().setdefault(key, {})
+            if url:
+                urls[kind] = url
+            else:
+                urls.pop(kind, None)
+            self.mkdir_p(PREFIX)
+            with open(RESOLVED_URLS_FILE, 'wb') as f:
+                json.dump(self.resolved_urls(), f, indent=2,
+                          separators=(',', ': '), sort_keys=True)
+
+    def download(self, url, target_file):
+        '''
+        Stream the file at `url` to `target_file`; raise DownloadError
+        if it isn't there.
+        Resumes, rather than overwrites, existing files.
+        '''
+        if self.downloader.fetch(url, target_file):
+            self.record_file(target_file)
 
     def construct_url_path(self, year, month, filename, suffix, lowercase):
         '''
@@ -135,7 +217,7 @@ class Command(BaseCommand):
         url = ('http://content.digital.nhs.uk'
                '/searchcatalogue?'
                'q=title%3a%22presentation+level+data%22&sort=Most+recent')
-        page = requests.get(url)
+        page = self.http.get(url)
         tree = html.fromstring(page.content)
         first_link = tree.xpath(
             '//li[@class="item HSCICProducts first"]//a/text()')[0]
@@ -0,0 +1,184 @@
+"""An on-disk cache of HTTP responses, shared by all fetchers.
+
+Index pages are cached whole. For data files, which fetchers save
+somewhere of their own, we only keep the validators (ETag and
+Last-Modified) of the response that produced them, so an unchanged
+file costs a conditional request rather than a download.
+
+Each URL belongs to a class, whose TTL says how long a cached response
+is used without asking the server whether it has changed at all.
+
+"""
+import hashlib
+import json
+import os
+import thread
+import time
+
+from downloader import DownloadError
+
+CACHE_DIR = os.environ.get('OPENP_HTTP_CACHE_DIR', '.http_cache')
+# Seconds a cached response is served without revalidation, by URL class
+TTLS = {
+    'index': 6 * 60 * 60,
+    'data': 24 * 60 * 60,
+}
+# Once cached bodies take up more than this, the least recently used
+# are evicted
+MAX_BYTES = 512 * 1024 * 1024
+
+
+class CacheMiss(DownloadError):
+    pass
+
+
+class CachedResponse(object):
+    """The parts of a `requests.Response` that fetchers use
+    """
+    def __init__(self, url, headers, content):
+        self.url = url
+        self.status_code = 200
+        self.headers = headers
+        self.content = content
+
+
+class HttpCache(object):
+    def __init__(self, downloader, cache_dir=CACHE_DIR, ttls=TTLS,
+                 max_bytes=MAX_BYTES):
+        self.downloader = downloader
+        self.cache_dir = cache_dir
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, url, url_class='index'):
+        """Return a response for `url`, from the cache if possible.
+
+        Raise CacheMiss if we're offline and it isn't cached.
+
+        """
+        meta = self._read_meta(url)
+        body_path = self._path(url, 'body')
+        if meta and os.path.exists(body_path):
+            if self.downloader.offline or self._is_fresh(meta, url_class):
+                return self._cached_response(url, meta)
+        else:
+            meta = None
+        if self.downloader.offline:
+            raise CacheMiss("Offline, and %s isn't cached" % url)
+        response = self.downloader.get(
+            url, headers=self._conditional_headers(meta))
+        if response.status_code == 304 and meta:
+            self._write_meta(url, meta)
+            return self._cached_response(url, meta)
+        if response.status_code == 200:
+            self._write(body_path, response.content)
+            self._write_meta(url, self._meta_for(response))
+            self.evict()
+        return response
+
+    def fetch(self, url, target_file, url_class='data'):
+        """Save `url` to `target_file`, unless the copy already there
+        came from a response the server says is still current.
+
+        Returns True if `target_file` was (re)written.
+
+        """
+        meta = self._read_meta(url)
+        if not os.path.exists(target_file):
+            meta = None
+        if meta and (self.downloader.offline or
+                     self._is_fresh(meta, url_class)):
+            return False
+        if self.downloader.offline:
+            raise CacheMiss("Offline, and don't have %s" % url)
+        partial = "%s.%s-%s.part" % (
+            target_file, os.getpid(), thread.get_ident())
+        try:
+            response = self.downloader.fetch_if_modified(
+                url, partial,
+                etag=meta and meta['etag'],
+                last_modified=meta and meta['last_modified'])
+            if response is None:
+                self._write_meta(url, meta)
+                return False
+            os.rename(partial, target_file)
+        finally:
+            # Don't leave a truncated file where importers would find it
+            if os.path.exists(partial):
+                os.remove(partial)
+        self._write_meta(url, self._meta_for(response))
+        return True
+
+    def evict(self):
+        """Delete least recently used bodies until we're within
+        `max_bytes`
+        """
+        bodies = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.body'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                bodies.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in bodies)
+        for _, size, name in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            key = name[:-len('.body')]
+            for suffix in ['body', 'json']:
+                try:
+                    os.remove(os.path.join(
+                        self.cache_dir, "%s.%s" % (key, suffix)))
+                except OSError:
+                    pass
+            total -= size
+
+    def _is_fresh(self, meta, url_class):
+        return time.time() - meta['fetched_at'] < self.ttls[url_class]
+
+    def _conditional_headers(self, meta):
+        headers = {}
+        if meta and meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def _cached_response(self, url, meta):
+        body_path = self._path(url, 'body')
+        with open(body_path, 'rb') as f:
+            content = f.read()
+        # The modification time of the body records when it was last
+        # used, for eviction
+        os.utime(body_path, None)
+        return CachedResponse(url, meta['headers'], content)
+
+    def _meta_for(self, response):
+        return {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'headers': dict(response.headers),
+        }
+
+    def _read_meta(self, url):
+        try:
+            with open(self._path(url, 'json'), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, url, meta):
+        meta['fetched_at'] = time.time()
+        self._write(self._path(url, 'json'), json.dumps(meta))
+
+    def _write(self, path, content):
+        # Write then rename, so concurrent readers never see half a file
+        partial = "%s.%s-%s.part" % (path, os.getpid(), thread.get_ident())
+        with open(partial, 'wb') as f:
+            f.write(content)
+        os.rename(partial, path)
+
+    def _path(self, url, suffix):
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cache_dir, "%s.%s" % (key, suffix))
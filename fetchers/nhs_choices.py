@@ -1,73 +1,271 @@
 """
 Pull all available practice email addresses
+
+This runs in two stages. The fetch stage saves each raw page under
+`pages/` in the month's folder, recording progress as it goes, so an
+interrupted run picks up where it left off. Pages previously found to
+be hidden or missing are only checked again once that finding is
+`--stale_days` old. The parse stage then extracts contact details from
+every saved page using a pool of processes, and can be re-run on its
+own with `--parse_only`.
 """
+from lxml import etree
 from lxml import html
-import requests
+from multiprocessing import Pool
 import datetime
+import glob
+import gzip
 import json
-from retrying import retry, RetryError
-import time
+import os
 
 from basecommand import BaseCommand
+from downloader import DownloadError, TokenBucket, WAIT_FOREVER
 
-def retry_if_error(response):
-    return response.status_code != 200
+MIN_ID = 36463  # 54
+MAX_ID = 110367
 
-class Command(BaseCommand):
+CONTACT_PAGE = "http://www.nhs.uk/Services/GP/MapsAndDirections/DefaultView.aspx?id=%s"
 
-    @retry(wait_exponential_multiplier=1000,
-           retry_on_result=retry_if_error,
-           stop_max_attempt_number=1,
-           wait_incrementing_start=0.5)
-    def get_page(self, url):
-        print "Trying %s" % url
-        result = requests.get(url)
-        return result
+# One JSON record per line, giving the status of each ID scraped this
+# month; later lines take precedence
+PROGRESS_FILE = 'progress.jsonl'
+# Statuses for which there is no point asking again until stale
+ABSENT_STATUSES = ['hidden', 'missing']
 
-    def handle(self):
-        min_id = 36463  # 54
-        max_id = 110367
+MAX_WORKERS = 16
+# Maximum requests per second, across all workers
+RATE = 20
+STALE_DAYS = 90
+# Number of records to buffer before writing them out
+BATCH_SIZE = 500
+# Number of pages to send to a parsing process at a time
+PARSE_BATCH_SIZE = 50
+
+# Plain strings, rather than lxml's "smart" ones, can be sent back from
+# the parsing processes
+CONTACTS = etree.XPath(
+    '//*[@id="ctl00_ctl00_ctl00_PlaceHolderMain_contentColumn1"]'
+    '/div[1]/div/div/div[1]')
+HIDDEN = etree.XPath("//*[@id='aliasbox']/h1[text() = 'Profile Hidden']")
+TITLE = etree.XPath('//*[@id="org-title"]/text()', smart_strings=False)
+HEADING_TEXT = etree.XPath(
+    ".//strong[contains(text(), $heading)]/following-sibling::text()[1]",
+    smart_strings=False)
+HEADING_LINK = etree.XPath(
+    ".//strong[contains(text(), $heading)]/following-sibling::a/text()",
+    smart_strings=False)
+HEADINGS = ['Tel', 'Fax', 'Address', 'Email', 'Website']
+
+
+def parse_page(path):
+    """Extract contact details from the saved page at `path`, returning
+    a tuple of (id, status, datum).
+    """
+    _id = int(os.path.basename(path).split('.')[0])
+    datum = {'id': _id}
+    with gzip.open(path, 'rb') as f:
+        content = html.fromstring(f.read())
+    try:
+        contacts = CONTACTS(content)[0]
+    except IndexError:
+        if HIDDEN(content):
+            print "Profile hidden"
+            return _id, 'hidden', None
+        else:
+            print "Other error: %s" % content.text_content()
+            return _id, 'missing', None
+    datum['name'] = TITLE(content)[0]
+    for heading in HEADINGS:
+        if heading == "Email":
+            vals = HEADING_LINK(contacts, heading=heading)
+        else:
+            vals = HEADING_TEXT(contacts, heading=heading)
+        datum[heading.lower()] = vals[0].strip() if vals else ""
+    return _id, 'ok', datum
+
+
+def parse_pages(paths):
+    """Return the results of `parse_page` for each of `paths`
+    """
+    return [parse_page(path) for path in paths]
 
-        contact_page = "http://www.nhs.uk/Services/GP/MapsAndDirections/DefaultView.aspx?id=%s"
-        staff_page = "http://www.nhs.uk/Services/GP/Staff/DefaultView.aspx?id=39327"
 
+class JsonLinesWriter(object):
+    """Write objects to `f` as lines of JSON, `batch_size` at a time
+    """
+    def __init__(self, f, batch_size=BATCH_SIZE):
+        self.f = f
+        self.batch_size = batch_size
+        self.lines = []
+
+    def write(self, obj):
+        self.lines.append(json.dumps(obj) + "\n")
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.lines))
+        self.f.flush()
+        self.lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max_workers', type=int, default=MAX_WORKERS,
+            help="Number of pages to fetch at once")
+        parser.add_argument(
+            '--rate', type=float, default=RATE,
+            help="Maximum number of requests per second")
+        parser.add_argument(
+            '--stale_days', type=int, default=STALE_DAYS,
+            help="Days after which hidden or missing IDs are checked again")
+        parser.add_argument(
+            '--processes', type=int,
+            help="Number of processes to parse with (default: one per CPU)")
+        parser.add_argument(
+            '--parse_only', action='store_true',
+            help="Parse pages already fetched this month, without fetching")
+
+    def downloader_options(self):
+        return {
+            'max_workers': self.args.max_workers,
+            'max_per_host': self.args.max_workers,
+            'host_delay': 0,
+            'rate_limiter': TokenBucket(self.args.rate)}
+
+    def handle(self):
         date_folder = datetime.datetime.today().strftime("%Y_%m")
         data = 'data/nhs_choices/%s/' % date_folder
-        self.mkdir_p(data)
-
-        with open(data + 'details.json', 'wb') as f:
-            for _id in range(min_id, max_id + 100):
-                time.sleep(0.5)
-                datum = {'id': _id}
-                page = contacts = None
-                try:
-                    page = self.get_page(contact_page % _id)
-                except RetryError:
-                    print "Couldn't get it"
-                    continue
-                content = html.fromstring(page.content)
-                try:
-                    contacts = content.xpath('//*[@id="ctl00_ctl00_ctl00_PlaceHolderMain_contentColumn1"]/div[1]/div/div/div[1]')[0]
-                except IndexError:
-                    hidden = not not content.xpath("//*[@id='aliasbox']/h1[text() = 'Profile Hidden']")
-                    if hidden:
-                        print "Profile hidden"
-                        continue
-                    else:
-                        print "Other error: %s" % content.text_content()
-                        continue
-                datum['name'] = content.xpath('//*[@id="org-title"]/text()')[0]
-                headings = ['Tel', 'Fax', 'Address', 'Email', 'Website']
-                for heading in headings:
+        self.pages = data + 'pages/'
+        self.mkdir_p(self.pages)
+        if not (self.args.parse_only or self.args.offline):
+            self.fetch_pages(data)
+        self.parse_pages(data)
+
+    def fetch_pages(self, data):
+        done = self.completed_ids(data)
+        known = self.known_statuses()
+        stale_before = (
+            datetime.datetime.now() -
+            datetime.timedelta(days=self.args.stale_days)).isoformat()
+        ids = []
+        for _id in range(MIN_ID, MAX_ID + 100):
+            if _id in done:
+                continue
+            record = known.get(_id)
+            if (record and record['status'] in ABSENT_STATUSES and
+                    record['checked_at'] > stale_before):
+                continue
+            ids.append(_id)
+        print "Fetching %s IDs (%s done this month, %s known absent)" % (
+            len(ids), len(done), MAX_ID + 100 - MIN_ID - len(done) - len(ids))
+        with open(data + PROGRESS_FILE, 'ab') as f:
+            with JsonLinesWriter(f, batch_size=1) as progress:
+                for _id, status in self.downloader.imap_unordered(
+                        self.fetch_page, ids):
+                    progress.write(
+                        {'id': _id, 'status': status,
+                         'checked_at': self.now()})
+
+    def parse_pages(self, data):
+        paths = glob.glob(self.pages + '*.html.gz')
+        print "Parsing %s pages" % len(paths)
+        # Hand pages to the pool in batches, to keep the overhead of
+        # passing them between processes down
+        batches = [paths[i:i + PARSE_BATCH_SIZE]
+                   for i in range(0, len(paths), PARSE_BATCH_SIZE)]
+        pool = Pool(self.args.processes)
+        try:
+            results = pool.imap_unordered(parse_pages, batches)
+            self.record_file(data + 'details.json')
+            with open(data + 'details.json', 'wb') as details_file, \
+                    open(data + PROGRESS_FILE, 'ab') as progress_file:
+                with JsonLinesWriter(details_file) as details, \
+                        JsonLinesWriter(progress_file) as progress:
+                    while True:
+                        try:
+                            batch = results.next(WAIT_FOREVER)
+                        except StopIteration:
+                            break
+                        for _id, status, datum in batch:
+                            if datum:
+                                details.write(datum)
+                            checked_at = datetime.datetime.fromtimestamp(
+                                os.path.getmtime(self.page_path(_id)))
+                            progress.write(
+                                {'id': _id, 'status': status,
+                                 'checked_at': checked_at.replace(
+                                     microsecond=0).isoformat()})
+        finally:
+            pool.terminate()
+
+    def now(self):
+        return datetime.datetime.now().replace(microsecond=0).isoformat()
+
+    def page_path(self, _id):
+        return "%s%s.html.gz" % (self.pages, _id)
+
+    def completed_ids(self, data):
+        """Return IDs already fetched, or found missing, this month
+        """
+        done = set(
+            _id for _id, record in self.read_progress(
+                data + PROGRESS_FILE).items()
+            if record['status'] != 'error')
+        for path in glob.glob(self.pages + '*.html.gz'):
+            done.add(int(os.path.basename(path).split('.')[0]))
+        return done
+
+    def known_statuses(self):
+        """Return the most recent progress record for every ID ever
+        scraped
+        """
+        known = {}
+        for path in sorted(glob.glob('data/nhs_choices/*/%s' % PROGRESS_FILE)):
+            known.update(self.read_progress(path))
+        return known
+
+    def read_progress(self, path):
+        records = {}
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
                     try:
-                        if heading == "Email":
-                            val = contacts.xpath("//strong[contains(text(),'%s')]/following-sibling::a/text()" % heading)[0].strip()
-                        else:
-                            val = contacts.xpath("//strong[contains(text(),'%s')]/following-sibling::text()[1]" % heading)[0].strip()
-                    except IndexError:
-                        val = ""
-                    datum[heading.lower()] = val
-                print json.dumps(datum)
-                f.write(json.dumps(datum) + "\n")
+                        record = json.loads(line)
+                    except ValueError:
+                        # A partial line from an interrupted run
+                        continue
+                    records[record['id']] = record
+        except IOError:
+            pass
+        return records
+
+    def fetch_page(self, _id):
+        """Save the raw page for `_id`, returning a tuple of (id, status)
+        """
+        try:
+            page = self.downloader.get(CONTACT_PAGE % _id)
+        except DownloadError as e:
+            print "Couldn't get it: %s" % e
+            return _id, 'error'
+        if page.status_code == 404:
+            return _id, 'missing'
+        if page.status_code != 200:
+            print "Couldn't get it: status %s" % page.status_code
+            return _id, 'error'
+        path = self.page_path(_id)
+        with gzip.open(path + '.part', 'wb') as f:
+            f.write(page.content)
+        os.rename(path + '.part', path)
+        return _id, 'fetched'
+
+
 if __name__ == '__main__':
     Command().handle()
@@ -1,13 +1,14 @@
-from StringIO import StringIO
-import requests
 from zipfile import ZipFile
 import shutil
 import tempfile
-import filecmp
 import datetime
+import glob
+import json
 import os
 
 from basecommand import BaseCommand
+from downloader import partial_path
+from snapshots import delta_paths, diff_snapshots, DELTA_KINDS
 
 """Practice and CCG metadata, keyed by code.
 
@@ -23,6 +24,10 @@ This data is therefore worth updating every month.
 
 """
 
+# Where we record what we last downloaded for each source, relative to
+# its data directory. Dotfiles are ignored by the importers.
+STATE_FILE = '.fetch_state.json'
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -42,13 +47,15 @@ class Command(BaseCommand):
         self.fetch_and_extract_zipped_csv(
             "https://digital.nhs.uk/media/354/eccg/zip/eccg1",
             "eccg.csv",
-            "data/ccg_details")
+            "data/ccg_details",
+            key_column=0)
 
     def fetch_practice_details(self):
         self.fetch_and_extract_zipped_csv(
             "https://digital.nhs.uk/media/372/epraccur/zip/epraccur",
             "epraccur.csv",
-            "data/practice_details")
+            "data/practice_details",
+            key_column=0)
 
     def fetch_org_postcodes(self):
         url = "https://digital.nhs.uk/media/636/Gridall/zip/gridall"
@@ -57,31 +64,117 @@ class Command(BaseCommand):
             'gridall.csv',
             'data/nhs_postcode_file')
 
-    def fetch_and_extract_zipped_csv(self, url, expected_filename, dest):
+    def fetch_and_extract_zipped_csv(self, url, expected_filename, dest,
+                                     key_column=None):
         """Grab a zipfile from a url, and extract a CSV.
 
-        Save it to a datestamped folder if it's different from the
-        latest previously-known data
+        Save it to a datestamped folder if its contents differ from
+        the latest previously-known data. The validators and digest
+        of the last download are kept in `dest`, so an unchanged
+        release costs a single conditional request.
+
+        If `key_column` is given, rows added, changed and removed since
+        the previous snapshot, matched on that column, are saved
+        alongside the new one.
 
         """
-        t = tempfile.mkdtemp()[1]
-        f = StringIO()
-        f.write(requests.get(url).content)
-        f.flush()
-        zipfile = ZipFile(f)
-        zipfile.extract(expected_filename, t)
-        extracted_file_path = "%s/%s" % (t, expected_filename)
-        most_recent = self.most_recent_file(dest)
-        changed = not filecmp.cmp(
-            most_recent, extracted_file_path, shallow=True)
-        if changed:
-            new_folder = datetime.datetime.today().strftime("%Y_%m")
-            new_path = "%s/%s/" % (dest, new_folder)
-            os.makedirs(new_path)
-            if self.args.verbose:
-                print "%s has changed; creating new copy" % most_recent
-            shutil.copy(extracted_file_path, new_path)
-        shutil.rmtree(t)
+        state = self.load_state(dest)
+        previous = state.get(url, {})
+        t = tempfile.mkdtemp()
+        try:
+            archive_path = os.path.join(t, 'download.zip')
+            response = self.downloader.fetch_if_modified(
+                url, archive_path,
+                etag=previous.get('etag'),
+                last_modified=previous.get('last_modified'))
+            if response is None:
+                if self.args.verbose:
+                    print "%s has not been modified" % url
+                return
+            with ZipFile(archive_path) as zipfile:
+                zipfile.extract(expected_filename, t)
+            extracted_file_path = os.path.join(t, expected_filename)
+            digest = self.sha256(extracted_file_path)
+            snapshot = self.most_recent_snapshot(dest, expected_filename)
+            most_recent = self.most_recent_digest(previous, snapshot)
+            if digest != most_recent:
+                new_folder = datetime.datetime.today().strftime("%Y_%m")
+                new_path = "%s/%s/" % (dest, new_folder)
+                self.mkdir_p(new_path)
+                if self.args.verbose:
+                    print "%s has changed; creating new copy in %s" % (
+                        url, new_path)
+                new_file = os.path.join(new_path, expected_filename)
+                # Copy then rename, rather than overwriting a snapshot
+                # fetched earlier this month, which may be linked to
+                # earlier months' snapshots by `runner.py dedup`
+                partial = partial_path(new_file)
+                shutil.copyfile(extracted_file_path, partial)
+                os.rename(partial, new_file)
+                self.record_file(new_file)
+                # Deltas are always against an earlier month, as a
+                # snapshot fetched earlier this month has gone
+                previous_snapshot = self.most_recent_snapshot(
+                    dest, expected_filename, before=new_folder)
+                if key_column is not None and previous_snapshot:
+                    self.write_deltas(
+                        previous_snapshot, new_file, key_column)
+                else:
+                    self.remove_deltas(new_file)
+            state[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'sha256': digest}
+            self.save_state(dest, state)
+        finally:
+            shutil.rmtree(t)
+
+    def most_recent_snapshot(self, dest, filename, before=None):
+        """Return the path of the most recent snapshot of `filename`, or
+        of the most recent in a month directory before `before`
+        """
+        snapshots = sorted(glob.glob("%s/*/%s" % (dest, filename)))
+        if before:
+            snapshots = [
+                path for path in snapshots
+                if os.path.basename(os.path.dirname(path)) < before]
+        return snapshots[-1] if snapshots else None
+
+    def most_recent_digest(self, previous, snapshot):
+        if 'sha256' in previous:
+            return previous['sha256']
+        if snapshot:
+            return self.sha256(snapshot)
+        return None
+
+    def write_deltas(self, old_file, new_file, key_column):
+        summary = diff_snapshots(old_file, new_file, key_column=key_column)
+        paths = delta_paths(new_file)
+        for kind in DELTA_KINDS + ['summary']:
+            self.record_file(paths[kind])
+        print "%s: %s added, %s changed, %s removed since %s" % (
+            new_file, summary['added'], summary['changed'],
+            summary['removed'], old_file)
+
+    def remove_deltas(self, new_file):
+        """Remove any deltas left alongside `new_file` from an earlier
+        version of it, which they no longer describe
+        """
+        for path in delta_paths(new_file).values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_state(self, dest):
+        try:
+            with open(os.path.join(dest, STATE_FILE), 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def save_state(self, dest, state):
+        self.mkdir_p(dest)
+        with open(os.path.join(dest, STATE_FILE), 'wb') as f:
+            json.dump(state, f, indent=2, separators=(',', ': '))
 
 if __name__ == '__main__':
     Command().handle()
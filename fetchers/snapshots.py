@@ -0,0 +1,132 @@
+"""Row-level differences between successive snapshots of a CSV.
+
+Rows are matched on a key column. Both snapshots are first split into
+partitions by a hash of the key, sized so that one partition of the
+old snapshot fits comfortably in memory; each pair of partitions is
+then joined in turn. Small files are joined in a single partition
+without the split.
+
+"""
+import csv
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+# Approximate number of bytes of the old snapshot to hold in memory
+PARTITION_BYTES = 64 * 1024 * 1024
+DELTA_KINDS = ['added', 'changed', 'removed']
+
+
+def delta_paths(path):
+    """Return a dict of the paths of the delta files for the snapshot at
+    `path`, by kind, plus the summary under 'summary'
+    """
+    stem, ext = os.path.splitext(path)
+    paths = dict(
+        (kind, "%s_%s%s" % (stem, kind, ext)) for kind in DELTA_KINDS)
+    paths['summary'] = "%s_delta.json" % stem
+    return paths
+
+
+def diff_snapshots(old_path, new_path, key_column=0,
+                   partition_bytes=PARTITION_BYTES):
+    """Write the rows added, changed and removed between `old_path` and
+    `new_path` to files alongside `new_path`, with a JSON summary of
+    the counts.
+
+    Added and changed rows are as they are in the new snapshot; removed
+    rows as they were in the old one. Returns the summary.
+
+    """
+    paths = delta_paths(new_path)
+    counts = dict((kind, 0) for kind in DELTA_KINDS + ['unchanged'])
+    partitions = max(1, os.path.getsize(old_path) // partition_bytes + 1)
+    outputs = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for kind in DELTA_KINDS:
+            outputs[kind] = open(paths[kind] + '.part', 'wb')
+        if partitions == 1:
+            pairs = [(old_path, new_path)]
+        else:
+            old_parts = partition(old_path, tmp_dir, 'old', partitions,
+                                  key_column)
+            new_parts = partition(new_path, tmp_dir, 'new', partitions,
+                                  key_column)
+            pairs = zip(old_parts, new_parts)
+        for old_part, new_part in pairs:
+            join(old_part, new_part, key_column, outputs, counts)
+    except BaseException:
+        for output in outputs.values():
+            output.close()
+            os.remove(output.name)
+        raise
+    finally:
+        for output in outputs.values():
+            output.close()
+        shutil.rmtree(tmp_dir)
+    for kind in DELTA_KINDS:
+        os.rename(paths[kind] + '.part', paths[kind])
+    summary = dict(counts)
+    summary['previous'] = os.path.relpath(
+        old_path, os.path.dirname(new_path))
+    with open(paths['summary'], 'wb') as f:
+        json.dump(summary, f, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+    return summary
+
+
+def lines(path):
+    """Yield the non-blank lines of `path`, each ending in a newline
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith('\n'):
+                line += '\n'
+            yield line
+
+
+def row_key(line, key_column):
+    return next(csv.reader([line]))[key_column]
+
+
+def partition(path, tmp_dir, prefix, partitions, key_column):
+    """Split the lines of `path` into `partitions` files by hash of
+    their key, returning the paths of the files
+    """
+    part_paths = [os.path.join(tmp_dir, "%s_%s.csv" % (prefix, i))
+                  for i in range(partitions)]
+    parts = [open(p, 'wb') for p in part_paths]
+    try:
+        for line in lines(path):
+            key = row_key(line, key_column)
+            parts[(zlib.crc32(key) & 0xffffffff) % partitions].write(line)
+    finally:
+        for part in parts:
+            part.close()
+    return part_paths
+
+
+def join(old_path, new_path, key_column, outputs, counts):
+    """Compare rows with the same key in `old_path` and `new_path`,
+    which should be small enough to hold `old_path` in memory
+    """
+    old = dict((row_key(line, key_column), line) for line in lines(old_path))
+    for line in lines(new_path):
+        previous = old.pop(row_key(line, key_column), None)
+        if previous is None:
+            kind = 'added'
+        elif previous.rstrip('\r\n') != line.rstrip('\r\n'):
+            kind = 'changed'
+        else:
+            counts['unchanged'] += 1
+            continue
+        outputs[kind].write(line)
+        counts[kind] += 1
+    for line in old.values():
+        outputs['removed'].write(line)
+        counts['removed'] += 1
@@ -1,35 +1,59 @@
 import json
 import subprocess
 import shlex
-import networkx as nx
 import re
 import glob
+import collections
 import datetime
+import importlib
 import UserDict
 import textwrap
+import threading
 import argparse
 import pipes
 import os
 import errno
-
-from apiclient.errors import HttpError
-from retrying import retry
+import fcntl
+import functools
+import time
+from multiprocessing.pool import ThreadPool
 
 from utils.cloud import CloudHandler
-from ebmdatalab import bigquery
-
+from utils import bundles
+from utils import checksums
+from utils import prescribing
+from utils import validate
+from utils.plan import ManifestError, load_plan
+from utils.workqueue import (
+    Heartbeat, LeaseLost, QueueError, WorkQueue, worker_id)
+
+# Heavy dependencies (apiclient, retrying, ebmdatalab) are
+# imported where they're used, so that commands which don't need them
+# start quickly; likewise environment variables are only looked up by
+# commands that use them.
 
-OPENP_PYTHON = os.environ['OPENP_PYTHON']
-OPENP_DATA_PYTHON = os.environ['OPENP_DATA_PYTHON']
-OPENP_DATA_BASEDIR = os.environ['OPENP_DATA_BASEDIR']
-OPENP_FRONTEND_APP_BASEDIR = os.environ['OPENP_FRONTEND_APP_BASEDIR']
-
-FILENAME_FLAGS = [
-    'filename', 'ccg', 'epraccur', 'chem_file', 'hscic_address',
-    'month_from_prescribing_filename']
 # Number of bytes to send/receive in each request.
 CHUNKSIZE = 2 * 1024 * 1024
 DEFAULT_MIMETYPE = 'application/octet-stream'
+# Number of fetchers to run at once
+FETCHER_WORKERS = 4
+# Number of files `getdata` downloads at once
+DOWNLOAD_WORKERS = 4
+# Number of tables `bigquery_upload` loads into BigQuery at once
+BIGQUERY_LOAD_WORKERS = 3
+DETAILED_PRESCRIBING_REGEX = r'Detailed_Prescribing_Information\.csv$'
+# Sources found dirty by an importer run that hasn't finished
+DIRTY_FILE = 'dirty.json'
+# Steps queued by `enqueue` for `work` to run
+QUEUE_FILE = 'workqueue.sqlite'
+# Seconds a worker waits before looking again for a ready step
+POLL_SECONDS = 10
+
+FetcherResult = collections.namedtuple(
+    'FetcherResult',
+    ['source', 'command', 'files', 'bytes', 'duration', 'error'])
+LoadResult = collections.namedtuple(
+    'LoadResult', ['table', 'duration', 'error'])
 
 
 def mkdir_p(path):
@@ -42,11 +66,38 @@ def mkdir_p(path):
             raise
 
 
+def env(name):
+    """Return the value of the environment variable `name`, which must
+    be set
+    """
+    try:
+        return os.environ[name]
+    except KeyError:
+        raise ConfigError("The %s environment variable must be set" % name)
+
+
+def retry(**retry_kwargs):
+    """Like `retrying.retry`, but only imports `retrying` when the
+    decorated function is first called
+    """
+    def decorator(func):
+        retrying_func = []
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not retrying_func:
+                from retrying import retry
+                retrying_func.append(retry(**retry_kwargs)(func))
+            return retrying_func[0](*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def retry_if_key_error(ex):
     return isinstance(ex, KeyError)
 
 
-class ManifestError(StandardError):
+class ConfigError(StandardError):
     pass
 
 
@@ -57,15 +108,18 @@ class LogError(StandardError):
 class Source(UserDict.UserDict):
     """Adds business logic to a row of data in `manifest.json`
     """
-    def __init__(self, source):
+    def __init__(self, source, plan):
         UserDict.UserDict.__init__(self)
         self.data = source
+        self.plan = plan
 
     def imported_file_records(self, file_regex):
         """Return an list of import records for all imported data for this
         source, whose path matches file_regex.
         """
         with open('log.json', 'r') as f:
+            # Other runner processes may be writing it
+            fcntl.lockf(f, fcntl.LOCK_SH)
             log = json.load(f)
 
         import_records = log.get(self['id'], [])
@@ -73,8 +127,9 @@ class Source(UserDict.UserDict):
             if any(not record['imported_file'] for record in import_records):
                 raise LogError("No filename found for %s in %s" % (
                     self['id'], import_records))
+            regex = self.plan.regex(file_regex)
             matched_records = filter(
-                lambda record: re.findall(file_regex, record['imported_file']),
+                lambda record: regex.search(record['imported_file']),
                 import_records)
             if matched_records:
                 return sorted(
@@ -97,6 +152,9 @@ class Source(UserDict.UserDict):
         """
         now = datetime.datetime.now().replace(microsecond=0).isoformat()
         with open('log.json', 'r+') as f:
+            # Hold the lock from reading to writing, so that records
+            # written meanwhile by other runner processes aren't lost
+            fcntl.lockf(f, fcntl.LOCK_EX)
             try:
                 log = json.load(f)
             except ValueError:
@@ -108,28 +166,16 @@ class Source(UserDict.UserDict):
                  'imported_at': now})
             f.seek(0)
             f.write(json.dumps(log, indent=2, separators=(',', ': ')))
+            f.truncate()
 
     def filename_arg(self, cmd_string):
         """Extract the argument supplied to `--filename` flag (or similar).
 
         Possible flags indicating a filename are defined in the
-        FILENAME_FLAGS constant.
+        FILENAME_FLAGS constant in `utils.plan`.
 
         """
-        # We quote before splitting, to preserve regex backslashes
-        # specified in the JSON
-        cmd_parts = shlex.split(cmd_string.encode('unicode-escape'))
-        filename_idx = None
-        for flag in FILENAME_FLAGS:
-            try:
-                filename_idx = cmd_parts.index("--%s" % flag) + 1
-            except ValueError:
-                pass
-        if not filename_idx:
-            raise ManifestError(
-                "Couldn't find a filename argument in %s"
-                % cmd_string)
-        return cmd_parts[filename_idx]
+        return self.plan.filename_arg(cmd_string)
 
     def files_by_date(self, importer):
         """Return list of of paths to files for importer ordered by date,
@@ -139,11 +185,10 @@ class Source(UserDict.UserDict):
         else:
             file_regex = '.*'
         data_location = os.path.join(
-            OPENP_DATA_BASEDIR, self.get('data_dir', self['id']))
+            env('OPENP_DATA_BASEDIR'), self.get('data_dir', self['id']))
         files = glob.glob("%s/*/*" % data_location)
-        candidates = filter(
-            lambda x: re.findall(file_regex, x),
-            files)
+        regex = self.plan.regex(file_regex)
+        candidates = filter(regex.search, files)
         return sorted(candidates)
 
     def unimported_files(self, importer):
@@ -168,6 +213,21 @@ class Source(UserDict.UserDict):
                 selected.append(path)
         return selected
 
+    def has_files_since_last_import(self):
+        """Return True if any of this source's data files are newer
+        than its most recent import
+        """
+        records = self.imported_file_records('.*')
+        files = self.files_by_date(None)
+        if not records:
+            return bool(files)
+        last_imported_at = max(r['imported_at'] for r in records)
+        # Import times are recorded to the second
+        return any(
+            datetime.datetime.fromtimestamp(
+                int(os.path.getmtime(path))).isoformat() > last_imported_at
+            for path in files)
+
     def most_recent_file_record(self, importer):
         """Return the most recently generated data file for the specified
         importer.
@@ -204,12 +264,12 @@ class Source(UserDict.UserDict):
 class ManifestReader(object):
     def __init__(self):
         super(ManifestReader, self).__init__()
-        with open('manifest.json') as f:
-            self.sources = map(lambda x: Source(x), json.load(f))
-            self.sources_with_fetchers = filter(
-                lambda x: 'fetcher' in x, self.sources)
-            self.sources_without_fetchers = filter(
-                lambda x: 'fetcher' not in x, self.sources)
+        self.plan = load_plan()
+        self.sources = map(lambda x: Source(x, self.plan), self.plan.sources)
+        self.sources_with_fetchers = filter(
+            lambda x: 'fetcher' in x, self.sources)
+        self.sources_without_fetchers = filter(
+            lambda x: 'fetcher' not in x, self.sources)
 
     def source_by_id(self, key):
         return next(x for x in self.sources
@@ -218,16 +278,24 @@ class ManifestReader(object):
     def sources_ordered_by_dependency(self):
         """Produce a list of sources, ordered by dependency graph
         """
-        graph = nx.DiGraph()
+        by_id = dict((source['id'], source) for source in self.sources)
+        return [by_id[source_id] for source_id in self.plan.order]
+
+    def check_hooks(self):
+        """Raise ManifestError if any `runner:` step names a function
+        this module doesn't have
+        """
+        unknown = []
         for source in self.sources:
-            graph.add_node(source['id'])
-            for parent in source.get('depends_on', []):
-                graph.add_node(parent)
-                graph.add_edge(parent, source['id'])
-        resolved_order = nx.topological_sort(graph)
-        return sorted(
-            self.sources,
-            key=lambda s: resolved_order.index(s['id']))
+            for cmd in (source.get('before_import', []) +
+                        source.get('importers', []) +
+                        source.get('after_import', [])):
+                if cmd.startswith('runner:') and \
+                        not callable(globals().get(cmd[len('runner:'):])):
+                    unknown.append("%s (in %s)" % (cmd, source['id']))
+        if unknown:
+            raise ManifestError(
+                "Unknown runner steps: %s" % ", ".join(unknown))
 
 
 class SmokeTestHandler(ManifestReader, CloudHandler):
@@ -245,7 +313,7 @@ class SmokeTestHandler(ManifestReader, CloudHandler):
         date = self.last_imported()
         my_env = os.environ.copy()
         my_env['LAST_IMPORTED'] = date
-        command = "%s smoketests/smoke.py" % OPENP_DATA_PYTHON
+        command = "%s smoketests/smoke.py" % env('OPENP_DATA_PYTHON')
         print "Running %s with LAST_IMPORTED=%s" % (command, date)
         subprocess.check_call(shlex.split(command), env=my_env)
 
@@ -259,10 +327,41 @@ class SmokeTestHandler(ManifestReader, CloudHandler):
                 dict_row[key] = value
             yield dict_row
 
-    def update_smoketests(self):
-        prescribing_date = "-".join(self.last_imported().split('_')) + '-01'
+    def update_smoketests(self, offline=False):
+        """Regenerate the expected results of the smoketests, from
+        BigQuery or, if `offline`, from local data
+        """
+        last_imported = self.last_imported()
+        prescribing_date = "-".join(last_imported.split('_')) + '-01'
         date_condition = ('month > TIMESTAMP(DATE_SUB(DATE "%s", '
                           'INTERVAL 5 YEAR))' % prescribing_date)
+        if offline:
+            from utils.columns import ColumnCache
+            from utils.query import QueryEngine, QueryError, parse_smoketest
+            # Check every query can be answered locally before
+            # rewriting any expectations
+            filters = {}
+            for sql_file in glob.glob('smoketests/*sql'):
+                with open(sql_file, 'rb') as f:
+                    filters[sql_file] = parse_smoketest(f.read())
+            basedir = env('OPENP_DATA_BASEDIR')
+            cache = ColumnCache(basedir)
+            cache.update(verbose=True)
+            engine = QueryEngine(basedir)
+            year, month = last_imported.split('_')
+            since = "%s_%s" % (int(year) - 5, month)
+            # A month missing locally would just be left out of the
+            # results, so make sure we have all of them
+            expected = []
+            year, month = int(year) - 5, int(month)
+            while "%04d_%02d" % (year, month) < last_imported:
+                year, month = divmod(year * 12 + month, 12)
+                month += 1
+                expected.append("%04d_%02d" % (year, month))
+            missing = sorted(set(expected) - set(cache.months()))
+            if missing:
+                raise QueryError(
+                    "No local prescribing data for %s" % ", ".join(missing))
 
         for sql_file in glob.glob('smoketests/*sql'):
             test_name = os.path.splitext(
@@ -271,15 +370,27 @@ class SmokeTestHandler(ManifestReader, CloudHandler):
                 query = f.read().replace(
                     '{{ date_condition }}', date_condition)
                 print query
-                response = self.bigquery.jobs().query(
-                    projectId='ebmdatalab',
-                    body={'useLegacySql': False,
-                          'timeoutMs': 20000,
-                          'query': query}).execute()
+                if offline:
+                    # The engine applies the date condition itself, as
+                    # `since` and `until`
+                    rows = [
+                        {'quantity': str(r['quantity']),
+                         'actual_cost': "%.2f" % round(r['actual_cost'], 2),
+                         'items': str(r['items'])}
+                        for r in engine.aggregate(
+                            since=since, until=last_imported,
+                            **filters[sql_file])]
+                else:
+                    response = self.bigquery.jobs().query(
+                        projectId='ebmdatalab',
+                        body={'useLegacySql': False,
+                              'timeoutMs': 20000,
+                              'query': query}).execute()
+                    rows = self.rows_to_dict(response)
                 quantity = []
                 cost = []
                 items = []
-                for r in self.rows_to_dict(response):
+                for r in rows:
                     quantity.append(r['quantity'])
                     cost.append(r['actual_cost'])
                     items.append(r['items'])
@@ -292,45 +403,210 @@ class SmokeTestHandler(ManifestReader, CloudHandler):
 
 
 class BigQueryDownloader(ManifestReader, CloudHandler):
-    def download_all(self):
+    def download_all(self, max_workers=DOWNLOAD_WORKERS, bundled=False):
+        """Download the most recent file in storage for each importer,
+        unless it's already here, `max_workers` at a time.
+
+        Each source's files in storage are listed once, and matched
+        against all its importers. With `bundled`, files are restored
+        from the bundles `archivedata --bundled` makes, reading just
+        the bytes of each file needed. Raises an exception listing the
+        downloads that failed, if any, once the rest have finished.
+
+        """
         bucket = 'ebmdatalab'
-        for source in self.sources:
-            base_name = 'hscic/%s' % source['id']
-            for importer in source.get('importers', []):
-                filename_regex = source.filename_arg(importer)
-                try:
-                    most_recent = self.list_raw_datasets(
-                        bucket, prefix=base_name,
-                        name_regex=filename_regex)[-1]
-                except IndexError:
-                    print "No file in Cloud at %s matching %s" % (
-                        base_name, filename_regex)
-                    continue
-                target_file = os.path.join(
-                    OPENP_DATA_BASEDIR,
-                    most_recent.replace('hscic/', ''))
-                target_dir = os.path.split(target_file)[0]
-                if os.path.exists(target_file):
-                    continue
-                else:
-                    print "Downloading %s to %s" % (most_recent, target_file)
-                    mkdir_p(target_dir)
-                    self.download(target_file, bucket, most_recent)
+        basedir = env('OPENP_DATA_BASEDIR')
+        sources = [source for source in self.sources if any(
+            not importer.startswith('runner:')
+            for importer in source.get('importers', []))]
+        pool = ThreadPool(max_workers)
+        try:
+            listings = pool.map_async(
+                lambda source: self.list_raw_datasets(
+                    bucket, prefix='hscic/%s/' % source['id']),
+                sources).get(2 ** 31)
+            downloads = {}
+            indexes = {}
+            for source, names in zip(sources, listings):
+                # By month, as a month that's bundled again is newer
+                # in the listing than the months after it
+                index_names = sorted(
+                    (name for name in names
+                     if name.endswith('/' + bundles.INDEX_NAME)),
+                    key=os.path.dirname)
+                for importer in source['importers']:
+                    if importer.startswith('runner:'):
+                        continue
+                    filename_regex = source.filename_arg(importer)
+                    regex = self.plan.regex(filename_regex)
+                    if bundled:
+                        found = self.find_in_bundles(
+                            bucket, index_names, indexes, regex)
+                    else:
+                        found = filter(regex.search, names)[-1:]
+                    if not found:
+                        print "No file in Cloud at hscic/%s matching %s" % (
+                            source['id'], filename_regex)
+                        continue
+                    if bundled:
+                        most_recent, bundle_name, member = found
+                        fetch = functools.partial(
+                            self.restore_member, bucket, bundle_name,
+                            member)
+                    else:
+                        most_recent = found[0]
+                        fetch = functools.partial(
+                            self.download, bucket_name=bucket,
+                            object_name=most_recent)
+                    target_file = os.path.join(
+                        basedir, most_recent.replace('hscic/', ''))
+                    if not os.path.exists(target_file):
+                        downloads[target_file] = (most_recent, fetch)
+            targets = sorted(downloads)
+            errors = pool.map_async(
+                lambda target: self.download_one(
+                    target, *downloads[target]),
+                targets).get(2 ** 31)
+        finally:
+            pool.terminate()
+        # Record what was downloaded, so importers can tell if it has
+        # changed since
+        checksums.record([
+            target for target, error in zip(targets, errors) if not error])
+        errors = filter(None, errors)
+        if errors:
+            raise StandardError(
+                "Downloads failed: %s" % ", ".join(errors))
+
+    def find_in_bundles(self, bucket, index_names, indexes, regex):
+        """Return the name, bundle and index entry of the most recent
+        bundled file whose name matches `regex`, or None.
+
+        `index_names` are the source's bundle indexes, oldest month
+        first; they are only fetched, into the cache `indexes`, until a
+        match is found.
+
+        """
+        for index_name in reversed(index_names):
+            if index_name not in indexes:
+                indexes[index_name] = json.loads(
+                    self.read(bucket, index_name))
+            directory = os.path.dirname(index_name)
+            matches = [
+                member for member in indexes[index_name]['members']
+                if regex.search("%s/%s" % (directory, member['name']))]
+            if matches:
+                return ("%s/%s" % (directory, matches[-1]['name']),
+                        "%s/%s" % (directory, bundles.BUNDLE_NAME),
+                        matches[-1])
+
+    def restore_member(self, bucket, bundle_name, member, target_file):
+        stream = self.open_range(
+            bucket, bundle_name, member['offset'], member['length'])
+        bundles.extract_member(stream, member, target_file)
+
+    def download_one(self, target_file, name, fetch):
+        """Fetch `name` to `target_file` with `fetch`, returning an
+        error message if it fails
+        """
+        print "Downloading %s to %s" % (name, target_file)
+        try:
+            mkdir_p(os.path.dirname(target_file))
+            fetch(target_file)
+        except Exception as e:
+            return "%s (%s: %s)" % (name, e.__class__.__name__, e)
 
 
 class BigQueryUploader(ManifestReader, CloudHandler):
-    def upload_all_to_storage(self):
-        bucket = 'ebmdatalab'
+    def upload_all_to_storage(self, bundled=False):
+        """Upload every importable data file not already in storage;
+        with `bundled`, as a bundle for each source and month
+        """
+        if bundled:
+            return self.upload_bundles()
         for source in self.sources:
             for importer in source.get('importers', []):
                 for path in source.files_by_date(importer):
-                    name = 'hscic' + path.replace(OPENP_DATA_BASEDIR, '')
-                    if self.dataset_exists(bucket, name):
-                        print "Skipping %s, already uploaded" % name
-                        continue
-                    print "Uploading %s to %s" % (path, name)
-                    self.upload(path, bucket, name)
+                    self.upload_to_storage(path)
 
+    def upload_to_storage(self, path, bucket='ebmdatalab'):
+        """Validate and upload the data file at `path`, unless it's
+        already in storage
+        """
+        name = 'hscic' + path.replace(env('OPENP_DATA_BASEDIR'), '')
+        if self.dataset_exists(bucket, name):
+            print "Skipping %s, already uploaded" % name
+            return
+        self.validate(path)
+        print "Uploading %s to %s" % (path, name)
+        self.upload(path, bucket, name)
+
+    def validate(self, path):
+        schema = validate.schema_for(path)
+        if schema:
+            print "Validating %s against %s" % (path, schema)
+            validate.validate(path, schema)
+
+    def upload_bundles(self, bucket='ebmdatalab'):
+        """Upload a bundle of each month directory's importable data
+        files, with its index, unless storage already has a bundle of
+        just those files as they are now.
+
+        A month whose files have changed since it was bundled, or which
+        has new ones, is bundled again. The bundle is compressed as it's
+        uploaded, and the index uploaded after it; a restore that reads
+        an old index alongside a new bundle fails its checksums rather
+        than restoring the wrong data.
+
+        """
+        basedir = env('OPENP_DATA_BASEDIR')
+        for source in self.sources:
+            by_directory = collections.defaultdict(set)
+            for importer in source.get('importers', []):
+                for path in source.files_by_date(importer):
+                    by_directory[os.path.dirname(path)].add(path)
+            for directory, paths in sorted(by_directory.items()):
+                paths = sorted(paths)
+                # Compare files as they were when they were fetched,
+                # and don't archive any that have changed since
+                failures = checksums.check(paths)
+                if failures:
+                    raise checksums.ChecksumError(failures)
+                prefix = 'hscic' + directory.replace(basedir, '')
+                index_name = "%s/%s" % (prefix, bundles.INDEX_NAME)
+                if self.bundle_is_current(
+                        bucket, index_name, directory, paths):
+                    print "Skipping %s, already uploaded" % prefix
+                    continue
+                for path in paths:
+                    self.validate(path)
+                print "Bundling %s files in %s" % (len(paths), directory)
+                index = {}
+                self.upload_stream(
+                    bundles.iter_bundle(paths, index), bucket,
+                    "%s/%s" % (prefix, bundles.BUNDLE_NAME),
+                    'application/gzip')
+                self.upload_stream(
+                    [json.dumps(index, indent=2, separators=(',', ': '))],
+                    bucket, index_name, 'application/json')
+
+    def bundle_is_current(self, bucket, index_name, directory, paths):
+        """Return True if the bundle with the index `index_name` in
+        storage holds exactly the files at `paths` in `directory`, as
+        their checksums are recorded
+        """
+        if not self.dataset_exists(bucket, index_name):
+            return False
+        records = checksums.load_manifest(directory)
+        local = {}
+        for path in paths:
+            name = os.path.basename(path)
+            local[name] = (records[name]['size'], records[name]['sha256'])
+        index = json.loads(self.read(bucket, index_name))
+        bundled = dict(
+            (member['name'], (member['size'], member['sha256']))
+            for member in index['members'])
+        return bundled == local
 
     @retry(retry_on_exception=retry_if_key_error, stop_max_attempt_number=3)
     def _count_imported_data_for_filename(self, filename,
@@ -342,6 +618,7 @@ class BigQueryUploader(ManifestReader, CloudHandler):
         Retries because bigquery is unreliable.
 
         """
+        from apiclient.errors import HttpError
         match = re.match(r'.*T(\d{6})PDPI', filename)
         date = match.groups()[0]
         year = date[:4]
@@ -387,7 +664,7 @@ class FetcherRunner(ManifestReader):
                 continue
             for importer in source.get('importers', [None]):
                 expected_location = "%s/%s/%s" % (
-                    OPENP_DATA_BASEDIR, source['id'], year_and_month)
+                    env('OPENP_DATA_BASEDIR'), source['id'], year_and_month)
                 print
                 print "You should now locate latest data for %s, if available" % source['id']
                 print "You should save it at:"
@@ -410,14 +687,50 @@ class FetcherRunner(ManifestReader):
                 print "    %s" % \
                     source.most_recent_file_record(importer)
                 raw_input("Press return when done, or to skip this step")
+                # Record the checksums of any new files, as they were
+                # saved
+                failures = checksums.check(
+                    filter(os.path.isfile, glob.glob(
+                        os.path.join(expected_location, '*'))))
+                if failures:
+                    print checksums.ChecksumError(failures)
+                    print "If these changes are deliberate, run " \
+                        "`python runner.py checksums --update`"
+
+    def run_all_fetchers(self, max_workers=FETCHER_WORKERS, timeout=None):
+        """Run every fetcher defined in the manifest, `max_workers` at a
+        time, in this process.
+
+        A fetcher still running after `timeout` seconds is cancelled.
+        Returns a list of FetcherResults; raises an exception after
+        they have all finished if any failed.
 
-    def run_all_fetchers(self):
-        """Run every fetcher defined in the manifest
         """
-        for source in self.sources_with_fetchers:
-            command = "%s fetchers/%s" % (OPENP_DATA_PYTHON, source['fetcher'])
-            print "Running %s" % command
-            subprocess.check_call(shlex.split(command))
+        pool = ThreadPool(max_workers)
+        try:
+            results = pool.map_async(
+                lambda source: run_fetcher(source, timeout),
+                self.sources_with_fetchers).get(2 ** 31)
+        finally:
+            pool.terminate()
+        # Record what was fetched, so importers can tell if it has
+        # changed since
+        checksums.record(
+            [path for result in results for path in result.files])
+        print
+        print "%-25s %8s %12s %10s  %s" % (
+            'Source', 'Files', 'Bytes', 'Seconds', 'Error')
+        for result in results:
+            print "%-25s %8s %12s %10.1f  %s" % (
+                result.source, len(result.files), result.bytes,
+                result.duration, result.error or '')
+        failed = [result for result in results if result.error]
+        if failed:
+            raise StandardError(
+                "Fetchers failed: %s" % ", ".join(
+                    "`%s` (%s)" % (result.command, result.error)
+                    for result in failed))
+        return results
 
 
 class ImporterRunner(ManifestReader):
@@ -433,57 +746,250 @@ class ImporterRunner(ManifestReader):
                 most_recent = source.most_recent_file_record(importer)['imported_file']
                 source.set_last_imported_filename(most_recent)
 
-    def run_all_importers(self, paranoid=False):
+    def run_all_importers(self, paranoid=False, force=False):
         """Run each importer sequentially.
 
-        On success, logs each one as imported
+        On success, logs each one as imported.
+
+        A source is dirty if its importers consumed files they hadn't
+        imported before, or if a source it depends on is dirty. Its
+        `before_import` steps are skipped unless something upstream is
+        dirty or it has files newer than its last import, and its
+        `after_import` steps are skipped unless it is dirty. With
+        `force`, everything is treated as dirty.
+
+        Dirty sources are recorded in DIRTY_FILE until the run
+        finishes, so that if it fails part way, the next run still
+        brings everything downstream of them up to date.
+
         """
+        self.check_hooks()
+        dirty = load_dirty()
         for source in self.sources_ordered_by_dependency():
+            upstream_dirty = force or source['id'] in dirty or any(
+                parent in dirty for parent in source.get('depends_on', []))
             if 'before_import' in source:
-                for cmd in source['before_import']:
-                    print "Running before_import step %s" % cmd
-                    if paranoid:
-                        if raw_input("Continue? [y/n]").lower() != 'y':
-                            print "  Skipping...."
+                if upstream_dirty or (source.get('importers') and
+                                      source.has_files_since_last_import()):
+                    self.run_hooks(source, 'before_import', paranoid)
+                else:
+                    print "Skipping before_import steps for %s; " \
+                        "nothing new" % source['id']
+
+            previously_imported = set(
+                record['imported_file']
+                for record in source.imported_file_records('.*'))
+            imported_new = False
+            for cmd in source.importer_cmds_with_latest_data():
+                print "Importing %s with command: `%s`" % (
+                    source['id'], cmd)
+                run_cmd = management_command(cmd, run=False)
+                input_file = source.filename_arg(run_cmd)
+                if paranoid:
+                    if raw_input("Continue? [y/n]").lower() != 'y':
+                        print "  Skipping...."
+                        if raw_input("Skip permanently? [y/n]").lower() == 'y':
+                            print "  Skipping permanently...."
+                            source.set_last_imported_filename(input_file)
                             continue
-                    if cmd.startswith('runner:'):
-                        cmd = cmd[len('runner:'):]
-                        globals()[cmd]()  # runs the named method
-                    else:
-                        management_command(cmd)
-
-            # XXX special case prescribing source to run twice. This
-            # is because the first time, the formatted version of the
-            # file has not been generated. This needs to be fixed to
-            # be more elegant, e.g. by moving the conversion to a
-            # pre-import step
-            for attempt in range(2):
+                        else:
+                            continue
+                # Refuse files changed since they were first seen
+                checksums.verify([input_file])
+                run_cmd = management_command(cmd)
+                source.set_last_imported_filename(input_file)
+                if input_file not in previously_imported:
+                    imported_new = True
+            if (upstream_dirty or imported_new) and source['id'] not in dirty:
+                dirty.add(source['id'])
+                save_dirty(dirty)
+            if 'after_import' in source:
+                if source['id'] in dirty:
+                    self.run_hooks(source, 'after_import', paranoid)
+                else:
+                    print "Skipping after_import steps for %s; " \
+                        "nothing new" % source['id']
+        save_dirty(set())
+
+    def run_hooks(self, source, hook, paranoid=False):
+        for cmd in source[hook]:
+            print "Running %s step %s" % (hook, cmd)
+            if paranoid:
+                if raw_input("Continue? [y/n]").lower() != 'y':
+                    print "  Skipping...."
+                    continue
+            run_step_command(cmd)
+
+    def enqueue_all(self, queue, force=False, archive=False):
+        """Add the steps `run_all_importers` would run to `queue`, which
+        must have nothing left to do, returning the number added.
+
+        Each source's steps run in order, after the last steps of the
+        sources it depends on. Which steps are needed is decided now,
+        as `run_all_importers` would; the files a source's importers
+        will read are too, unless its `before_import` steps are queued
+        and may make new ones, in which case a single step imports
+        whatever is new when it runs. With `archive`, uploads of every
+        data file to storage are queued too.
+
+        """
+        self.check_hooks()
+        queue.reset()
+        dirty = load_dirty()
+        tails = {}
+        added = 0
+        for source in self.sources_ordered_by_dependency():
+            parents = set()
+            for parent in source.get('depends_on', []):
+                parents.update(tails[parent])
+            steps = []
+            upstream_dirty = force or source['id'] in dirty or any(
+                parent in dirty for parent in source.get('depends_on', []))
+            hooks_queued = False
+            if 'before_import' in source and (
+                    upstream_dirty or (source.get('importers') and
+                                       source.has_files_since_last_import())):
+                steps.extend(('before_import', cmd, None)
+                             for cmd in source['before_import'])
+                hooks_queued = True
+            if hooks_queued and source.get('importers'):
+                steps.append(('importers', '; '.join(source['importers']),
+                              None))
+                upstream_dirty = True
+            else:
+                previously_imported = set(
+                    record['imported_file']
+                    for record in source.imported_file_records('.*'))
                 for cmd in source.importer_cmds_with_latest_data():
-                    print "Importing %s with command: `%s`" % (
-                        source['id'], cmd)
-                    run_cmd = management_command(cmd, run=False)
-                    input_file = source.filename_arg(run_cmd)
-                    if paranoid:
-                        if raw_input("Continue? [y/n]").lower() != 'y':
-                            print "  Skipping...."
-                            if raw_input("Skip permanently? [y/n]").lower() == 'y':
-                                print "  Skipping permanently...."
-                                source.set_last_imported_filename(input_file)
-                                continue
-                            else:
-                                continue
-                    run_cmd = management_command(cmd)
-                    source.set_last_imported_filename(input_file)
-                if source['id'] != 'prescribing':
+                    input_file = None
+                    if not cmd.startswith('runner:'):
+                        input_file = source.filename_arg(
+                            management_command(cmd, run=False))
+                        if input_file not in previously_imported:
+                            upstream_dirty = True
+                    steps.append(('import', cmd, input_file))
+            if upstream_dirty:
+                dirty.add(source['id'])
+                steps.extend(('after_import', cmd, None)
+                             for cmd in source.get('after_import', []))
+            for kind, cmd, input_file in steps:
+                parents = [queue.add(source['id'], kind, cmd, input_file,
+                                     depends_on=parents)]
+                added += 1
+            tails[source['id']] = parents
+            if archive:
+                for importer in source.get('importers', []):
+                    if importer.startswith('runner:'):
+                        continue
+                    for path in source.files_by_date(importer):
+                        queue.add(source['id'], 'upload', path, path)
+                        added += 1
+        # The queue now remembers what needs doing
+        save_dirty(set())
+        return added
+
+    def run_step(self, step, heartbeat=None):
+        """Run a Step claimed from the work queue, stopping before it
+        records anything if `heartbeat` says its lease has been lost
+        """
+        source = self.source_by_id(step.source)
+        if step.kind == 'upload':
+            BigQueryUploader().upload_to_storage(step.input_file)
+        elif step.kind == 'importers':
+            for cmd in source.importer_cmds_with_latest_data():
+                self.run_import(source, cmd, heartbeat)
+        elif step.kind == 'import':
+            self.run_import(source, step.command, heartbeat)
+        else:
+            run_step_command(step.command)
+
+    def run_import(self, source, cmd, heartbeat=None):
+        if heartbeat:
+            heartbeat.check()
+        print "Importing %s with command: `%s`" % (source['id'], cmd)
+        if cmd.startswith('runner:'):
+            run_step_command(cmd)
+            return
+        input_file = source.filename_arg(management_command(cmd, run=False))
+        checksums.verify([input_file])
+        management_command(cmd)
+        if heartbeat:
+            # Leave the import to be logged by whoever has the lease now
+            heartbeat.check()
+        source.set_last_imported_filename(input_file)
+
+    def work(self, queue, poll=POLL_SECONDS):
+        """Claim and run ready steps from `queue` until none are left
+        that can run, renewing the lease on each while it runs.
+
+        Any number of workers can share a queue. Raises an exception
+        listing the steps that failed, if any.
+
+        """
+        self.check_hooks()
+        owner = worker_id()
+        while True:
+            step = queue.claim(owner)
+            if step is None:
+                if not queue.runnable():
                     break
-            if 'after_import' in source:
-                for cmd in source['after_import']:
-                    print "Running after_import step %s" % cmd
-                    if paranoid:
-                        if raw_input("Continue? [y/n]").lower() != 'y':
-                            print "  Skipping...."
-                            continue
-                    management_command(cmd)
+                # Wait for other workers' steps to finish
+                time.sleep(poll)
+                continue
+            print "Running %s step %s for %s (attempt %s)" % (
+                step.kind, step.command, step.source, step.attempts)
+            try:
+                with Heartbeat(queue, step.id, owner) as heartbeat:
+                    self.run_step(step, heartbeat)
+                    heartbeat.check()
+            except LeaseLost as e:
+                # Another worker has taken the step over
+                print e
+                continue
+            except Exception as e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+                print "Step %s failed: %s" % (step.id, error)
+                finish = functools.partial(queue.fail, error=error)
+            else:
+                finish = queue.complete
+            try:
+                finish(step.id, owner)
+            except QueueError as e:
+                # Another worker has taken the step over
+                print e
+        failures = queue.failures()
+        if failures:
+            raise StandardError("Steps failed:\n  " + "\n  ".join(
+                "%s: `%s` (%s)" % failure for failure in failures))
+
+
+def load_dirty():
+    try:
+        with open(DIRTY_FILE, 'rb') as f:
+            return set(json.load(f))
+    except (IOError, ValueError):
+        return set()
+
+
+def save_dirty(dirty):
+    if not dirty:
+        if os.path.exists(DIRTY_FILE):
+            os.remove(DIRTY_FILE)
+        return
+    with open(DIRTY_FILE + '.part', 'wb') as f:
+        json.dump(sorted(dirty), f)
+    os.rename(DIRTY_FILE + '.part', DIRTY_FILE)
+
+
+def run_step_command(cmd):
+    """Run a manifest step: a function in this module if prefixed
+    `runner:`, otherwise a Django management command
+    """
+    if cmd.startswith('runner:'):
+        cmd = cmd[len('runner:'):]
+        globals()[cmd]()  # runs the named method
+    else:
+        management_command(cmd)
 
 
 def management_command(cmd, run=True):
@@ -492,9 +998,10 @@ def management_command(cmd, run=True):
     Raise an exception if the command is not successful
     """
     start = datetime.datetime.now()
+    app_basedir = env('OPENP_FRONTEND_APP_BASEDIR')
     cmd_to_run = ("%s %s/manage.py %s -v 2 "
                   "--settings=openprescribing.settings.production" % (
-                      OPENP_PYTHON, OPENP_FRONTEND_APP_BASEDIR, cmd))
+                      env('OPENP_PYTHON'), app_basedir, cmd))
     my_env = os.environ.copy()
     my_env['PYTHONIOENCODING'] = 'utf-8'
     if run:
@@ -503,7 +1010,7 @@ def management_command(cmd, run=True):
             shlex.split(cmd_to_run),
             stderr=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            cwd=OPENP_FRONTEND_APP_BASEDIR,
+            cwd=app_basedir,
             env=my_env
         )
         stdout, stderr = p.communicate()
@@ -519,14 +1026,169 @@ def management_command(cmd, run=True):
     return cmd_to_run
 
 
-def bigquery_upload():
-    BigQueryUploader().update_bnf_table()
-    bigquery.load_data_from_pg(
-        'hscic', 'practices', 'frontend_practice',
-        bigquery.PRACTICE_SCHEMA)
-    bigquery.load_presentation_from_pg()
-    bigquery.load_statistics_from_pg()
-    bigquery.load_ccgs_from_pg()
+def run_fetcher(source, timeout=None):
+    """Run the fetcher for `source` in this process, returning a
+    FetcherResult.
+
+    The manifest's `fetcher` is a script in `fetchers/` plus its
+    arguments, which are passed to the script's Command explicitly.
+
+    """
+    cmd = source['fetcher']
+    script = shlex.split(cmd)[0]
+    argv = shlex.split(cmd)[1:]
+    print "Running %s" % cmd
+    start = datetime.datetime.now()
+    timer = None
+    try:
+        module = importlib.import_module(
+            'fetchers.%s' % os.path.splitext(script)[0])
+        command = module.Command(argv)
+        if timeout:
+            timer = threading.Timer(timeout, command.cancel)
+            timer.start()
+        result = command.run()
+    except (Exception, SystemExit) as e:
+        if timer and timer.finished.is_set():
+            error = "timed out after %s seconds" % timeout
+        else:
+            error = "%s: %s" % (e.__class__.__name__, e)
+        duration = (datetime.datetime.now() - start).total_seconds()
+        return FetcherResult(source['id'], cmd, [], 0, duration, error)
+    finally:
+        if timer:
+            timer.cancel()
+    return FetcherResult(
+        source['id'], cmd, result.files, result.bytes, result.duration, None)
+
+
+def convert_prescribing():
+    """Convert any detailed prescribing data which doesn't yet have a
+    formatted version
+    """
+    source = ManifestReader().source_by_id('prescribing')
+    for path in source.files_by_date(None):
+        if not re.search(DETAILED_PRESCRIBING_REGEX, path):
+            continue
+        if os.path.exists(prescribing.formatted_path(path)):
+            continue
+        print "Converting %s" % path
+        checksums.record([prescribing.convert(path)])
+
+
+def simplify_ccg_boundaries():
+    """Write simplified GeoJSON for any CCG boundary KML which doesn't
+    yet have it
+    """
+    from utils import kml
+    source = ManifestReader().source_by_id('ccg_boundaries')
+    tolerances = source.get('simplify_tolerances', kml.DEFAULT_TOLERANCES)
+    for path in source.files_by_date(None):
+        if not path.lower().endswith('.kml'):
+            continue
+        if os.path.exists(kml.output_path(path, tolerances[0])):
+            continue
+        print "Simplifying %s" % path
+        checksums.record(kml.convert(path, tolerances))
+
+
+def check_data(update=False):
+    """Check every data file against the checksums recorded for it,
+    recording those of new files; with `update`, record new checksums
+    for changed files rather than failing them
+    """
+    paths = set()
+    for source in ManifestReader().sources:
+        # Sources with an empty `data_dir` have no data of their own
+        if source.get('data_dir', source['id']):
+            paths.update(source.files_by_date(None))
+    failures = checksums.check(sorted(paths), update=update, verbose=True)
+    if failures:
+        raise checksums.ChecksumError(failures)
+    print "Checked %s files" % len(paths)
+
+
+def dedup_data(symlink=False):
+    """Replace copies of importable data files with links to a single
+    stored blob of each
+    """
+    from utils.blobstore import BlobStore
+    store = BlobStore(
+        env('OPENP_DATA_BASEDIR'), symlink=symlink, verbose=True)
+    saved = 0
+    try:
+        for source in ManifestReader().sources:
+            for importer in source.get('importers', []):
+                for path in source.files_by_date(importer):
+                    saved += store.add(path)
+    finally:
+        store.save()
+    print "Saved %s bytes" % saved
+
+
+def gc_data():
+    from utils.blobstore import BlobStore
+    store = BlobStore(env('OPENP_DATA_BASEDIR'), verbose=True)
+    try:
+        freed = store.gc()
+    finally:
+        store.save()
+    print "Freed %s bytes" % freed
+
+
+def bigquery_upload(max_workers=BIGQUERY_LOAD_WORKERS):
+    """Load the tables the measures need into BigQuery, `max_workers`
+    at a time.
+
+    The tables are independent, so a failed load doesn't stop the
+    others; an exception listing the failures is raised once they have
+    all finished.
+
+    """
+    from ebmdatalab import bigquery
+    loads = [
+        ('bnf', lambda: BigQueryUploader().update_bnf_table()),
+        ('practices', lambda: bigquery.load_data_from_pg(
+            'hscic', 'practices', 'frontend_practice',
+            bigquery.PRACTICE_SCHEMA)),
+        ('presentation', bigquery.load_presentation_from_pg),
+        ('practice_statistics', bigquery.load_statistics_from_pg),
+        ('ccgs', bigquery.load_ccgs_from_pg),
+    ]
+    pool = ThreadPool(max_workers)
+    try:
+        results = pool.map_async(
+            lambda load: run_load(*load), loads).get(2 ** 31)
+    finally:
+        pool.terminate()
+    print
+    print "%-25s %10s  %s" % ('Table', 'Seconds', 'Error')
+    for result in results:
+        print "%-25s %10.1f  %s" % (
+            result.table, result.duration, result.error or '')
+    failed = [result for result in results if result.error]
+    if failed:
+        raise StandardError(
+            "BigQuery loads failed: %s" % ", ".join(
+                "%s (%s)" % (result.table, result.error)
+                for result in failed))
+    return results
+
+
+def run_load(table, load):
+    """Run `load`, which loads `table` into BigQuery, returning a
+    LoadResult
+    """
+    print "Loading %s into BigQuery" % table
+    start = datetime.datetime.now()
+    error = None
+    try:
+        load()
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    duration = (datetime.datetime.now() - start).total_seconds()
+    print "Finished loading %s in %.1f seconds" % (table, duration)
+    return LoadResult(table, duration, error)
 
 
 if __name__ == '__main__':
@@ -538,23 +1200,67 @@ if __name__ == '__main__':
         choices=['getmanual', 'getauto', 'updatelog',
                  'runimporters', 'bigquery', 'create_indexes',
                  'create_matviews', 'refresh_matviews','showorder',
-                 'archivedata', 'smoketests', 'updatesmoketests', 'runsmoketests', 'getdata']
+                 'archivedata', 'smoketests', 'updatesmoketests', 'runsmoketests', 'getdata',
+                 'convertprescribing', 'validate', 'buildcolumns',
+                 'dedup', 'gc', 'enqueue', 'work', 'checksums']
     )
     parser.add_argument('--bigquery-file')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help="Have `updatesmoketests` use local data rather than BigQuery")
+    parser.add_argument(
+        '--symlink', action='store_true',
+        help="Have `dedup` use symlinks rather than hardlinks")
+    parser.add_argument(
+        '--schema',
+        help="Schema for `validate` to check against (default: by filename)")
     parser.add_argument('--paranoid', action='store_true')
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Have `runimporters` and `enqueue` run every step, even if "
+        "nothing is new")
+    parser.add_argument(
+        '--queue', default=QUEUE_FILE,
+        help="Work queue for `enqueue` and `work` (default: %(default)s)")
+    parser.add_argument(
+        '--archive', action='store_true',
+        help="Have `enqueue` also queue uploads of data files to storage")
+    parser.add_argument(
+        '--retry-failed', action='store_true',
+        help="Have `work` try failed steps again")
+    parser.add_argument(
+        '--bundled', action='store_true',
+        help="Have `archivedata` upload, and `getdata` restore from, a "
+        "compressed bundle for each source and month")
+    parser.add_argument(
+        '--update', action='store_true',
+        help="Have `checksums` record changed files rather than fail them")
+    parser.add_argument(
+        '--fetcher-timeout', type=int,
+        help="Seconds after which `getauto` cancels a fetcher")
     args = parser.parse_args()
     if args.command[0] == 'getmanual':
         FetcherRunner().prompt_all_manual_data()
     elif args.command[0] == 'getauto':
-        FetcherRunner().run_all_fetchers()
+        FetcherRunner().run_all_fetchers(timeout=args.fetcher_timeout)
     elif args.command[0] == 'runimporters':
-        ImporterRunner().run_all_importers(paranoid=args.paranoid)
+        ImporterRunner().run_all_importers(
+            paranoid=args.paranoid, force=args.force)
+    elif args.command[0] == 'enqueue':
+        added = ImporterRunner().enqueue_all(
+            WorkQueue(args.queue), force=args.force, archive=args.archive)
+        print "Queued %s steps in %s" % (added, args.queue)
+    elif args.command[0] == 'work':
+        queue = WorkQueue(args.queue)
+        if args.retry_failed:
+            queue.retry_failed()
+        ImporterRunner().work(queue)
     elif args.command[0] == 'updatelog':
         ImporterRunner().update_log()
     elif args.command[0] == 'archivedata':
-        BigQueryUploader().upload_all_to_storage()
+        BigQueryUploader().upload_all_to_storage(bundled=args.bundled)
     elif args.command[0] == 'getdata':
-        BigQueryDownloader().download_all()
+        BigQueryDownloader().download_all(bundled=args.bundled)
     elif args.command[0] == 'create_indexes':
         management_command('create_indexes')
     elif args.command[0] == 'create_matviews':
@@ -562,11 +1268,29 @@ if __name__ == '__main__':
     elif args.command[0] == 'refresh_matviews':
         management_command('refresh_matviews')
     elif args.command[0] == 'updatesmoketests':
-        SmokeTestHandler().update_smoketests()
+        SmokeTestHandler().update_smoketests(offline=args.offline)
     elif args.command[0] == 'runsmoketests':
         SmokeTestHandler().run_smoketests()
     elif args.command[0] == 'bigquery':
         bigquery_upload()
+    elif args.command[0] == 'convertprescribing':
+        convert_prescribing()
+    elif args.command[0] == 'checksums':
+        check_data(update=args.update)
+    elif args.command[0] == 'dedup':
+        dedup_data(symlink=args.symlink)
+    elif args.command[0] == 'gc':
+        gc_data()
+    elif args.command[0] == 'buildcolumns':
+        from utils.columns import ColumnCache
+        ColumnCache(env('OPENP_DATA_BASEDIR')).update(verbose=True)
+    elif args.command[0] == 'validate':
+        schema = args.schema or validate.schema_for(args.bigquery_file)
+        if not schema:
+            parser.error("Don't know which schema %s should match; "
+                         "use --schema" % args.bigquery_file)
+        validate.validate(args.bigquery_file, schema)
+        print "%s matches %s" % (args.bigquery_file, schema)
     elif args.command[0] == 'showorder':
         print "Will run in the following order:"
         for s in ManifestReader().sources_ordered_by_dependency():
@@ -0,0 +1,170 @@
+"""A content-addressed store for data files, so identical copies of a
+file in different month directories take up space only once.
+
+Blobs live under `<data basedir>/.blobs/<first two hex digits>/<sha256>`.
+A deduplicated data file is replaced by a hardlink to its blob, or a
+symlink where hardlinks aren't possible (or `symlink=True`), so paths
+under the data directory don't change.
+
+The store assumes files are never modified in place once deduplicated.
+Fetchers download to a partial file and rename it over the old one
+(see `Downloader.fetch`), which breaks the link rather than changing
+the blob. A hardlinked blob is the same inode as the data files, so
+its permissions are left alone; blobs reached by symlink are made
+read-only, so that writing through a link fails rather than changing
+every copy.
+
+"""
+import errno
+import hashlib
+import json
+import os
+import stat
+
+BLOB_DIR = '.blobs'
+# Hashes of files already seen, by inode, size and mtime, so we don't
+# hash multi-GB files on every run
+HASHES_FILE = 'hashes.json'
+HASH_CHUNKSIZE = 1024 * 1024
+
+
+class BlobStore(object):
+    def __init__(self, basedir, symlink=False, verbose=False):
+        self.basedir = basedir
+        self.blob_dir = os.path.join(basedir, BLOB_DIR)
+        self.symlink = symlink
+        self.verbose = verbose
+        self._hashes = None
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def add(self, path):
+        """Replace `path` with a link to the blob of its contents,
+        returning the number of bytes saved
+        """
+        if os.path.islink(path):
+            return 0
+        digest = self.digest(path)
+        blob = self.blob_path(digest)
+        size = os.path.getsize(path)
+        if not os.path.exists(blob):
+            self._store(path, blob)
+            return 0
+        if os.path.samefile(path, blob):
+            return 0
+        if os.path.getsize(blob) != size:
+            raise StandardError(
+                "Blob %s doesn't match %s; is it corrupt?" % (blob, path))
+        self._link(blob, path)
+        if self.verbose:
+            print "%s is a copy of %s" % (path, blob)
+        return size
+
+    def digest(self, path):
+        """Return the sha256 of `path`, from the hash cache if possible
+        """
+        stat_result = os.stat(path)
+        key = "%s:%s:%s" % (
+            stat_result.st_ino, stat_result.st_size, stat_result.st_mtime)
+        hashes = self.hashes()
+        if key not in hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNKSIZE), ''):
+                    digest.update(chunk)
+            hashes[key] = digest.hexdigest()
+        return hashes[key]
+
+    def hashes(self):
+        if self._hashes is None:
+            try:
+                with open(os.path.join(self.blob_dir, HASHES_FILE)) as f:
+                    self._hashes = json.load(f)
+            except (IOError, ValueError):
+                self._hashes = {}
+        return self._hashes
+
+    def save(self):
+        if self._hashes is None:
+            return
+        if not os.path.isdir(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        path = os.path.join(self.blob_dir, HASHES_FILE)
+        with open(path + '.part', 'wb') as f:
+            json.dump(self._hashes, f)
+        os.rename(path + '.part', path)
+
+    def gc(self):
+        """Delete blobs no longer linked from the data directory,
+        returning the number of bytes freed
+        """
+        referenced = set()
+        for root, dirs, files in os.walk(self.basedir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    referenced.add(os.path.realpath(path))
+        freed = 0
+        live = set()
+        for root, dirs, files in os.walk(self.blob_dir):
+            for name in files:
+                if name == HASHES_FILE or root == self.blob_dir:
+                    continue
+                path = os.path.join(root, name)
+                stat_result = os.stat(path)
+                if stat_result.st_nlink > 1 or \
+                        os.path.realpath(path) in referenced:
+                    live.add(name)
+                    continue
+                if self.verbose:
+                    print "Removing unreferenced blob %s" % path
+                os.remove(path)
+                freed += stat_result.st_size
+            if root != self.blob_dir and not os.listdir(root):
+                os.rmdir(root)
+        # Forget hashes of files that have gone
+        hashes = self.hashes()
+        for key, digest in hashes.items():
+            if digest not in live:
+                del hashes[key]
+        return freed
+
+    def _store(self, path, blob):
+        """Make `path` the blob of its contents
+        """
+        blob_parent = os.path.dirname(blob)
+        if not os.path.isdir(blob_parent):
+            os.makedirs(blob_parent)
+        if self.symlink:
+            os.rename(path, blob)
+            self._make_read_only(blob)
+            self._link(blob, path)
+            return
+        try:
+            os.link(path, blob)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            self.symlink = True
+            return self._store(path, blob)
+
+    def _link(self, blob, path):
+        """Atomically replace `path` with a link to `blob`
+        """
+        partial = "%s.%s.link" % (path, os.getpid())
+        if not self.symlink:
+            try:
+                os.link(blob, partial)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                self.symlink = True
+        if self.symlink:
+            os.symlink(os.path.relpath(blob, os.path.dirname(path)), partial)
+        os.rename(partial, path)
+
+    def _make_read_only(self, path):
+        mode = os.stat(path).st_mode
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
@@ -0,0 +1,153 @@
+"""Bundles of a source's data files for one month, for archiving.
+
+A bundle is a gzipped tar of the files, with each file's tar entry
+compressed as a separate gzip member. Concatenated gzip members are
+themselves valid gzip, so a bundle can be unpacked with `tar xzf`, but
+any one member can also be decompressed on its own. The bundle's index
+records where each member starts and how long it is, so a single file
+can be restored with a ranged read of just its bytes.
+
+Files are streamed into the bundle, compressed as they're read, so a
+bundle can be uploaded as it's made without a copy of it on disk.
+
+"""
+import gzip
+import hashlib
+import os
+import tarfile
+
+BUNDLE_NAME = 'bundle.tar.gz'
+INDEX_NAME = 'bundle.index.json'
+# Bump when the layout of bundles or indexes changes
+VERSION = 1
+# Bytes to read or write at a time
+COPY_BUFSIZE = 1024 * 1024
+COMPRESSLEVEL = 6
+
+
+class BundleError(StandardError):
+    pass
+
+
+def gzip_member(out):
+    """Return a GzipFile writing a new gzip member to `out`
+    """
+    return gzip.GzipFile(filename='', mode='wb', fileobj=out,
+                         compresslevel=COMPRESSLEVEL, mtime=0)
+
+
+class _Buffer(object):
+    """A file object collecting what's written to it, for `iter_bundle`
+    to pass on
+    """
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def iter_bundle(paths, index):
+    """Yield the bytes of a bundle of the files at `paths`, a block at a
+    time, filling in the dict `index` as they go
+    """
+    index['version'] = VERSION
+    index['members'] = members = []
+    out = _Buffer()
+    for path in paths:
+        stat = os.stat(path)
+        info = tarfile.TarInfo(os.path.basename(path))
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0644
+        start = out.tell()
+        sha256 = hashlib.sha256()
+        size = 0
+        member = gzip_member(out)
+        member.write(info.tobuf(format=tarfile.USTAR_FORMAT))
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(COPY_BUFSIZE)
+                if not block:
+                    break
+                member.write(block)
+                sha256.update(block)
+                size += len(block)
+                yield out.take()
+        if size != info.size:
+            raise BundleError("%s changed while it was being bundled" % path)
+        member.write('\0' * (-size % tarfile.BLOCKSIZE))
+        member.close()
+        members.append({
+            'name': info.name,
+            'offset': start,
+            'length': out.tell() - start,
+            'size': size,
+            'mtime': info.mtime,
+            'sha256': sha256.hexdigest(),
+        })
+        yield out.take()
+    # The end-of-archive marker
+    end = gzip_member(out)
+    end.write('\0' * tarfile.BLOCKSIZE * 2)
+    end.close()
+    yield out.take()
+
+
+def write_bundle(paths, out):
+    """Write a bundle of the files at `paths` to the file object `out`,
+    returning its index
+    """
+    index = {}
+    for data in iter_bundle(paths, index):
+        out.write(data)
+    return index
+
+
+def extract_member(stream, member, target):
+    """Write the file in `member` of a bundle's index to `target`, from
+    `stream`, a file object reading the member's compressed bytes.
+
+    The file only appears at `target` once it has been checked against
+    the size and sha256 in the index.
+
+    """
+    partial = "%s.%s.part" % (target, os.getpid())
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|gz')
+        info = tar.next()
+        if info is None or info.name != member['name']:
+            raise BundleError("Expected %s in bundle, but found %s" % (
+                member['name'], info and info.name))
+        source = tar.extractfile(info)
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(partial, 'wb') as f:
+            while True:
+                block = source.read(COPY_BUFSIZE)
+                if not block:
+                    break
+                f.write(block)
+                sha256.update(block)
+                size += len(block)
+        if (size, sha256.hexdigest()) != (member['size'], member['sha256']):
+            raise BundleError("%s from bundle doesn't match its index" %
+                              member['name'])
+        os.utime(partial, (member['mtime'], member['mtime']))
+        os.rename(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
@@ -0,0 +1,170 @@
+"""Checksums of data files, to catch files that are changed or
+truncated after they were fetched.
+
+Each month directory has a `.checksums.json` recording the size,
+mtime and sha256 of its files, and for CSVs the number of lines.
+Files are recorded as soon as they have been fetched, downloaded or
+generated. After that, a file is only read again if its size or mtime
+has changed, and then fails unless its contents are the same as when
+it was recorded. A file that was never recorded fails verification;
+files put in place by hand are recorded with `runner.py checksums`.
+Files are hashed in a pool of processes, reading large blocks at a
+time.
+
+"""
+import fcntl
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+MANIFEST = '.checksums.json'
+# Held while a manifest is updated, as the manifest itself is replaced
+LOCK_FILE = '.checksums.json.lock'
+# Bytes to read from a file at a time
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class ChecksumError(StandardError):
+    def __init__(self, failures):
+        self.failures = failures
+        StandardError.__init__(
+            self, "Files don't match their checksums:\n  " + "\n  ".join(
+                "%s: %s" % item for item in sorted(failures.items())))
+
+
+def file_record(path):
+    """Return the size, mtime and sha256 of the file at `path`, and the
+    number of lines if it's a CSV
+    """
+    stat = os.stat(path)
+    is_csv = path.lower().endswith('.csv')
+    sha256 = hashlib.sha256()
+    lines = 0
+    last = ''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BUFFER_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+            if is_csv:
+                lines += block.count('\n')
+                last = block[-1]
+    record = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256.hexdigest(),
+    }
+    if is_csv:
+        record['rows'] = lines + (1 if last not in ('', '\n') else 0)
+    return record
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(directory, records):
+    path = os.path.join(directory, MANIFEST)
+    partial = "%s.%s.part" % (path, os.getpid())
+    with open(partial, 'wb') as f:
+        json.dump(records, f, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+    os.rename(partial, path)
+
+
+def update_manifest(directory, records):
+    """Add `records` to the manifest in `directory`, and forget files
+    that have gone.
+
+    Other processes and threads may be recording files in the same
+    directory, so the manifest is read again and written under an
+    exclusive lock, rather than overwritten with what we read before.
+
+    """
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        # flock rather than lockf, so that threads exclude each other
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest(directory)
+        manifest.update(records)
+        for name in manifest.keys():
+            if not os.path.exists(os.path.join(directory, name)):
+                del manifest[name]
+        save_manifest(directory, manifest)
+
+
+def check(paths, update=False, record_new=True, processes=None,
+          verbose=False):
+    """Check the files at `paths` against the manifests of their
+    directories, returning a dict of reasons for the files that fail.
+
+    Files not in a manifest are recorded in it, or fail unless
+    `record_new`. With `update`, files whose contents have changed are
+    recorded afresh rather than failed.
+
+    """
+    manifests = {}
+    to_hash = []
+    failures = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        if directory not in manifests:
+            manifests[directory] = load_manifest(directory)
+        record = manifests[directory].get(name)
+        if not record and not record_new:
+            failures[path] = (
+                "no checksum was recorded when it was fetched; if it's "
+                "good, record it with `runner.py checksums`")
+            continue
+        stat = os.stat(path)
+        if record and (record['size'], record['mtime']) == (
+                stat.st_size, stat.st_mtime):
+            continue
+        to_hash.append(path)
+    if verbose:
+        print "Hashing %s of %s files" % (len(to_hash), len(paths))
+    if len(to_hash) > 1:
+        pool = Pool(processes)
+        try:
+            records = pool.map(file_record, to_hash, chunksize=1)
+        finally:
+            pool.terminate()
+    else:
+        records = map(file_record, to_hash)
+    changed = {}
+    for path, record in zip(to_hash, records):
+        directory, name = os.path.split(path)
+        previous = manifests[directory].get(name)
+        if previous and previous['sha256'] != record['sha256'] and \
+                not update:
+            failures[path] = (
+                "%s bytes with sha256 %s, but %s bytes with sha256 %s "
+                "when recorded" % (record['size'], record['sha256'],
+                                   previous['size'], previous['sha256']))
+            continue
+        if verbose and previous and previous['sha256'] != record['sha256']:
+            print "Recording new checksum for %s" % path
+        changed.setdefault(directory, {})[name] = record
+    for directory, records in changed.items():
+        update_manifest(directory, records)
+    return failures
+
+
+def record(paths, processes=None):
+    """Record the checksums of files that have just been written
+    """
+    check(paths, update=True, processes=processes)
+
+
+def verify(paths, processes=None):
+    """Check `paths` as `check` does, raising ChecksumError if any fail
+    or were never recorded
+    """
+    failures = check(paths, record_new=False, processes=processes)
+    if failures:
+        raise ChecksumError(failures)
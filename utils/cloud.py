@@ -14,22 +14,17 @@
 
 # gs://ebmdatalab/hscic/prescribing/T201601PDPI%2BBNFT.CSV
 # https://www.googleapis.com/storage/v1/b/ebmdatalab/o/hscic%2Faddresses%2FT201602ADDR%20BNFT.CSV
-import httplib2
 import json
+import os
+import re
 import random
 import sys
+import threading
 import time
-import re
+import urlparse
 
-from apiclient.errors import HttpError
-from oauth2client.client import GoogleCredentials
-from googleapiclient import discovery
-from apiclient.http import MediaFileUpload
-from apiclient.http import MediaIoBaseDownload
-from json import dumps as json_dumps
-
-# Retry transport and file IO errors.
-RETRYABLE_ERRORS = (httplib2.HttpLib2Error, IOError)
+# The Google API client libraries are slow to import, so are imported
+# when first needed.
 
 # Number of times to retry failed downloads.
 NUM_RETRIES = 5
@@ -40,14 +35,118 @@ CHUNKSIZE = 2 * 1024 * 1024
 # Mimetype to use if one can't be guessed from the file extension.
 DEFAULT_MIMETYPE = 'application/octet-stream'
 
+# Where we keep copies of the API discovery documents, which otherwise
+# have to be fetched every time a client is built.
+DISCOVERY_CACHE_DIR = os.environ.get(
+    'OPENP_DISCOVERY_CACHE_DIR', '.discovery_cache')
+# Seconds for which a cached discovery document is used without
+# fetching a new one.
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+DISCOVERY_URL = ('https://www.googleapis.com/discovery/v1/apis/'
+                 '%s/%s/rest')
+# Environment variable which, if set, is the root URL of a stand-in for
+# the Google APIs (such as `benchmarks/fakecloud.py`) to use instead;
+# no credentials are sent to it.
+ENDPOINT_VARIABLE = 'OPENP_CLOUD_ENDPOINT'
+
+_discovery_lock = threading.Lock()
+
+
+def retryable_errors():
+    """Transport and file IO errors, which are worth retrying
+    """
+    import httplib2
+    return (httplib2.HttpLib2Error, IOError)
+
+
+def cloud_endpoint():
+    return os.environ.get(ENDPOINT_VARIABLE)
+
+
+def discovery_document(api, version):
+    """Return the discovery document for `api`, from the local cache
+    if it's recent enough.
+
+    If the cached copy is stale but a new one can't be fetched, the
+    stale copy is used. Documents from a stand-in endpoint are cached
+    separately for each endpoint.
+
+    """
+    endpoint = cloud_endpoint()
+    if endpoint:
+        url = urlparse.urljoin(
+            endpoint, 'discovery/v1/apis/%s/%s/rest' % (api, version))
+        host = re.sub(r'\W+', '_', urlparse.urlsplit(url).netloc)
+        name = '%s.%s.%s.json' % (api, version, host)
+    else:
+        url = DISCOVERY_URL % (api, version)
+        name = '%s.%s.json' % (api, version)
+    path = os.path.join(DISCOVERY_CACHE_DIR, name)
+    with _discovery_lock:
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            age = None
+        if age is None or age > DISCOVERY_TTL:
+            import httplib2
+            try:
+                response, content = httplib2.Http().request(url)
+                if response.status != 200:
+                    raise IOError("Got status %s fetching discovery "
+                                  "document for %s" % (response.status, api))
+            except (httplib2.HttpLib2Error, IOError):
+                if age is None:
+                    raise
+            else:
+                if not os.path.isdir(DISCOVERY_CACHE_DIR):
+                    os.makedirs(DISCOVERY_CACHE_DIR)
+                with open(path + '.part', 'wb') as f:
+                    f.write(content)
+                os.rename(path + '.part', path)
+        with open(path, 'rb') as f:
+            return f.read()
+
 
 class CloudHandler(object):
+    """Access to BigQuery and Cloud Storage.
+
+    The API clients are built on first use, so subclasses only pay for
+    the ones they use. Their HTTP connections can't be shared between
+    threads, so each thread gets its own clients.
+
+    """
     def __init__(self):
         super(CloudHandler, self).__init__()
-        credentials = GoogleCredentials.get_application_default()
-        self.bigquery = discovery.build('bigquery', 'v2',
-                                        credentials=credentials)
-        self.cloud = discovery.build('storage', 'v1', credentials=credentials)
+        self._credentials = None
+        self._clients = threading.local()
+
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            from oauth2client.client import GoogleCredentials
+            self._credentials = GoogleCredentials.get_application_default()
+        return self._credentials
+
+    def build_client(self, api, version):
+        from googleapiclient import discovery
+        if cloud_endpoint():
+            from googleapiclient.http import build_http
+            return discovery.build_from_document(
+                discovery_document(api, version), http=build_http())
+        return discovery.build_from_document(
+            discovery_document(api, version), credentials=self.credentials)
+
+    @property
+    def bigquery(self):
+        if getattr(self._clients, 'bigquery', None) is None:
+            self._clients.bigquery = self.build_client('bigquery', 'v2')
+        return self._clients.bigquery
+
+    @property
+    def cloud(self):
+        if getattr(self._clients, 'cloud', None) is None:
+            self._clients.cloud = self.build_client('storage', 'v1')
+        return self._clients.cloud
 
     def handle_progressless_iter(self, error, progressless_iters):
         if progressless_iters > NUM_RETRIES:
@@ -173,32 +272,26 @@ class CloudHandler(object):
 
         Optionally filtered by prefex and name regex.
         """
-        dataset_ids = []
-        response = self.cloud.objects().list(
-            bucket=bucket,
-            prefix=prefix).execute()
-        page_token = response.get('nextPageToken', None)
-        if 'items' in response:
-            dataset_ids += response["items"]
-            while page_token:
-                response = self.cloud.objects().list(
-                    bucket='ebmdatalab',
-                    pageToken=page_token,
-                    prefix='hscic/prescribing').execute()
-                if 'items' not in response:
-                    break
-                dataset_ids += response["items"]
-                page_token = response.get('nextPageToken', None)
-            if name_regex:
-                dataset_ids = filter(
-                    lambda x: re.findall(name_regex, x['name']), dataset_ids)
-            dataset_ids = sorted(
-                dataset_ids, key=lambda x: x['timeCreated'])
-            dataset_ids = map(
-                lambda x: x['name'], dataset_ids)
-            return dataset_ids
-        else:
-            return []
+        dataset_ids = self.list_objects(bucket, prefix)
+        if name_regex:
+            dataset_ids = filter(
+                lambda x: re.findall(name_regex, x['name']), dataset_ids)
+        dataset_ids = sorted(
+            dataset_ids, key=lambda x: x['timeCreated'])
+        return map(lambda x: x['name'], dataset_ids)
+
+    def list_objects(self, bucket, prefix=''):
+        """Return every object in `bucket` whose name starts with
+        `prefix`, from all pages of the listing
+        """
+        objects = []
+        kwargs = {'bucket': bucket, 'prefix': prefix}
+        while True:
+            response = self.cloud.objects().list(**kwargs).execute()
+            objects += response.get('items', [])
+            if not response.get('nextPageToken'):
+                return objects
+            kwargs['pageToken'] = response['nextPageToken']
 
     def list_tables(self):
         page_token = None
@@ -239,27 +332,81 @@ class CloudHandler(object):
             yield dict_row
 
     def download(self, filename, bucket_name, object_name):
-        with open(filename, 'wb') as f:
-            req = self.cloud.objects().get_media(
-                bucket=bucket_name, object=object_name)
-            downloader = MediaIoBaseDownload(f, req)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                print("Download {}%.".format(int(status.progress() * 100)))
+        """Download an object to `filename`, which only appears once the
+        download is complete
+        """
+        from apiclient.http import MediaIoBaseDownload
+        partial = "%s.%s.part" % (filename, os.getpid())
+        try:
+            with open(partial, 'wb') as f:
+                req = self.cloud.objects().get_media(
+                    bucket=bucket_name, object=object_name)
+                downloader = MediaIoBaseDownload(f, req, chunksize=CHUNKSIZE)
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk(
+                        num_retries=NUM_RETRIES)
+                    print("Download of {} {}%.".format(
+                        object_name, int(status.progress() * 100)))
+            os.rename(partial, filename)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def read(self, bucket_name, object_name):
+        """Return the contents of a small object
+        """
+        return self.cloud.objects().get_media(
+            bucket=bucket_name, object=object_name).execute(
+                num_retries=NUM_RETRIES)
+
+    def read_range(self, bucket_name, object_name, start, end):
+        """Return bytes `start` to `end` inclusive of an object
+        """
+        req = self.cloud.objects().get_media(
+            bucket=bucket_name, object=object_name)
+        req.headers['Range'] = "bytes=%s-%s" % (start, end)
+        content = req.execute(num_retries=NUM_RETRIES)
+        if len(content) != end - start + 1:
+            raise IOError("Asked for %s bytes of %s but got %s" % (
+                end - start + 1, object_name, len(content)))
+        return content
+
+    def open_range(self, bucket_name, object_name, start, length):
+        """Return a file object reading `length` bytes of an object from
+        `start`, fetched CHUNKSIZE bytes at a time
+        """
+        return RangeReader(self, bucket_name, object_name, start, length)
 
     def upload(self, filename, bucket_name, object_name):
+        from apiclient.http import MediaFileUpload
         assert bucket_name and object_name
         print 'Building upload request...'
         media = MediaFileUpload(filename, chunksize=CHUNKSIZE, resumable=True)
         if not media.mimetype():
             media = MediaFileUpload(filename, DEFAULT_MIMETYPE, resumable=True)
-        request = self.cloud.objects().insert(bucket=bucket_name,
-                                              name=object_name,
-                                              media_body=media)
         print 'Uploading file: %s to bucket: %s object: %s ' % (filename,
                                                                 bucket_name,
                                                                 object_name)
+        self.upload_media(media, bucket_name, object_name)
+
+    def upload_stream(self, chunks, bucket_name, object_name,
+                      mimetype=DEFAULT_MIMETYPE):
+        """Upload the strings yielded by `chunks` as one object, holding
+        no more than a couple of CHUNKSIZE pieces of it at a time
+        """
+        from mediastream import MediaStreamUpload
+        assert bucket_name and object_name
+        media = MediaStreamUpload(chunks, mimetype, CHUNKSIZE)
+        print 'Uploading to bucket: %s object: %s ' % (bucket_name,
+                                                       object_name)
+        self.upload_media(media, bucket_name, object_name)
+
+    def upload_media(self, media, bucket_name, object_name):
+        from apiclient.errors import HttpError
+        request = self.cloud.objects().insert(bucket=bucket_name,
+                                              name=object_name,
+                                              media_body=media)
         progressless_iters = 0
         response = None
         while response is None:
@@ -273,7 +420,7 @@ class CloudHandler(object):
                 error = err
                 if err.resp.status < 500:
                     raise
-            except RETRYABLE_ERRORS, err:
+            except retryable_errors(), err:
                 error = err
 
             if error:
@@ -283,3 +430,36 @@ class CloudHandler(object):
                 progressless_iters = 0
 
         print '\nUpload complete!'
+
+
+class RangeReader(object):
+    """A readable file object of part of a Cloud Storage object
+    """
+    def __init__(self, handler, bucket_name, object_name, start, length):
+        self.handler = handler
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.position = start
+        self.end = start + length
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                if self.position >= self.end:
+                    break
+                chunk_end = min(self.position + CHUNKSIZE, self.end) - 1
+                self.buffer = self.handler.read_range(
+                    self.bucket_name, self.object_name, self.position,
+                    chunk_end)
+                self.offset = 0
+                self.position = chunk_end + 1
+            available = len(self.buffer) - self.offset
+            n = available if size < 0 else min(size, available)
+            parts.append(self.buffer[self.offset:self.offset + n])
+            self.offset += n
+            if size > 0:
+                size -= n
+        return ''.join(parts)
@@ -0,0 +1,253 @@
+"""A columnar cache of formatted prescribing data, one directory per
+month, under `<data basedir>/.columns/prescribing/<YYYY_MM>/`.
+
+Numeric columns are stored as raw typed arrays, which are read with
+`numpy.memmap`, so a query touching two columns reads only those two.
+Organisation and presentation codes are dictionary-encoded: an array
+of int32 indexes, plus a JSON list of the distinct values.
+
+Each month's `meta.json` records the size, mtime and sha256 of the CSV
+it was built from. A month is rebuilt when that CSV's contents change;
+if only its mtime has changed, the hash is checked and the record
+updated.
+
+"""
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+CACHE_DIR = '.columns/prescribing'
+FORMATTED_GLOB = 'prescribing/*/*_formatted.CSV'
+# Names of month directories in the cache; anything else, such as a
+# temporary directory left by an interrupted build, is ignored
+MONTH_RE = re.compile(r'^\d{4}_\d{2}$')
+# Bump when the layout changes, to invalidate existing caches
+VERSION = 1
+# Number of rows to read before writing out
+CHUNK_ROWS = 500000
+HASH_CHUNKSIZE = 1024 * 1024
+CODE_COLUMNS = ['practice', 'pct', 'bnf_code']
+# Numeric columns and their C types, as `array` and numpy typecodes
+NUMERIC_COLUMNS = [
+    ('items', 'l'),
+    ('net_cost', 'd'),
+    ('actual_cost', 'd'),
+    ('quantity', 'l'),
+]
+
+
+class ColumnCacheError(StandardError):
+    pass
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNKSIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ColumnCache(object):
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.cache_dir = os.path.join(basedir, CACHE_DIR)
+
+    def sources(self):
+        """Return a dict of the formatted CSV for each month, by YYYY_MM
+        """
+        sources = {}
+        for path in sorted(glob.glob(
+                os.path.join(self.basedir, FORMATTED_GLOB))):
+            month = re.search(r'(\d{4}_\d{2})/[^/]*$', path).group(1)
+            sources[month] = path
+        return sources
+
+    def months(self):
+        """Return the months in the cache, oldest first
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return sorted(
+            month for month in os.listdir(self.cache_dir)
+            if MONTH_RE.match(month) and os.path.exists(os.path.join(
+                self.cache_dir, month, 'meta.json')))
+
+    def month(self, month):
+        return Month(os.path.join(self.cache_dir, month))
+
+    def update(self, verbose=False):
+        """Build or rebuild the cache for any month whose CSV is new or
+        has changed, returning the months built.
+
+        """
+        built = []
+        for month, source in sorted(self.sources().items()):
+            if self.is_current(month, source):
+                continue
+            if verbose:
+                print "Building column cache for %s from %s" % (
+                    month, source)
+            self.build(month, source)
+            built.append(month)
+        return built
+
+    def is_current(self, month, source):
+        meta_path = os.path.join(self.cache_dir, month, 'meta.json')
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if meta.get('version') != VERSION:
+            return False
+        stat = os.stat(source)
+        if (meta['size'], meta['mtime']) == (stat.st_size, stat.st_mtime):
+            return True
+        if meta['size'] != stat.st_size or meta['sha256'] != sha256(source):
+            return False
+        # Touched but unchanged; remember that, to save hashing again
+        meta['mtime'] = stat.st_mtime
+        write_json(meta_path, meta)
+        return True
+
+    def build(self, month, source):
+        """Write the columns of `source` to the cache for `month`
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # Build alongside the old version, then swap it in, so readers
+        # never see a half-built month
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.%s-' % month)
+        try:
+            stat = os.stat(source)
+            meta = write_columns(source, tmp_dir)
+            meta.update({
+                'version': VERSION,
+                'source': os.path.relpath(source, self.basedir),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': sha256(source),
+            })
+            write_json(os.path.join(tmp_dir, 'meta.json'), meta)
+            target = os.path.join(self.cache_dir, month)
+            if os.path.exists(target):
+                old = tempfile.mkdtemp(
+                    dir=self.cache_dir, prefix='.%s-old-' % month)
+                os.rename(target, os.path.join(old, month))
+                os.rename(tmp_dir, target)
+                shutil.rmtree(old)
+            else:
+                os.rename(tmp_dir, target)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+
+class Month(object):
+    """Read access to one month of cached columns
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'rb') as f:
+            self.meta = json.load(f)
+        self.rows = self.meta['rows']
+        self._values = {}
+
+    def column(self, name):
+        """Return the named numeric column, or the indexes of a code
+        column, as a read-only memory-mapped array
+        """
+        dtype = self.meta['dtypes'][name]
+        if not self.rows:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, '%s.bin' % name),
+                         dtype=dtype, mode='r', shape=(self.rows,))
+
+    def values(self, name):
+        """Return the list of distinct values of a code column; the
+        column holds indexes into this list
+        """
+        if name not in self._values:
+            with open(os.path.join(
+                    self.path, '%s.values.json' % name), 'rb') as f:
+                self._values[name] = json.load(f)
+        return self._values[name]
+
+    def decoded(self, name):
+        """Return a code column as an array of strings
+        """
+        return np.array(self.values(name), dtype=object)[self.column(name)]
+
+
+def write_columns(source, target_dir):
+    """Write the columns of the formatted CSV `source` as files in
+    `target_dir`, returning their metadata
+    """
+    codes = dict((name, {}) for name in CODE_COLUMNS)
+    rows = 0
+    outputs = {}
+    try:
+        for name in CODE_COLUMNS + [c[0] for c in NUMERIC_COLUMNS]:
+            outputs[name] = open(
+                os.path.join(target_dir, '%s.bin' % name), 'wb')
+        with open(source, 'rb') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            try:
+                indexes = dict(
+                    (name, header.index(name))
+                    for name in outputs)
+            except ValueError as e:
+                raise ColumnCacheError("%s: %s" % (source, e))
+            while True:
+                chunk = list(itertools.islice(reader, CHUNK_ROWS))
+                if not chunk:
+                    break
+                rows += len(chunk)
+                for name in CODE_COLUMNS:
+                    lookup = codes[name]
+                    i = indexes[name]
+                    encoded = array('i', [
+                        lookup.setdefault(row[i], len(lookup))
+                        for row in chunk])
+                    encoded.tofile(outputs[name])
+                for name, typecode in NUMERIC_COLUMNS:
+                    i = indexes[name]
+                    cast = float if typecode == 'd' else to_int
+                    array(typecode, [
+                        cast(row[i] or 0) for row in chunk]).tofile(
+                            outputs[name])
+    finally:
+        for output in outputs.values():
+            output.close()
+    dtypes = dict((name, 'int32') for name in CODE_COLUMNS)
+    for name, typecode in NUMERIC_COLUMNS:
+        dtypes[name] = np.dtype(typecode).name
+    for name, lookup in codes.items():
+        values = sorted(lookup, key=lookup.get)
+        write_json(os.path.join(target_dir, '%s.values.json' % name), values)
+    return {'rows': rows, 'dtypes': dtypes}
+
+
+def to_int(value):
+    """Parse an integer column, which may be written as a float, such
+    as a quantity of '2.0'
+    """
+    return int(round(float(value)))
+
+
+def write_json(path, obj):
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        json.dump(obj, f)
+    os.rename(partial, path)
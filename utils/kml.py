@@ -0,0 +1,202 @@
+"""Turn CCG boundary KML into compact, simplified GeoJSON.
+
+The KML is streamed with `iterparse`, one Placemark at a time, and each
+Placemark is cleared once read, so memory use doesn't grow with the
+size of the file. Polygons are simplified with the Douglas-Peucker
+algorithm, and each feature carries its bounding box, so map rendering
+can skip boundaries outside the view without looking at them.
+
+"""
+import json
+import os
+import re
+
+import numpy as np
+from lxml import etree
+
+# Degrees; 0.0001 is about 10m in England
+DEFAULT_TOLERANCES = [0.0001]
+# Decimal places to keep in output coordinates
+PRECISION = 6
+
+
+class KmlError(StandardError):
+    pass
+
+
+def output_path(kml_path, tolerance, default=True):
+    """Return where the GeoJSON simplified to `tolerance` goes; only the
+    default tolerance's output has a name the importer looks for
+    """
+    stem = re.sub(r'\.kml$', '', kml_path, flags=re.I)
+    if default:
+        return "%s_simplified.geojson" % stem
+    return "%s_simplified_%s.geojson" % (stem, tolerance)
+
+
+def local_name(element):
+    return etree.QName(element).localname
+
+
+def iter_placemarks(path):
+    """Yield (name, polygons) for each Placemark in the KML at `path`.
+
+    Each polygon is a list of rings, the outer one first; each ring is
+    an array of (longitude, latitude) points.
+
+    """
+    for _, element in etree.iterparse(
+            path, events=('end',), tag='{*}Placemark', huge_tree=True):
+        name = None
+        polygons = []
+        for child in element.iter():
+            if not isinstance(child.tag, basestring):
+                continue
+            tag = local_name(child)
+            if tag == 'name' and name is None:
+                name = (child.text or '').strip()
+            elif tag == 'Polygon':
+                polygons.append(polygon_rings(child))
+        # Free what we've read, including the references lxml keeps
+        # from the parent to earlier siblings
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if not name:
+            raise KmlError("Placemark without a name in %s" % path)
+        yield name, polygons
+
+
+def polygon_rings(polygon):
+    outer = []
+    inner = []
+    for boundary in polygon:
+        if not isinstance(boundary.tag, basestring):
+            continue
+        tag = local_name(boundary)
+        if tag not in ('outerBoundaryIs', 'innerBoundaryIs'):
+            continue
+        for coordinates in boundary.iter('{*}coordinates'):
+            ring = parse_coordinates(coordinates.text or '')
+            (outer if tag == 'outerBoundaryIs' else inner).append(ring)
+    return outer + inner
+
+
+def parse_coordinates(text):
+    """Parse a KML coordinates string of `lon,lat[,alt]` tuples
+    """
+    points = [point.split(',')[:2] for point in text.split()]
+    return np.array(points, dtype=float).reshape(-1, 2)
+
+
+def simplify(points, tolerance):
+    """Return `points` with those closer than `tolerance` to the line
+    between their neighbours removed, by Douglas-Peucker
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[start + 1:end]
+        a = points[start]
+        b = points[end]
+        ab = b - a
+        length = np.hypot(ab[0], ab[1])
+        if length == 0:
+            # A closed ring: measure from the shared end point
+            distances = np.hypot(
+                segment[:, 0] - a[0], segment[:, 1] - a[1])
+        else:
+            distances = np.abs(
+                ab[0] * (segment[:, 1] - a[1]) -
+                ab[1] * (segment[:, 0] - a[0])) / length
+        i = np.argmax(distances)
+        if distances[i] > tolerance:
+            middle = start + 1 + i
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+    return points[keep]
+
+
+def simplify_polygon(rings, tolerance):
+    """Simplify each ring of a polygon, dropping holes that vanish and
+    keeping the outer ring unsimplified if simplifying would destroy it
+    """
+    simplified = []
+    for i, ring in enumerate(rings):
+        result = simplify(ring, tolerance)
+        if len(result) < 4:
+            if i > 0:
+                continue
+            result = ring
+        simplified.append(result)
+    return simplified
+
+
+def feature(name, polygons, tolerance):
+    polygons = [simplify_polygon(rings, tolerance)
+                for rings in polygons if rings]
+    points = np.concatenate(
+        [ring for rings in polygons for ring in rings]) \
+        if polygons else np.zeros((0, 2))
+    bbox = [round(float(v), PRECISION) for v in
+            list(points.min(axis=0)) + list(points.max(axis=0))] \
+        if len(points) else None
+    return {
+        'type': 'Feature',
+        'id': name,
+        'bbox': bbox,
+        'properties': {'Name': name, 'code': name, 'bbox': bbox},
+        'geometry': {
+            'type': 'MultiPolygon',
+            'coordinates': [
+                [np.round(ring, PRECISION).tolist() for ring in rings]
+                for rings in polygons],
+        },
+    }
+
+
+def convert(kml_path, tolerances=DEFAULT_TOLERANCES):
+    """Write GeoJSON versions of `kml_path` simplified to each of
+    `tolerances`, the first being the default, returning their paths.
+
+    Features are written as they are read, so only one boundary is in
+    memory at a time.
+
+    """
+    paths = [output_path(kml_path, t, default=(i == 0))
+             for i, t in enumerate(tolerances)]
+    outputs = []
+    try:
+        for path in paths:
+            outputs.append(open(path + '.part', 'wb'))
+        for output in outputs:
+            output.write('{"type":"FeatureCollection","features":[\n')
+        first = True
+        for name, polygons in iter_placemarks(kml_path):
+            for output, tolerance in zip(outputs, tolerances):
+                if not first:
+                    output.write(',\n')
+                json.dump(feature(name, polygons, tolerance), output,
+                          separators=(',', ':'))
+            first = False
+        for output in outputs:
+            output.write('\n]}\n')
+    except BaseException:
+        # Don't leave partial GeoJSON where importers would find it
+        for output in outputs:
+            output.close()
+            os.remove(output.name)
+        raise
+    finally:
+        for output in outputs:
+            output.close()
+    for path in paths:
+        os.rename(path + '.part', path)
+    return paths
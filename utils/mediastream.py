@@ -0,0 +1,75 @@
+"""Resumable uploads of data that is produced as it's sent, such as a
+bundle compressed on the fly, without a copy of it on disk.
+
+This imports the Google API client, so is itself imported where it's
+needed.
+
+"""
+from apiclient.http import MediaUpload
+
+
+class StreamUploadError(StandardError):
+    pass
+
+
+class MediaStreamUpload(MediaUpload):
+    """Upload the strings yielded by `chunks`, `chunksize` bytes at a
+    time.
+
+    The client asks for each chunk of an upload by its offset, and
+    after an error starts again from the last offset the server
+    confirmed, so only data from the chunk being sent on is kept. One
+    more chunk is read ahead, so that the total size is known before
+    the last chunk is sent.
+
+    """
+    def __init__(self, chunks, mimetype, chunksize):
+        self._chunks = iter(chunks)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = ''
+        # Offset in the upload of the start of the buffer
+        self._start = 0
+        self._size = None
+        self._fill(2 * chunksize + 1)
+
+    def _fill(self, end):
+        """Read from `chunks` until the buffer reaches offset `end`, or
+        they run out
+        """
+        parts = [self._buffer]
+        length = self._start + len(self._buffer)
+        while self._size is None and length < end:
+            try:
+                data = next(self._chunks)
+            except StopIteration:
+                self._size = length
+                break
+            parts.append(data)
+            length += len(data)
+        self._buffer = ''.join(parts)
+
+    def getbytes(self, begin, length):
+        if begin < self._start:
+            raise StreamUploadError(
+                "Asked to send data from offset %s again, but it has "
+                "already been dropped" % begin)
+        self._buffer = self._buffer[begin - self._start:]
+        self._start = begin
+        self._fill(begin + 2 * length + 1)
+        return self._buffer[:length]
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
@@ -0,0 +1,231 @@
+"""`manifest.json`, checked and compiled into a plan.
+
+Compiling the manifest checks it against what the runner expects, and
+works out the order to run sources in, so mistakes are reported before
+anything runs rather than hours into an import. Each importer command
+is split up once, to find its filename regex.
+
+The compiled plan is cached on disk, and reused while the manifest's
+mtime and size, or failing that its hash, are unchanged.
+
+"""
+import cPickle as pickle
+import hashlib
+import heapq
+import json
+import os
+import re
+import shlex
+
+MANIFEST = 'manifest.json'
+CACHE_FILE = '.manifest_plan.pickle'
+# Bump when the layout of the plan changes, to invalidate caches
+VERSION = 1
+FILENAME_FLAGS = [
+    'filename', 'ccg', 'epraccur', 'chem_file', 'hscic_address',
+    'month_from_prescribing_filename']
+# Types of the fields the runner uses; other fields are documentation
+FIELD_TYPES = {
+    'id': basestring,
+    'fetcher': basestring,
+    'data_dir': basestring,
+    'importers': list,
+    'before_import': list,
+    'after_import': list,
+    'depends_on': list,
+    'tags': list,
+    'always_import': bool,
+}
+REQUIRED_FIELDS = ['id', 'title']
+
+
+class ManifestError(StandardError):
+    pass
+
+
+def parse_importer(cmd_string):
+    """Return a tuple of the filename flag and regex in the importer
+    command `cmd_string`
+    """
+    # We quote before splitting, to preserve regex backslashes
+    # specified in the JSON
+    cmd_parts = shlex.split(cmd_string.encode('unicode-escape'))
+    found = None
+    for flag in FILENAME_FLAGS:
+        try:
+            found = (flag, cmd_parts[cmd_parts.index("--%s" % flag) + 1])
+        except (ValueError, IndexError):
+            pass
+    if not found:
+        raise ManifestError(
+            "Couldn't find a filename argument in %s" % cmd_string)
+    return found
+
+
+class Plan(object):
+    """A checked manifest: its sources, the order to run them in, and
+    the filename flag and regex of every importer
+    """
+    def __init__(self, sources, order, importers):
+        self.sources = sources
+        self.order = order
+        self.importers = importers
+        self._regexes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_regexes'] = {}
+        return state
+
+    def filename_arg(self, cmd_string):
+        """Return the filename regex of `cmd_string`, which needn't be
+        one of the manifest's importers
+        """
+        if cmd_string not in self.importers:
+            self.importers[cmd_string] = parse_importer(cmd_string)
+        return self.importers[cmd_string][1]
+
+    def regex(self, pattern):
+        """Return `pattern` compiled
+        """
+        if pattern not in self._regexes:
+            self._regexes[pattern] = re.compile(pattern)
+        return self._regexes[pattern]
+
+
+def compile_manifest(sources):
+    """Check `sources`, as loaded from the manifest, and return a Plan;
+    raise ManifestError listing every problem found
+    """
+    errors = []
+    if not isinstance(sources, list):
+        raise ManifestError("The manifest should be a list of sources")
+    ids = []
+    importers = {}
+    for i, source in enumerate(sources):
+        if not isinstance(source, dict):
+            errors.append("Source %s isn't an object" % i)
+            continue
+        name = source.get('id', "number %s" % i)
+        for field in REQUIRED_FIELDS:
+            if field not in source:
+                errors.append("Source %s has no `%s`" % (name, field))
+        for field, expected in FIELD_TYPES.items():
+            if field in source and not isinstance(source[field], expected):
+                errors.append("`%s` of source %s should be a %s" % (
+                    field, name, expected.__name__))
+        for field in ['importers', 'before_import', 'after_import',
+                      'depends_on', 'tags']:
+            values = source.get(field, [])
+            if isinstance(values, list) and \
+                    not all(isinstance(v, basestring) for v in values):
+                errors.append("`%s` of source %s should be a list of "
+                              "strings" % (field, name))
+        if name in ids:
+            errors.append("Source %s is defined more than once" % name)
+        ids.append(name)
+        for importer in source.get('importers', []):
+            if not isinstance(importer, basestring) or \
+                    importer.startswith('runner:'):
+                continue
+            try:
+                importers[importer] = parse_importer(importer)
+                re.compile(importers[importer][1])
+            except ManifestError as e:
+                errors.append("Source %s: %s" % (name, e))
+            except re.error as e:
+                errors.append("Source %s: bad filename regex in %s: %s" % (
+                    name, importer, e))
+    for source in sources:
+        if not isinstance(source, dict):
+            continue
+        for parent in source.get('depends_on', []):
+            if parent not in ids:
+                errors.append("Source %s depends on unknown source %s" % (
+                    source.get('id'), parent))
+    if errors:
+        raise ManifestError(
+            "Problems with the manifest:\n  " + "\n  ".join(errors))
+    order = dependency_order(sources)
+    return Plan(sources, order, importers)
+
+
+def dependency_order(sources):
+    """Return the ids of `sources` so each comes after those it depends
+    on, otherwise in manifest order; raise ManifestError on a cycle
+    """
+    ids = [s['id'] for s in sources]
+    position = dict((source_id, i) for i, source_id in enumerate(ids))
+    # Number of each source's parents not yet in the order
+    waiting = {}
+    children = dict((source_id, []) for source_id in ids)
+    for source in sources:
+        parents = set(source.get('depends_on', []))
+        waiting[source['id']] = len(parents)
+        for parent in parents:
+            children[parent].append(source['id'])
+    # Positions of the sources that are ready, earliest first
+    ready = [position[i] for i in ids if not waiting[i]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        source_id = ids[heapq.heappop(ready)]
+        order.append(source_id)
+        for child in children[source_id]:
+            waiting[child] -= 1
+            if not waiting[child]:
+                heapq.heappush(ready, position[child])
+    if len(order) < len(ids):
+        raise ManifestError(
+            "Dependency cycle among sources: %s" % ", ".join(
+                i for i in ids if waiting[i]))
+    return order
+
+
+def load_plan(manifest=MANIFEST, cache_file=CACHE_FILE):
+    """Return the Plan for `manifest`, from the cache if it's current
+    """
+    stat = os.stat(manifest)
+    cached = read_cache(cache_file)
+    if cached and cached['version'] == VERSION and \
+            (cached['mtime'], cached['size']) == (stat.st_mtime, stat.st_size):
+        return cached['plan']
+    with open(manifest, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if cached and cached['version'] == VERSION and cached['sha256'] == digest:
+        plan = cached['plan']
+    else:
+        try:
+            sources = json.loads(content)
+        except ValueError as e:
+            raise ManifestError("%s isn't valid JSON: %s" % (manifest, e))
+        plan = compile_manifest(sources)
+    write_cache(cache_file, {
+        'version': VERSION,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha256': digest,
+        'plan': plan,
+    })
+    return plan
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, KeyError, ValueError):
+        return None
+
+
+def write_cache(cache_file, cached):
+    partial = "%s.%s.part" % (cache_file, os.getpid())
+    try:
+        with open(partial, 'wb') as f:
+            pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(partial, cache_file)
+    except (IOError, OSError):
+        # Caching is only an optimisation
+        pass
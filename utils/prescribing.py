@@ -0,0 +1,213 @@
+"""Convert NHSBSA detailed prescribing data to our formatted CSV.
+
+`Detailed_Prescribing_Information.csv` has a row for every distinct
+quantity of a presentation prescribed by a practice. We sum these to one
+row per practice and presentation, with the columns in
+`schemas/prescribing.json`.
+
+The input is read in chunks of raw lines, which are parsed and
+aggregated by a pool of processes and written back in order. A
+practice's rows are contiguous in the input, so only the rows for the
+practice at the end of each chunk need carrying over to the next one;
+memory use is bounded by the chunk size whatever the size of the file.
+Input where a practice's rows are split up is rejected, rather than
+converted into duplicate rows.
+
+"""
+import collections
+import csv
+import itertools
+import json
+import os
+import re
+from multiprocessing import Pool, cpu_count
+
+# Number of input lines given to a process at a time
+CHUNK_ROWS = 200000
+
+# Input column for each output column, by normalised header name
+SOURCE_COLUMNS = {
+    'sha': 'area_team_code',
+    'pct': 'pco_code',
+    'practice': 'practice_code',
+    'bnf_code': 'bnf_code',
+    'bnf_name': 'bnf_description',
+    'items': 'items',
+    'net_cost': 'nic',
+    'actual_cost': 'actual_cost',
+    'quantity': 'quantity',
+}
+
+
+class ConversionError(StandardError):
+    pass
+
+
+def output_columns():
+    with open(os.path.join(
+            os.path.dirname(__file__), '..', 'schemas', 'prescribing.json'),
+            'rb') as f:
+        return [field['name'] for field in json.load(f)]
+
+
+def formatted_path(path):
+    """Return the path of the formatted version of the detailed data at
+    `path`
+    """
+    return re.sub(r'\.csv$', '_formatted.CSV', path, flags=re.I)
+
+
+def period_for(path):
+    """Return the YYYYMM period of the data at `path`, from the name of
+    the month directory it's in
+    """
+    match = re.search(r'(\d{4})_(\d{2})/[^/]*$', path)
+    if not match:
+        raise ConversionError(
+            "Can't tell which month %s is for" % path)
+    return "%s%s" % match.groups()
+
+
+def convert(path, processes=None, chunk_rows=CHUNK_ROWS):
+    """Convert the detailed prescribing data at `path`, writing it to
+    `formatted_path(path)`.
+
+    """
+    target = formatted_path(path)
+    partial = target + '.part'
+    period = period_for(path)
+    # Stop reading ahead of what we've written, so that we never hold
+    # more than a few chunks in memory
+    max_in_flight = (processes or cpu_count()) * 2
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline()]))
+        indexes = column_indexes(header)
+        pool = Pool(processes)
+        try:
+            with open(partial, 'wb') as out:
+                writer = csv.writer(out)
+                writer.writerow(output_columns())
+                carried = []
+                # Practices whose rows have all been written
+                flushed = set()
+                in_flight = collections.deque()
+                while True:
+                    while len(in_flight) < max_in_flight:
+                        lines = list(itertools.islice(f, chunk_rows))
+                        if not lines:
+                            break
+                        in_flight.append(pool.apply_async(
+                            aggregate_chunk, [(indexes, lines)]))
+                    if not in_flight:
+                        break
+                    rows = in_flight.popleft().get(2 ** 31)
+                    if not rows:
+                        continue
+                    check_contiguous(rows, flushed)
+                    if carried and carried[0][0] == rows[0][0]:
+                        rows = merge(carried + rows)
+                    else:
+                        write_rows(writer, carried, period)
+                        flushed.update(r[0] for r in carried)
+                    carried = [r for r in rows if r[0] == rows[-1][0]]
+                    done = rows[:len(rows) - len(carried)]
+                    write_rows(writer, done, period)
+                    flushed.update(r[0] for r in done)
+                write_rows(writer, carried, period)
+        except BaseException:
+            # Don't leave a truncated file where importers would find it
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        finally:
+            pool.terminate()
+    os.rename(partial, target)
+    return target
+
+
+def column_indexes(header):
+    normalised = [
+        re.sub(r'\W+', '_', name.strip().lower()).strip('_')
+        for name in header]
+    indexes = {}
+    for column, source in SOURCE_COLUMNS.items():
+        try:
+            indexes[column] = normalised.index(source)
+        except ValueError:
+            raise ConversionError(
+                "No %s column in header %s" % (source, header))
+    return indexes
+
+
+def aggregate_chunk(args):
+    """Parse raw CSV `lines` and sum them by practice and presentation.
+
+    Returns a list of [practice, bnf_code, sha, pct, bnf_name, items,
+    net_cost, actual_cost, quantity] rows, in order of each key's first
+    appearance.
+
+    """
+    indexes, lines = args
+    totals = {}
+    order = []
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        key = (row[indexes['practice']].strip(),
+               row[indexes['bnf_code']].strip())
+        items = int(row[indexes['items']])
+        values = [items,
+                  float(row[indexes['net_cost']]),
+                  float(row[indexes['actual_cost']]),
+                  # Quantity is given per item
+                  float(row[indexes['quantity']]) * items]
+        if key in totals:
+            total = totals[key]
+            for i, value in enumerate(values):
+                total[i] += value
+        else:
+            totals[key] = values
+            order.append((key, (
+                row[indexes['sha']].strip(),
+                # CCG codes are the first three characters of PCO codes
+                row[indexes['pct']].strip()[:3],
+                row[indexes['bnf_name']].strip())))
+    return [list(key) + list(names) + totals[key] for key, names in order]
+
+
+def check_contiguous(rows, flushed):
+    """Raise ConversionError if any of `rows` is for a practice in
+    `flushed`, whose rows have already been written
+    """
+    reappeared = set(row[0] for row in rows) & flushed
+    if reappeared:
+        raise ConversionError(
+            "Rows for practice(s) %s aren't contiguous in the input" %
+            ", ".join(sorted(reappeared)))
+
+
+def merge(rows):
+    """Sum any rows of `rows` with the same practice and presentation
+    """
+    merged = {}
+    order = []
+    for row in rows:
+        key = (row[0], row[1])
+        if key in merged:
+            for i in range(5, 9):
+                merged[key][i] += row[i]
+        else:
+            merged[key] = list(row)
+            order.append(key)
+    return [merged[key] for key in order]
+
+
+def write_rows(writer, rows, period):
+    for (practice, bnf_code, sha, pct, bnf_name,
+         items, net_cost, actual_cost, quantity) in rows:
+        writer.writerow([
+            sha, pct, practice, bnf_code, bnf_name, items,
+            '%.2f' % net_cost, '%.2f' % actual_cost,
+            # The schema has quantity as an integer
+            int(round(quantity)),
+            period, ''])
@@ -0,0 +1,314 @@
+"""Answer the smoketests' aggregations from the local column cache.
+
+Every query in `smoketests/*.sql` sums items, actual_cost and quantity
+by month for the rows whose BNF code equals or starts with one of a few
+values, optionally for one practice or CCG. For each month we keep the
+rows' order sorted by BNF code, and by practice and by pct, with the
+offset at which each code starts. A filter on a code or code prefix is
+then one or more contiguous slices of that order; we take the slices of
+the most selective filter and check the others against the rows in
+them.
+
+Indexes are stored next to the month's columns, so they're rebuilt
+whenever the column cache is.
+
+"""
+import bisect
+import os
+import re
+
+import numpy as np
+
+from columns import ColumnCache
+
+# Sorts after any character in a code, for finding the end of a prefix
+HIGHEST = u'\uffff'
+
+
+class QueryError(StandardError):
+    pass
+
+
+class CodeIndex(object):
+    """The rows of a month in order of one code column.
+
+    `order` lists row numbers; the rows with the i'th code in sorted
+    order are `order[starts[i]:starts[i + 1]]`.
+
+    """
+    def __init__(self, month, name):
+        self.values = month.values(name)
+        self.sorted_values = sorted(self.values)
+        by_value = dict((value, i) for i, value in enumerate(self.values))
+        # Dictionary index of each code, in sorted order of code
+        self.sorted_indexes = np.array(
+            [by_value[value] for value in self.sorted_values],
+            dtype=np.int32)
+        self.order, self.starts = self._load_or_build(month, name)
+
+    def _load_or_build(self, month, name):
+        path = os.path.join(month.path, '%s.index.npz' % name)
+        try:
+            saved = np.load(path)
+            return saved['order'], saved['starts']
+        except IOError:
+            pass
+        codes = month.column(name)
+        rank = np.empty(len(self.values), dtype=np.int32)
+        rank[self.sorted_indexes] = np.arange(len(self.values))
+        order = np.argsort(rank[codes], kind='mergesort').astype(np.int32)
+        counts = np.bincount(codes, minlength=len(self.values))
+        starts = np.concatenate(
+            [[0], np.cumsum(counts[self.sorted_indexes])]).astype(np.int64)
+        # Save under a temporary name then rename, in case another
+        # process is building the same index
+        partial = '%s.%s.part.npz' % (path[:-len('.npz')], os.getpid())
+        np.savez(partial, order=order, starts=starts)
+        os.rename(partial, path)
+        return order, starts
+
+    def ranges(self, exact=(), prefixes=()):
+        """Return sorted, non-overlapping (start, stop) ranges of sorted
+        code positions matching any of `exact` or `prefixes`
+        """
+        ranges = []
+        for value in exact:
+            value = unicode(value)
+            ranges.append((
+                bisect.bisect_left(self.sorted_values, value),
+                bisect.bisect_right(self.sorted_values, value)))
+        for prefix in prefixes:
+            prefix = unicode(prefix)
+            ranges.append((
+                bisect.bisect_left(self.sorted_values, prefix),
+                bisect.bisect_left(self.sorted_values, prefix + HIGHEST)))
+        merged = []
+        for start, stop in sorted(r for r in ranges if r[0] < r[1]):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def row_count(self, ranges):
+        return sum(
+            self.starts[stop] - self.starts[start] for start, stop in ranges)
+
+    def rows(self, ranges):
+        if not ranges:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate([
+            self.order[self.starts[start]:self.starts[stop]]
+            for start, stop in ranges])
+
+    def wanted(self, ranges):
+        """Return a boolean array saying which dictionary indexes are in
+        `ranges`
+        """
+        wanted = np.zeros(len(self.values), dtype=bool)
+        for start, stop in ranges:
+            wanted[self.sorted_indexes[start:stop]] = True
+        return wanted
+
+
+class QueryEngine(object):
+    def __init__(self, basedir):
+        self.cache = ColumnCache(basedir)
+        self._indexes = {}
+
+    def index(self, month, name):
+        key = (month.path, month.meta['sha256'], name)
+        if key not in self._indexes:
+            self._indexes[key] = CodeIndex(month, name)
+        return self._indexes[key]
+
+    def aggregate(self, bnf_codes=(), bnf_prefixes=(), practice=None,
+                  pct=None, since=None, until=None):
+        """Return the total items, actual_cost and quantity for each
+        month, oldest first, of rows matching all the given filters.
+
+        Rows match the BNF filter if their code is one of `bnf_codes`
+        or starts with one of `bnf_prefixes`. `since` and `until` are
+        YYYY_MM months; `since` is exclusive and `until` inclusive, to
+        match the smoketests' date condition. As with SQL, months with
+        no matching rows are left out.
+
+        """
+        filters = {}
+        if bnf_codes or bnf_prefixes:
+            filters['bnf_code'] = (bnf_codes, bnf_prefixes)
+        if practice:
+            filters['practice'] = ([practice], ())
+        if pct:
+            filters['pct'] = ([pct], ())
+        results = []
+        for name in self.cache.months():
+            if since and name <= since:
+                continue
+            if until and name > until:
+                continue
+            month = self.cache.month(name)
+            rows = self.matching_rows(month, filters)
+            if rows is not None and not len(rows):
+                continue
+            totals = {}
+            for column in ['items', 'actual_cost', 'quantity']:
+                values = month.column(column)
+                totals[column] = values.sum() if rows is None \
+                    else values[rows].sum()
+            results.append({
+                'month': '%s-%s-01' % tuple(name.split('_')),
+                'items': int(totals['items']),
+                'actual_cost': float(totals['actual_cost']),
+                'quantity': int(totals['quantity']),
+            })
+        return results
+
+    def matching_rows(self, month, filters):
+        """Return the numbers of the rows of `month` matching every one
+        of `filters`, or None if there are no filters
+        """
+        if not filters:
+            return None
+        ranges = {}
+        for name, (exact, prefixes) in filters.items():
+            ranges[name] = self.index(month, name).ranges(exact, prefixes)
+        # Start from the filter matching fewest rows
+        driver = min(
+            ranges, key=lambda n: self.index(month, n).row_count(ranges[n]))
+        rows = self.index(month, driver).rows(ranges[driver])
+        for name in ranges:
+            if name == driver or not len(rows):
+                continue
+            wanted = self.index(month, name).wanted(ranges[name])
+            rows = rows[wanted[month.column(name)[rows]]]
+        return rows
+
+
+# The parts of a smoketest's WHERE clause, in the order they're tried
+WHERE_TOKENS = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<prefix>bnf_code\s+LIKE\s+'(?P<prefix_value>\w+)%')
+  | (?P<equals>(?P<column>bnf_code|practice|pct)\s*=\s*'(?P<value>\w+)')
+  | (?P<date>\{\{\s*date_condition\s*\}\})
+  | (?P<op>\bAND\b|\bOR\b|[()])
+""", re.X)
+
+
+def parse_smoketest(sql):
+    """Return the arguments to `QueryEngine.aggregate` equivalent to
+    the WHERE clause of the smoketest query `sql`.
+
+    The clause must AND together the date condition, at most one
+    practice and one pct, and one BNF code condition, which may be
+    several BNF codes or prefixes ORed together. Raise QueryError if
+    the query isn't of this form.
+
+    """
+    if not re.search(r'FROM\s+`hscic\.prescribing`', sql) or \
+            not re.search(r'GROUP\s+BY\s+month', sql):
+        raise QueryError("Not a monthly prescribing aggregation")
+    match = re.search(r'WHERE(.*?)(GROUP\s+BY|ORDER\s+BY|$)', sql, re.S)
+    if not match:
+        raise QueryError("No WHERE clause")
+    where = match.group(1)
+    tokens = tokenise_where(where)
+    tree = parse_or(tokens, where)
+    if tokens:
+        raise QueryError("Don't understand %r in %s" % (tokens[0], where))
+    args = {'bnf_prefixes': [], 'bnf_codes': [],
+            'practice': None, 'pct': None}
+    bnf_conditions = 0
+    for condition in flatten(tree, 'AND'):
+        if condition[0] == 'date':
+            continue
+        if condition[0] == 'OR':
+            terms = flatten(condition, 'OR')
+        else:
+            terms = [condition]
+        if all(term[0] == 'bnf_code' for term in terms):
+            bnf_conditions += 1
+            for _, kind, value in terms:
+                args[kind].append(value)
+        elif condition[0] in ('practice', 'pct'):
+            if args[condition[0]]:
+                raise QueryError(
+                    "More than one %s in %s" % (condition[0], where))
+            args[condition[0]] = condition[1]
+        else:
+            raise QueryError(
+                "Only BNF codes can be ORed together in %s" % where)
+    if bnf_conditions > 1:
+        raise QueryError("More than one BNF code condition in %s" % where)
+    return args
+
+
+def tokenise_where(where):
+    """Split `where` into AND, OR, parentheses and condition tuples:
+    ('bnf_code', 'bnf_prefixes' or 'bnf_codes', value), ('practice',
+    value), ('pct', value) and ('date',)
+    """
+    tokens = []
+    position = 0
+    while position < len(where):
+        match = WHERE_TOKENS.match(where, position)
+        if not match:
+            raise QueryError(
+                "Don't understand %r in %s" % (where[position:], where))
+        position = match.end()
+        if match.group('prefix'):
+            tokens.append(
+                ('bnf_code', 'bnf_prefixes', match.group('prefix_value')))
+        elif match.group('column') == 'bnf_code':
+            tokens.append(('bnf_code', 'bnf_codes', match.group('value')))
+        elif match.group('equals'):
+            tokens.append((match.group('column'), match.group('value')))
+        elif match.group('date'):
+            tokens.append(('date',))
+        elif match.group('op'):
+            tokens.append(match.group('op').upper())
+    return tokens
+
+
+def parse_or(tokens, where):
+    """Consume an expression from the start of `tokens`, returning it
+    as a condition tuple or an ('AND', ...) or ('OR', ...) tree
+    """
+    operands = [parse_and(tokens, where)]
+    while tokens and tokens[0] == 'OR':
+        tokens.pop(0)
+        operands.append(parse_and(tokens, where))
+    return operands[0] if len(operands) == 1 else ('OR',) + tuple(operands)
+
+
+def parse_and(tokens, where):
+    operands = [parse_operand(tokens, where)]
+    while tokens and tokens[0] == 'AND':
+        tokens.pop(0)
+        operands.append(parse_operand(tokens, where))
+    return operands[0] if len(operands) == 1 else ('AND',) + tuple(operands)
+
+
+def parse_operand(tokens, where):
+    if not tokens:
+        raise QueryError("Unexpected end of %s" % where)
+    token = tokens.pop(0)
+    if token == '(':
+        expression = parse_or(tokens, where)
+        if not tokens or tokens.pop(0) != ')':
+            raise QueryError("Unbalanced parentheses in %s" % where)
+        return expression
+    if isinstance(token, tuple):
+        return token
+    raise QueryError("Don't understand %r in %s" % (token, where))
+
+
+def flatten(tree, operator):
+    """Return the operands of nested `operator`s at the top of `tree`
+    """
+    if tree[0] != operator:
+        return [tree]
+    operands = []
+    for operand in tree[1:]:
+        operands.extend(flatten(operand, operator))
+    return operands
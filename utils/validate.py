@@ -0,0 +1,146 @@
+"""Check CSVs against the schemas in `schemas/` before they go to
+BigQuery.
+
+A malformed row otherwise only shows up as a failed load job, after
+we've uploaded the file and waited for the load. Files are read in
+chunks, and each chunk is checked a column at a time, so the common
+case of a clean column costs a single pass of a compiled regex.
+
+"""
+import csv
+import itertools
+import json
+import os
+import re
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), '..', 'schemas')
+# Number of rows to check at a time
+CHUNK_ROWS = 100000
+# Stop after finding this many problems
+MAX_ERRORS = 20
+# Which schema each kind of file we load into BigQuery should match
+SCHEMAS_BY_FILENAME = [
+    (r'Detailed_Prescribing_Information_formatted\.CSV$', 'prescribing.json'),
+    (r'bnf_codes\.csv$', 'bnf.json'),
+]
+# Patterns that values of each type must match, as BigQuery parses them
+TYPE_PATTERNS = {
+    'integer': re.compile(r'\s*[-+]?\d+\s*$'),
+    'float': re.compile(
+        r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'),
+}
+
+
+class ValidationError(StandardError):
+    def __init__(self, path, errors):
+        self.path = path
+        self.errors = errors
+        super(ValidationError, self).__init__(
+            "%s doesn't match its schema:\n%s" % (
+                path, "\n".join(
+                    "  line %s: %s" % error for error in errors)))
+
+
+def schema_for(path):
+    """Return the name of the schema `path` should match, or None
+    """
+    for regex, schema in SCHEMAS_BY_FILENAME:
+        if re.search(regex, path):
+            return schema
+    return None
+
+
+def load_schema(schema):
+    with open(os.path.join(SCHEMA_DIR, schema), 'rb') as f:
+        return json.load(f)
+
+
+def validate(path, schema, skip_leading_rows=1, max_errors=MAX_ERRORS,
+             chunk_rows=CHUNK_ROWS):
+    """Raise ValidationError listing the first `max_errors` problems
+    with the CSV at `path`, if it doesn't match `schema`.
+
+    """
+    errors = find_errors(path, schema, skip_leading_rows=skip_leading_rows,
+                         max_errors=max_errors, chunk_rows=chunk_rows)
+    if errors:
+        raise ValidationError(path, errors)
+
+
+def find_errors(path, schema, skip_leading_rows=1, max_errors=MAX_ERRORS,
+                chunk_rows=CHUNK_ROWS):
+    """Return a list of up to `max_errors` (line number, message) tuples
+    describing where the CSV at `path` doesn't match `schema`.
+
+    """
+    fields = load_schema(schema)
+    errors = []
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        for _ in itertools.islice(reader, skip_leading_rows):
+            pass
+        while len(errors) < max_errors:
+            rows = []
+            line_numbers = []
+            for row in itertools.islice(reader, chunk_rows):
+                rows.append(row)
+                line_numbers.append(reader.line_num)
+            if not rows:
+                break
+            errors.extend(check_chunk(fields, rows, line_numbers))
+    return sorted(errors)[:max_errors]
+
+
+def check_chunk(fields, rows, line_numbers):
+    """Return (line number, message) tuples for every problem in `rows`
+    """
+    errors = []
+    width = len(fields)
+    lengths = map(len, rows)
+    if lengths.count(width) != len(rows):
+        bad = set()
+        for i, length in enumerate(lengths):
+            if length != width:
+                bad.add(i)
+                errors.append((
+                    line_numbers[i],
+                    "expected %s columns, found %s" % (width, length)))
+        # The remaining checks can't say which field is which in these
+        rows = [row for i, row in enumerate(rows) if i not in bad]
+        line_numbers = [
+            n for i, n in enumerate(line_numbers) if i not in bad]
+        if not rows:
+            return errors
+    for field, column in zip(fields, zip(*rows)):
+        errors.extend(
+            (line_numbers[i], message)
+            for i, message in check_column(field, column))
+    return errors
+
+
+def check_column(field, column):
+    """Return (row index, message) tuples for each value in `column`
+    that doesn't fit `field`
+    """
+    errors = []
+    name = field['name']
+    required = field.get('mode', 'nullable').lower() == 'required'
+    if required and not all(column):
+        errors.extend(
+            (i, "%s is required" % name)
+            for i, value in enumerate(column) if not value)
+    pattern = TYPE_PATTERNS.get(field.get('type', 'string').lower())
+    if pattern and not all(map(pattern.match, filter(None, column))):
+        errors.extend(
+            (i, "%s should be %s, not %r" % (name, field['type'], value))
+            for i, value in enumerate(column)
+            if value and not pattern.match(value))
+    max_length = field.get('maxLength')
+    # A value has at least as many bytes as characters, so only decode
+    # when some value might be too long
+    if max_length and max(map(len, column)) > int(max_length):
+        errors.extend(
+            (i, "%s is longer than %s characters" % (name, max_length))
+            for i, value in enumerate(column)
+            if len(value.decode('utf-8', 'replace')) > int(max_length))
+    return errors
@@ -0,0 +1,291 @@
+"""A work queue of runner steps, kept in SQLite so that several runner
+processes can share it.
+
+Each step is a command plus the steps it depends on. A worker claims a
+ready step by taking a lease on it, and renews the lease with
+heartbeats while the step runs; if the worker dies, the lease expires
+and another worker can claim the step. Claims happen inside an
+IMMEDIATE transaction, so two workers never claim the same step.
+
+The database uses SQLite's default rollback journal rather than WAL,
+which doesn't work on network filesystems, so workers on different
+machines can share a queue on a shared volume.
+
+"""
+import collections
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Seconds a claim lasts without a heartbeat
+LEASE_SECONDS = 5 * 60
+# Times a step is tried before it's marked failed
+MAX_ATTEMPTS = 2
+# Seconds to wait for another process to release the database
+DB_TIMEOUT = 60
+# Seconds to wait before trying again to renew a lease after a
+# database error
+HEARTBEAT_RETRY_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    command TEXT NOT NULL,
+    input_file TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS edges (
+    step INTEGER NOT NULL REFERENCES steps(id),
+    depends_on INTEGER NOT NULL REFERENCES steps(id),
+    PRIMARY KEY (step, depends_on)
+);
+CREATE INDEX IF NOT EXISTS steps_by_state ON steps (state);
+"""
+
+Step = collections.namedtuple(
+    'Step', ['id', 'source', 'kind', 'command', 'input_file', 'attempts'])
+
+
+class QueueError(StandardError):
+    pass
+
+
+class LeaseLost(QueueError):
+    pass
+
+
+def worker_id():
+    return "%s:%s:%s" % (
+        socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # SQLite connections can't be shared between threads
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        if not hasattr(self.local, 'db'):
+            self.local.db = sqlite3.connect(
+                self.path, timeout=DB_TIMEOUT, isolation_level=None)
+        return self.local.db
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def reset(self):
+        """Empty the queue, which must have nothing left to do
+        """
+        with self.transaction() as db:
+            unfinished = db.execute(
+                "SELECT count(*) FROM steps "
+                "WHERE state IN ('pending', 'running')").fetchone()[0]
+            if unfinished:
+                raise QueueError(
+                    "%s steps in %s are unfinished" % (unfinished, self.path))
+            db.execute("DELETE FROM edges")
+            db.execute("DELETE FROM steps")
+
+    def add(self, source, kind, command, input_file=None, depends_on=()):
+        """Add a step, returning its id
+        """
+        with self.transaction() as db:
+            step_id = db.execute(
+                "INSERT INTO steps (source, kind, command, input_file) "
+                "VALUES (?, ?, ?, ?)",
+                (source, kind, command, input_file)).lastrowid
+            db.executemany(
+                "INSERT OR IGNORE INTO edges (step, depends_on) "
+                "VALUES (?, ?)",
+                [(step_id, parent) for parent in set(depends_on)])
+        return step_id
+
+    def claim(self, owner):
+        """Lease the next step whose dependencies are done to `owner`,
+        returning it, or None if no step is ready
+        """
+        now = time.time()
+        with self.transaction() as db:
+            # Give up on workers that have stopped sending heartbeats
+            db.execute(
+                "UPDATE steps SET lease_owner = NULL, state = CASE "
+                "  WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = 'Worker ' || lease_owner || ' lost its lease' "
+                "WHERE state = 'running' AND lease_expires < ?",
+                (self.max_attempts, now))
+            row = db.execute(
+                "SELECT id, source, kind, command, input_file, attempts "
+                "FROM steps s WHERE state = 'pending' AND NOT EXISTS ("
+                "  SELECT 1 FROM edges e JOIN steps d ON d.id = e.depends_on"
+                "  WHERE e.step = s.id AND d.state != 'done') "
+                "ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE steps SET state = 'running', lease_owner = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (owner, now + self.lease_seconds, row[0]))
+        return Step(*row[:5] + (row[5] + 1,))
+
+    def heartbeat(self, step_id, owner):
+        """Renew `owner`'s lease on a step, returning False if it has
+        been lost
+        """
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE steps SET lease_expires = ? "
+                "WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (time.time() + self.lease_seconds, step_id, owner)
+            ).rowcount == 1
+
+    def complete(self, step_id, owner):
+        self._finish(step_id, owner, 'done', None)
+
+    def fail(self, step_id, owner, error):
+        """Record that a step failed; it's tried again unless it has
+        already had `max_attempts`
+        """
+        with self.transaction() as db:
+            attempts = db.execute(
+                "SELECT attempts FROM steps WHERE id = ?",
+                (step_id,)).fetchone()[0]
+        state = 'failed' if attempts >= self.max_attempts else 'pending'
+        self._finish(step_id, owner, state, error)
+
+    def _finish(self, step_id, owner, state, error):
+        with self.transaction() as db:
+            updated = db.execute(
+                "UPDATE steps SET state = ?, error = ?, lease_owner = NULL, "
+                "lease_expires = NULL, finished_at = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                (state, error, time.time(), step_id, owner)).rowcount
+        if not updated:
+            raise QueueError(
+                "Lost the lease on step %s before it finished" % step_id)
+
+    def retry_failed(self):
+        """Make failed steps ready to be tried again
+        """
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE steps SET state = 'pending', attempts = 0 "
+                "WHERE state = 'failed'")
+
+    def counts(self):
+        """Return the number of steps in each state
+        """
+        return dict(self.db.execute(
+            "SELECT state, count(*) FROM steps GROUP BY state").fetchall())
+
+    def failures(self):
+        return self.db.execute(
+            "SELECT source, command, error FROM steps "
+            "WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def runnable(self):
+        """Return True if any step is running, or could still run
+        """
+        counts = self.counts()
+        if counts.get('running'):
+            return True
+        # Pending steps behind a failure, however far back, will never
+        # be ready
+        return self.db.execute(
+            "WITH RECURSIVE blocked(id) AS ("
+            "  SELECT id FROM steps WHERE state = 'failed'"
+            "  UNION"
+            "  SELECT e.step FROM edges e"
+            "  JOIN blocked b ON e.depends_on = b.id"
+            ") SELECT count(*) FROM steps WHERE state = 'pending' "
+            "AND id NOT IN blocked"
+        ).fetchone()[0] > 0
+
+
+class Transaction(object):
+    """Context manager running statements in an IMMEDIATE transaction,
+    which takes the database's write lock up front
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
+
+
+class Heartbeat(object):
+    """Context manager renewing a lease in a background thread while a
+    step runs.
+
+    Database errors are retried until the lease would have run out. If
+    the lease is lost, `lost` is set, and `check` raises LeaseLost; the
+    step should then stop before recording anything, as another worker
+    may be running it.
+
+    """
+    def __init__(self, queue, step_id, owner):
+        self.queue = queue
+        self.step_id = step_id
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        renewed = time.time()
+        wait = self.queue.lease_seconds / 3.0
+        while not self.stopped.wait(wait):
+            try:
+                if not self.queue.heartbeat(self.step_id, self.owner):
+                    self.lost.set()
+                    return
+            except sqlite3.Error as e:
+                if time.time() - renewed >= self.queue.lease_seconds:
+                    print "Gave up renewing lease on step %s: %s" % (
+                        self.step_id, e)
+                    self.lost.set()
+                    return
+                print "Couldn't renew lease on step %s, retrying: %s" % (
+                    self.step_id, e)
+                wait = HEARTBEAT_RETRY_SECONDS
+                continue
+            renewed = time.time()
+            wait = self.queue.lease_seconds / 3.0
+
+    def check(self):
+        """Raise LeaseLost if the lease has been lost
+        """
+        if self.lost.is_set():
+            raise LeaseLost(
+                "Lost the lease on step %s; another worker may be "
+                "running it" % self.step_id)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()